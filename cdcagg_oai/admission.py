@@ -0,0 +1,328 @@
+# Copyright CESSDA ERIC 2021-2025
+#
+# Licensed under the EUPL, Version 1.2 (the "License"); you may not
+# use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Admission control for OAI-PMH requests.
+
+Limits the number of OAI-PMH requests processed concurrently, in total
+and per harvester. Harvesters are identified by their IP address or
+User-Agent. Requests exceeding the limits wait in a queue per
+harvester. Free slots are shared between the queues using weighted
+fair queuing, so that a harvester running many parallel requests does
+not starve the others. Requests are rejected with ``503 Service
+Unavailable``, a ``Retry-After`` header and an empty body when the
+harvester's queue is full.
+
+Limits apply to each server process.
+"""
+import time
+import asyncio
+from collections import deque
+
+from tornado.web import Finish
+
+from cdcagg_oai.metrics import (
+    set_requests_queued,
+    observe_requests_queue_duration,
+    observe_request_rejected
+)
+
+
+HARVESTER_KEY_IP = 'ip'
+HARVESTER_KEY_USER_AGENT = 'user-agent'
+HARVESTER_KEYS = (HARVESTER_KEY_IP, HARVESTER_KEY_USER_AGENT)
+
+
+class _Harvester:
+
+    __slots__ = ('weight', 'virtual_finish', 'in_flight', 'waiters')
+
+    def __init__(self, weight, virtual_time):
+        self.weight = weight
+        self.virtual_finish = virtual_time
+        self.in_flight = 0
+        self.waiters = deque()
+
+
+class _AdmissionController:
+    """Admit requests using per harvester queues.
+
+    Each admitted request advances the harvester's virtual finish time
+    by the inverse of its weight. Free slots go to the waiting
+    harvester with the smallest virtual finish time. Harvesters are
+    forgotten when they have no requests in flight or waiting.
+    """
+
+    def __init__(self):
+        self.max_in_flight = 0
+        self.harvester_max_in_flight = 0
+        self.harvester_max_queued = 0
+        self.weights = {}
+        self._harvesters = {}
+        self._in_flight = 0
+        self._queued = 0
+        self._virtual_time = 0.0
+
+    def configure(self, max_in_flight, harvester_max_in_flight, harvester_max_queued, weights=None):
+        """Configure limits.
+
+        :param int max_in_flight: Maximum number of requests in flight.
+                                  Zero for no limit.
+        :param int harvester_max_in_flight: Maximum number of requests in
+                                            flight per harvester. Zero for no limit.
+        :param int harvester_max_queued: Maximum number of waiting requests
+                                         per harvester.
+        :param dict or None weights: Weights keyed by harvester key.
+                                     Default weight is 1.
+        """
+        self.max_in_flight = max_in_flight
+        self.harvester_max_in_flight = harvester_max_in_flight
+        self.harvester_max_queued = harvester_max_queued
+        self.weights = dict(weights or {})
+
+    @property
+    def enabled(self):
+        """True if requests are limited."""
+        return self.max_in_flight > 0 or self.harvester_max_in_flight > 0
+
+    def _has_capacity(self, harvester):
+        return (self.max_in_flight <= 0 or self._in_flight < self.max_in_flight) and\
+            (self.harvester_max_in_flight <= 0 or harvester.in_flight < self.harvester_max_in_flight)
+
+    def _start(self, harvester):
+        harvester.virtual_finish = max(harvester.virtual_finish, self._virtual_time) + 1.0 / harvester.weight
+        harvester.in_flight += 1
+        self._in_flight += 1
+
+    def _set_queued(self, delta):
+        self._queued += delta
+        set_requests_queued(self._queued)
+
+    def _forget_if_idle(self, key):
+        harvester = self._harvesters.get(key)
+        if harvester is not None and harvester.in_flight == 0 and not harvester.waiters:
+            del self._harvesters[key]
+
+    def _dispatch(self):
+        while self.max_in_flight <= 0 or self._in_flight < self.max_in_flight:
+            eligible = [harvester for harvester in self._harvesters.values()
+                        if harvester.waiters and self._has_capacity(harvester)]
+            if not eligible:
+                return
+            harvester = min(eligible, key=lambda harvester: harvester.virtual_finish)
+            self._virtual_time = harvester.virtual_finish
+            self._start(harvester)
+            self._set_queued(-1)
+            harvester.waiters.popleft().set_result(True)
+
+    def admit(self, key):
+        """Admit a request of harvester.
+
+        :param str key: Harvester key.
+        :returns: Future resolving to True when the request may proceed
+                  or to False if it was withdrawn while waiting. None if
+                  the harvester's queue is full.
+        :rtype: :obj:`asyncio.Future` or None
+        """
+        harvester = self._harvesters.get(key)
+        if harvester is None:
+            harvester = self._harvesters[key] = _Harvester(self.weights.get(key, 1.0), self._virtual_time)
+        future = asyncio.get_event_loop().create_future()
+        if not harvester.waiters and self._has_capacity(harvester):
+            self._start(harvester)
+            future.set_result(True)
+            return future
+        if len(harvester.waiters) >= self.harvester_max_queued:
+            self._forget_if_idle(key)
+            return None
+        harvester.waiters.append(future)
+        self._set_queued(1)
+        return future
+
+    def withdraw(self, key, future):
+        """Withdraw a waiting request.
+
+        :param str key: Harvester key.
+        :param future: Future returned by :meth:`admit`.
+        """
+        harvester = self._harvesters.get(key)
+        if harvester is None or future not in harvester.waiters:
+            return
+        harvester.waiters.remove(future)
+        self._set_queued(-1)
+        future.set_result(False)
+        self._forget_if_idle(key)
+
+    def release(self, key):
+        """Release slot of an admitted request.
+
+        :param str key: Harvester key.
+        """
+        harvester = self._harvesters[key]
+        harvester.in_flight -= 1
+        self._in_flight -= 1
+        self._dispatch()
+        self._forget_if_idle(key)
+
+
+_CONTROLLER = _AdmissionController()
+
+
+class _AdmissionControlMixin:
+    """Wait for admission before processing OAI-PMH request.
+
+    Mixed in to OAI route handler class by :func:`handler_class`.
+    """
+
+    harvester_key = HARVESTER_KEY_IP
+    retry_after = 10
+    _admission_key = None
+    _admission = None
+    _admitted = False
+
+    def _get_harvester_key(self):
+        if self.harvester_key == HARVESTER_KEY_USER_AGENT:
+            return self.request.headers.get('User-Agent', '')
+        return self.request.remote_ip
+
+    def _reject(self):
+        observe_request_rejected()
+        self.set_status(503)
+        self.set_header('Retry-After', str(self.retry_after))
+        self.finish()
+
+    async def prepare(self):
+        """Wait for admission and continue processing the request.
+
+        Rejects the request if the harvester's queue is full.
+        """
+        self._admission_key = self._get_harvester_key()
+        self._admission = _CONTROLLER.admit(self._admission_key)
+        if self._admission is None:
+            self._reject()
+            return
+        if not self._admission.done():
+            started = time.monotonic()
+            await self._admission
+            observe_requests_queue_duration(time.monotonic() - started)
+        self._admitted = self._admission.result()
+        if not self._admitted:
+            # Connection was closed while waiting.
+            self.set_status(503)
+            raise Finish()
+        result = super().prepare()
+        if result is not None:
+            await result
+
+    def on_connection_close(self):
+        """Withdraw waiting request when client closes connection."""
+        if self._admission is not None and not self._admission.done():
+            _CONTROLLER.withdraw(self._admission_key, self._admission)
+        super().on_connection_close()
+
+    def on_finish(self):
+        """Release slot of admitted request."""
+        if self._admitted:
+            self._admitted = False
+            _CONTROLLER.release(self._admission_key)
+        super().on_finish()
+
+
+def handler_class(oai_route_handler_class):
+    """Return OAI route handler class with admission control.
+
+    :param oai_route_handler_class: Handler responsible for OAI-PMH requests.
+    :returns: Subclass of oai_route_handler_class.
+    """
+    return type('Admitted' + oai_route_handler_class.__name__,
+                (_AdmissionControlMixin, oai_route_handler_class), {})
+
+
+def is_enabled():
+    """Return True if admission control is enabled.
+
+    :rtype: bool
+    """
+    return _CONTROLLER.enabled
+
+
+def _parse_weights(value):
+    weights = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        key, separator, weight = item.rpartition('=')
+        if not separator or not key.strip():
+            raise ValueError("Invalid harvester weight '%s'. Expected <harvester>=<weight>." % (item,))
+        weight = float(weight)
+        if weight <= 0:
+            raise ValueError("Harvester weight must be positive: '%s'" % (item,))
+        weights[key.strip()] = weight
+    return weights
+
+
+def add_cli_args(parser):
+    """Add command line arguments to argument parser.
+
+    :param parser: Argument parser.
+    :type parser: :obj:`configargparse.ArgumentParser`
+    """
+    parser.add('--oai-pmh-max-in-flight',
+               help='Maximum number of OAI-PMH requests processed concurrently. Applies to each '
+               'worker process. Set to 0 for no limit.',
+               default=0,
+               env_var='OPRH_OP_MAX_IN_FLIGHT',
+               type=int)
+    parser.add('--oai-pmh-harvester-max-in-flight',
+               help='Maximum number of OAI-PMH requests processed concurrently per harvester. '
+               'Applies to each worker process. Set to 0 for no limit.',
+               default=0,
+               env_var='OPRH_OP_HARVESTER_MAX_IN_FLIGHT',
+               type=int)
+    parser.add('--oai-pmh-harvester-max-queued',
+               help='Maximum number of OAI-PMH requests waiting for admission per harvester. '
+               'Applies to each worker process. Requests exceeding the limit are rejected with '
+               '503 Service Unavailable, a Retry-After header and an empty body.',
+               default=10,
+               env_var='OPRH_OP_HARVESTER_MAX_QUEUED',
+               type=int)
+    parser.add('--oai-pmh-harvester-key',
+               help='Identify harvesters by IP address or User-Agent.',
+               default=HARVESTER_KEY_IP,
+               choices=list(HARVESTER_KEYS),
+               env_var='OPRH_OP_HARVESTER_KEY',
+               type=str)
+    parser.add('--oai-pmh-harvester-weights',
+               help='Comma separated list of <harvester>=<weight> pairs. Harvesters with higher '
+               'weight get a larger share of concurrent requests. Default weight is 1.',
+               default='',
+               env_var='OPRH_OP_HARVESTER_WEIGHTS',
+               type=str)
+    parser.add('--oai-pmh-retry-after',
+               help='Seconds in Retry-After header of rejected OAI-PMH requests.',
+               default=10,
+               env_var='OPRH_OP_RETRY_AFTER',
+               type=int)
+
+
+def configure(settings):
+    """Configure admission control with loaded settings.
+
+    :param settings: Loaded settings.
+    :type settings: :obj:`argparse.Namespace`
+    :raises ValueError: If harvester weights are invalid.
+    """
+    _CONTROLLER.configure(settings.oai_pmh_max_in_flight,
+                          settings.oai_pmh_harvester_max_in_flight,
+                          settings.oai_pmh_harvester_max_queued,
+                          _parse_weights(settings.oai_pmh_harvester_weights))
+    _AdmissionControlMixin.harvester_key = settings.oai_pmh_harvester_key
+    _AdmissionControlMixin.retry_after = settings.oai_pmh_retry_after
@@ -0,0 +1,225 @@
+# Copyright CESSDA ERIC 2021-2025
+#
+# Licensed under the EUPL, Version 1.2 (the "License"); you may not
+# use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Coalesce identical concurrent OAI-PMH requests.
+
+The first OAI-PMH GET request with a given set of arguments is
+processed normally and its response body is recorded. Identical
+requests received while it is in progress wait for it to finish and
+are answered with the same status, headers and bytes, without querying
+the Document Store or rendering the response again. Hop-by-hop headers
+and headers describing the individual response, such as
+``Content-Length`` and ``Date``, are not shared.
+
+Requests are identical if they have the same OAI-PMH arguments in any
+order, and the loaded OAI set mapping files have not changed. If the
+requested URL is echoed in responses, requests must also have the same
+URL. Responses with server errors are not shared, nor are 304 Not
+Modified responses to conditional requests. Waiting requests are
+processed normally instead.
+
+Requests are coalesced within each server process.
+"""
+import asyncio
+
+from cdcagg_oai.metadataformats import ConfigurableAggMDSet
+from cdcagg_oai.metrics import observe_request_coalesced
+
+
+# Headers set for each response by Tornado or the connection.
+_UNSHARED_HEADERS = frozenset(name.lower() for name in (
+    'Connection', 'Keep-Alive', 'Proxy-Authenticate', 'Proxy-Authorization', 'TE', 'Trailer',
+    'Transfer-Encoding', 'Upgrade', 'Content-Length', 'Date', 'Etag'))
+
+
+def _shared_headers(headers):
+    return [(name, value) for name, value in headers.get_all() if name.lower() not in _UNSHARED_HEADERS]
+
+
+async def request_key(request, include_url=False):
+    """Return key identifying responses of OAI-PMH GET request.
+
+    Requests with equal keys get identical responses while the
+    Document Store contents do not change.
+
+    :param request: HTTP request.
+    :type request: :obj:`tornado.httputil.HTTPServerRequest`
+    :param bool include_url: True if requests with different URLs get
+                             different responses.
+    :rtype: tuple
+    """
+    arguments = tuple(sorted((name, tuple(values)) for name, values in request.query_arguments.items()))
+    mapping_mtimes = tuple(sorted((await ConfigurableAggMDSet.get_mapping_mtimes()).items()))
+    url = request.full_url() if include_url else None
+    return (request.host, request.path, arguments, mapping_mtimes, url)
+
+
+class _Flights:
+    """Keep track of OAI-PMH requests in progress."""
+
+    def __init__(self):
+        self.enabled = False
+        self.key_includes_url = False
+        self._pending = {}
+
+    def configure(self, enabled, key_includes_url):
+        """Configure request coalescing.
+
+        :param bool enabled: True to coalesce requests.
+        :param bool key_includes_url: True if requests with different
+                                      URLs get different responses.
+        """
+        self.enabled = enabled
+        self.key_includes_url = key_includes_url
+
+    def get(self, key):
+        """Return future of response in progress, or None.
+
+        :param tuple key: Key of request.
+        :rtype: :obj:`asyncio.Future` or None
+        """
+        return self._pending.get(key)
+
+    def start(self, key):
+        """Mark response of key in progress.
+
+        :param tuple key: Key of request.
+        """
+        self._pending[key] = asyncio.get_event_loop().create_future()
+
+    def complete(self, key, response):
+        """Pass response to waiting requests.
+
+        :param tuple key: Key of request.
+        :param response: Status, headers and body of response,
+                         or None if the waiting requests should be
+                         processed normally.
+        :type response: tuple or None
+        """
+        self._pending.pop(key).set_result(response)
+
+
+_FLIGHTS = _Flights()
+
+
+class _CoalescingMixin:
+    """Share responses of identical concurrent OAI-PMH requests.
+
+    Mixed in to OAI route handler class by :func:`handler_class`.
+    """
+
+    #: True if the response was shared from another request.
+    shared_response = False
+    _flight_key = None
+    _recorded = None
+    _recorded_headers = None
+
+    async def prepare(self):
+        """Wait for identical request in progress and respond with its response.
+
+        Otherwise record the response for identical requests received
+        while this one is in progress.
+        """
+        result = super().prepare()
+        if result is not None:
+            await result
+        if self._finished or self.request.method != 'GET':
+            return
+        key = await request_key(self.request, _FLIGHTS.key_includes_url)
+        flight = _FLIGHTS.get(key)
+        if flight is None:
+            _FLIGHTS.start(key)
+            self._flight_key = key
+            self._recorded = []
+            return
+        response = await flight
+        if response is None:
+            return
+        status, headers, body = response
+        observe_request_coalesced()
+        self.shared_response = True
+        self.set_status(status)
+        for name in set(name for name, _ in headers):
+            self.clear_header(name)
+        for name, value in headers:
+            self.add_header(name, value)
+        self.finish(body)
+
+    def flush(self, include_footers=False):
+        """Record response headers and body before flushing them.
+
+        Headers are recorded before output transforms change them.
+
+        :param bool include_footers: Passed to
+                                     :meth:`tornado.web.RequestHandler.flush`
+        """
+        if self._recorded is not None:
+            if self._recorded_headers is None:
+                self._recorded_headers = _shared_headers(self._headers)
+            self._recorded.extend(self._write_buffer)
+        return super().flush(include_footers=include_footers)
+
+    def on_finish(self):
+        """Pass recorded response to waiting requests."""
+        if self._flight_key is not None:
+            response = None
+            if self.get_status() < 500 and self.get_status() != 304:
+                headers = self._recorded_headers
+                if headers is None:
+                    headers = _shared_headers(self._headers)
+                response = (self.get_status(), headers, b''.join(self._recorded))
+            _FLIGHTS.complete(self._flight_key, response)
+            self._flight_key = None
+            self._recorded = None
+            self._recorded_headers = None
+        super().on_finish()
+
+
+def handler_class(oai_route_handler_class):
+    """Return OAI route handler class coalescing identical requests.
+
+    :param oai_route_handler_class: Handler responsible for OAI-PMH requests.
+    :returns: Subclass of oai_route_handler_class.
+    """
+    return type('Coalescing' + oai_route_handler_class.__name__,
+                (_CoalescingMixin, oai_route_handler_class), {})
+
+
+def is_enabled():
+    """Return True if identical concurrent requests are coalesced.
+
+    :rtype: bool
+    """
+    return _FLIGHTS.enabled
+
+
+def add_cli_args(parser):
+    """Add command line arguments to argument parser.
+
+    :param parser: Argument parser.
+    :type parser: :obj:`configargparse.ArgumentParser`
+    """
+    parser.add('--oai-pmh-coalesce-requests',
+               help='Answer identical concurrent OAI-PMH GET requests with the response of '
+               'the first one instead of processing each request.',
+               action='store_true',
+               env_var='OPRH_OP_COALESCE_REQUESTS')
+
+
+def configure(settings):
+    """Configure request coalescing with loaded settings.
+
+    :param settings: Loaded settings.
+    :type settings: :obj:`argparse.Namespace`
+    """
+    _FLIGHTS.configure(settings.oai_pmh_coalesce_requests,
+                       settings.oai_pmh_respond_with_requested_url)
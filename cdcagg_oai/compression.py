@@ -0,0 +1,253 @@
+# Copyright CESSDA ERIC 2021-2025
+#
+# Licensed under the EUPL, Version 1.2 (the "License"); you may not
+# use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compress OAI-PMH responses.
+
+Provides a Tornado output transform, which compresses responses of the
+OAI route using the content encoding negotiated with the
+``Accept-Encoding`` request header. Supported encodings are gzip,
+deflate and, if the brotli package is installed, br.
+
+Compression is disabled by default. It is enabled by configuring the
+content encodings to use.
+"""
+import zlib
+
+from tornado.web import OutputTransform
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+ENCODING_BROTLI = 'br'
+ENCODING_GZIP = 'gzip'
+ENCODING_DEFLATE = 'deflate'
+ENCODINGS = (ENCODING_BROTLI, ENCODING_GZIP, ENCODING_DEFLATE)
+COMPRESSIBLE_CONTENT_TYPES = ('application/xml', 'text/xml')
+
+
+class _ZlibCompressor:
+
+    def __init__(self, level, wbits):
+        self._compressobj = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, chunk, finishing):
+        return self._compressobj.compress(chunk) + self._compressobj.flush(
+            zlib.Z_FINISH if finishing else zlib.Z_SYNC_FLUSH)
+
+
+class _BrotliCompressor:
+
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, chunk, finishing):
+        return self._compressor.process(chunk) + (
+            self._compressor.finish() if finishing else self._compressor.flush())
+
+
+def _accepted_encodings(accept_encoding):
+    accepted = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        qvalue = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        accepted[coding] = qvalue
+    return accepted
+
+
+def negotiate_encoding(accept_encoding, encodings):
+    """Choose content encoding for response.
+
+    Encodings with the highest quality value in ``Accept-Encoding``
+    win. Ties are resolved by the order of the server's encodings.
+
+    :param str accept_encoding: Value of Accept-Encoding request header.
+    :param encodings: Encodings supported by server in order of preference.
+    :type encodings: list or tuple
+    :returns: Chosen encoding or None if none is acceptable.
+    :rtype: str or None
+    """
+    accepted = _accepted_encodings(accept_encoding)
+    wildcard = accepted.get('*', 0.0)
+    chosen, chosen_qvalue = None, 0.0
+    for encoding in encodings:
+        qvalue = accepted.get(encoding, wildcard)
+        if qvalue > chosen_qvalue:
+            chosen, chosen_qvalue = encoding, qvalue
+    return chosen
+
+
+def _new_compressor(encoding):
+    if encoding == ENCODING_BROTLI:
+        return _BrotliCompressor(CompressionTransform.brotli_quality)
+    # gzip has a gzip header and trailer, deflate is zlib wrapped.
+    wbits = 16 + zlib.MAX_WBITS if encoding == ENCODING_GZIP else zlib.MAX_WBITS
+    return _ZlibCompressor(CompressionTransform.level, wbits)
+
+
+class CompressionTransform(OutputTransform):
+    """Compress responses of the OAI route.
+
+    Configured via :func:`configure`. Responses are compressed if
+    the client accepts one of the configured encodings, the content
+    type is XML and the response is not shorter than
+    :attr:`min_length`. Responses written in multiple chunks are
+    compressed regardless of their length.
+    """
+
+    encodings = ()
+    level = 6
+    brotli_quality = 4
+    min_length = 1024
+    path = None
+
+    def __init__(self, request):
+        super().__init__(request)
+        self._applies = request.path == self.path
+        self._encoding = None
+        self._compressor = None
+        if self._applies:
+            self._encoding = negotiate_encoding(request.headers.get('Accept-Encoding', ''), self.encodings)
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        if not self._applies:
+            return status_code, headers, chunk
+        if 'Vary' in headers:
+            headers['Vary'] += ', Accept-Encoding'
+        else:
+            headers['Vary'] = 'Accept-Encoding'
+        content_type = headers.get('Content-Type', '').split(';')[0].strip()
+        if self._encoding is None or\
+           status_code in (204, 304) or\
+           'Content-Encoding' in headers or\
+           content_type not in COMPRESSIBLE_CONTENT_TYPES or\
+           (finishing and len(chunk) < self.min_length):
+            return status_code, headers, chunk
+        headers['Content-Encoding'] = self._encoding
+        self._compressor = _new_compressor(self._encoding)
+        chunk = self.transform_chunk(chunk, finishing)
+        if 'Content-Length' in headers:
+            if finishing:
+                headers['Content-Length'] = str(len(chunk))
+            else:
+                del headers['Content-Length']
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        if self._compressor is None:
+            return chunk
+        return self._compressor.compress(chunk, finishing)
+
+
+def response_encoding(accept_encoding, content_type, length):
+    """Choose content encoding for a complete response.
+
+    Makes the same choice as :class:`CompressionTransform` for a
+    response written in a single chunk.
+
+    :param str accept_encoding: Value of Accept-Encoding request header.
+    :param str content_type: Value of Content-Type response header.
+    :param int length: Length of response body in bytes.
+    :returns: Chosen encoding or None if the response is not compressed.
+    :rtype: str or None
+    """
+    if content_type.split(';')[0].strip() not in COMPRESSIBLE_CONTENT_TYPES or\
+       length < CompressionTransform.min_length:
+        return None
+    return negotiate_encoding(accept_encoding, CompressionTransform.encodings)
+
+
+def compress(body, encoding):
+    """Compress complete response body.
+
+    :param bytes body: Response body.
+    :param str encoding: Content encoding.
+    :returns: Compressed body.
+    :rtype: bytes
+    """
+    return _new_compressor(encoding).compress(body, True)
+
+
+def is_enabled():
+    """Return True if response compression is enabled.
+
+    :rtype: bool
+    """
+    return bool(CompressionTransform.encodings)
+
+
+def add_cli_args(parser):
+    """Add command line arguments to argument parser.
+
+    :param parser: Argument parser.
+    :type parser: :obj:`configargparse.ArgumentParser`
+    """
+    parser.add('--oai-pmh-compression-encodings',
+               help='Comma separated list of content encodings used to compress OAI-PMH responses '
+               'in order of preference. Supported encodings are %s. Encoding %s requires the brotli '
+               'package. Leave empty to disable compression.' % (', '.join(ENCODINGS), ENCODING_BROTLI),
+               default='',
+               env_var='OPRH_OP_COMPRESSION_ENCODINGS',
+               type=str)
+    parser.add('--oai-pmh-compression-level',
+               help='Compression level from 1 to 9 for %s and %s encodings.' % (ENCODING_GZIP, ENCODING_DEFLATE),
+               default=6,
+               env_var='OPRH_OP_COMPRESSION_LEVEL',
+               type=int)
+    parser.add('--oai-pmh-compression-brotli-quality',
+               help='Compression quality from 0 to 11 for %s encoding.' % (ENCODING_BROTLI,),
+               default=4,
+               env_var='OPRH_OP_COMPRESSION_BROTLI_QUALITY',
+               type=int)
+    parser.add('--oai-pmh-compression-min-length',
+               help='Minimum length in bytes of OAI-PMH responses to compress.',
+               default=1024,
+               env_var='OPRH_OP_COMPRESSION_MIN_LENGTH',
+               type=int)
+
+
+def configure(settings):
+    """Configure response compression with loaded settings.
+
+    :param settings: Loaded settings.
+    :type settings: :obj:`argparse.Namespace`
+    :raises ValueError: If settings are invalid.
+    """
+    encodings = tuple(encoding.strip().lower() for encoding in settings.oai_pmh_compression_encodings.split(',')
+                      if encoding.strip())
+    for encoding in encodings:
+        if encoding not in ENCODINGS:
+            raise ValueError("Unsupported compression encoding '%s'. Supported encodings are %s."
+                             % (encoding, ', '.join(ENCODINGS)))
+        if encoding == ENCODING_BROTLI and brotli is None:
+            raise ValueError("Compression encoding '%s' requires the brotli package." % (ENCODING_BROTLI,))
+    if not 1 <= settings.oai_pmh_compression_level <= 9:
+        raise ValueError('Compression level must be from 1 to 9.')
+    if not 0 <= settings.oai_pmh_compression_brotli_quality <= 11:
+        raise ValueError('Brotli compression quality must be from 0 to 11.')
+    CompressionTransform.encodings = encodings
+    CompressionTransform.level = settings.oai_pmh_compression_level
+    CompressionTransform.brotli_quality = settings.oai_pmh_compression_brotli_quality
+    CompressionTransform.min_length = settings.oai_pmh_compression_min_length
+    CompressionTransform.path = '/%s/oai' % (settings.api_version,)
@@ -0,0 +1,273 @@
+# Copyright CESSDA ERIC 2021-2025
+#
+# Licensed under the EUPL, Version 1.2 (the "License"); you may not
+# use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Answer conditional OAI-PMH requests.
+
+OAI-PMH responses get a strong ``ETag`` header computed from the
+rendered response without its ``responseDate``, which is the only part
+that changes between identical responses. Requests with a matching
+``If-None-Match`` header are answered with 304 Not Modified. OAI-PMH
+error responses get no ``ETag``.
+
+Entity-tags of GetRecord responses are remembered together with a
+version of the record computed from its datestamps, the metadata
+prefix, the loaded OAI set mapping files and the deployment. A
+GetRecord request with ``If-None-Match`` looks up the record datestamps
+from DocStore, and is answered with 304 Not Modified before the record
+is fetched and rendered if the version and the entity-tag match.
+Requests without ``If-None-Match`` are not looked up.
+"""
+import os
+import re
+import hashlib
+from collections import OrderedDict
+from importlib import metadata
+
+from kuha_common.query import QueryController
+from cdcagg_common.records import Study
+
+from cdcagg_oai.metadataformats import ConfigurableAggMDSet
+
+
+_DISTRIBUTIONS = ('cdcagg_oai', 'cdcagg_common', 'kuha_common', 'kuha_oai_pmh_repo_handler')
+_GET_RECORD_ARGUMENTS = frozenset(('verb', 'identifier', 'metadataPrefix'))
+_RESPONSE_DATE = re.compile(rb'<responseDate>[^<]*</responseDate>')
+_OAI_ERROR = re.compile(rb'<error[\s>]')
+
+
+def _distribution_version(name):
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def entity_tag(body):
+    """Return strong entity-tag of rendered OAI-PMH response.
+
+    :param bytes body: Response body.
+    :returns: Entity-tag, or None for OAI-PMH error responses.
+    :rtype: str or None
+    """
+    if _OAI_ERROR.search(body):
+        return None
+    return '"%s"' % (hashlib.sha256(_RESPONSE_DATE.sub(b'', body)).hexdigest(),)
+
+
+class _Validators:
+    """Remember entity-tags of GetRecord responses by record version."""
+
+    def __init__(self):
+        self.enabled = False
+        self.max_entries = 0
+        self._salt = None
+        self._identifier_prefix = None
+        self._entity_tags = OrderedDict()
+
+    def configure(self, settings):
+        """Configure validators with loaded settings.
+
+        Record versions change with versions of the installed packages,
+        loaded settings and the source set mapping file, since these
+        affect the response contents.
+
+        :param settings: Loaded settings.
+        :type settings: :obj:`argparse.Namespace`
+        """
+        self.enabled = settings.oai_pmh_conditional_requests
+        self._entity_tags.clear()
+        if not self.enabled:
+            return
+        self.max_entries = settings.oai_pmh_conditional_requests_cache_size
+        sources_path = settings.oai_set_sources_path
+        self._salt = repr((tuple(map(_distribution_version, _DISTRIBUTIONS)),
+                           sorted((key, repr(value)) for key, value in vars(settings).items()),
+                           os.stat(sources_path).st_mtime_ns if sources_path else None))
+        self._identifier_prefix = 'oai:%s:' % (settings.oai_pmh_namespace_identifier,)
+
+    async def version(self, identifier, metadata_prefix, headers=None):
+        """Get version of GetRecord response.
+
+        :param str identifier: Requested OAI identifier.
+        :param str metadata_prefix: Requested metadata prefix.
+        :param dict or None headers: Headers for DocStore request.
+        :returns: Version, or None if the record is not found.
+        :rtype: str or None
+        """
+        # pylint: disable=protected-access
+        if identifier.startswith(self._identifier_prefix):
+            identifier = identifier[len(self._identifier_prefix):]
+        studies = []
+
+        async def _on_record(study):
+            studies.append(study)
+
+        await QueryController().query_single(Study, _on_record, headers=headers,
+                                             fields=[Study._metadata],
+                                             _filter={Study._aggregator_identifier: identifier})
+        if not studies:
+            return None
+        values = tuple(attr.get_value() for attr in (studies[0]._metadata.attr_updated,
+                                                     studies[0]._metadata.attr_deleted,
+                                                     studies[0]._metadata.attr_status))
+        mapping_mtimes = await ConfigurableAggMDSet.get_mapping_mtimes()
+        return hashlib.sha256(repr((self._salt, metadata_prefix, identifier, values,
+                                    sorted(mapping_mtimes.items()))).encode('utf8')).hexdigest()
+
+    def get(self, key, version):
+        """Return remembered entity-tag of GetRecord response.
+
+        :param tuple key: Requested identifier and metadata prefix.
+        :param str version: Current version of the response.
+        :returns: Entity-tag, or None if not remembered for version.
+        :rtype: str or None
+        """
+        remembered = self._entity_tags.get(key)
+        if remembered is None or remembered[0] != version:
+            return None
+        self._entity_tags.move_to_end(key)
+        return remembered[1]
+
+    def put(self, key, version, etag):
+        """Remember entity-tag of GetRecord response.
+
+        :param tuple key: Requested identifier and metadata prefix.
+        :param str version: Version of the response.
+        :param str etag: Entity-tag of the response.
+        """
+        if self.max_entries <= 0:
+            return
+        self._entity_tags[key] = (version, etag)
+        self._entity_tags.move_to_end(key)
+        while len(self._entity_tags) > self.max_entries:
+            self._entity_tags.popitem(last=False)
+
+
+_VALIDATORS = _Validators()
+
+
+class _ConditionalRequestMixin:
+    """Add entity-tags to OAI-PMH responses and answer conditional requests.
+
+    Mixed in to OAI route handler class by :func:`handler_class`.
+    """
+
+    mdprefixes = frozenset()
+    _version_key = None
+    _version = None
+
+    def _get_record_arguments(self):
+        arguments = self.request.query_arguments
+        if set(arguments) != _GET_RECORD_ARGUMENTS or any(len(values) != 1 for values in arguments.values()):
+            return None
+        if self.get_query_argument('verb') != 'GetRecord':
+            return None
+        metadata_prefix = self.get_query_argument('metadataPrefix')
+        if metadata_prefix not in self.mdprefixes:
+            return None
+        return self.get_query_argument('identifier'), metadata_prefix
+
+    async def prepare(self):
+        """Answer GetRecord request with 304 Not Modified if the client
+        already has the current response.
+        """
+        result = super().prepare()
+        if result is not None:
+            await result
+        if (self._finished or self.request.method not in ('GET', 'HEAD')
+                or 'If-None-Match' not in self.request.headers):
+            return
+        arguments = self._get_record_arguments()
+        if arguments is None:
+            return
+        version = await _VALIDATORS.version(*arguments, headers=self._correlation_id.as_header())
+        if version is None:
+            return
+        # Remember the entity-tag of the rendered response for this version.
+        self._version_key, self._version = arguments, version
+        etag = _VALIDATORS.get(arguments, version)
+        if etag is None:
+            return
+        self.set_header('Etag', etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return
+        # Computed again from the rendered response.
+        self.clear_header('Etag')
+
+    def compute_etag(self):
+        """Compute entity-tag of the rendered response.
+
+        Called by :meth:`tornado.web.RequestHandler.finish`, which
+        answers with 304 Not Modified if the entity-tag matches.
+        Responses written already encoded, such as compressed responses
+        served from the response cache, get no entity-tag.
+
+        :returns: Entity-tag or None.
+        :rtype: str or None
+        """
+        if 'Content-Encoding' in self._headers:
+            return None
+        etag = entity_tag(b''.join(self._write_buffer))
+        if etag is not None and self._version is not None:
+            _VALIDATORS.put(self._version_key, self._version, etag)
+        return etag
+
+
+def handler_class(oai_route_handler_class, mdformats):
+    """Return OAI route handler class answering conditional requests.
+
+    :param oai_route_handler_class: Handler responsible for OAI-PMH requests.
+    :param list mdformats: Configured metadataformats.
+    :returns: Subclass of oai_route_handler_class.
+    """
+    return type('Conditional' + oai_route_handler_class.__name__,
+                (_ConditionalRequestMixin, oai_route_handler_class),
+                {'mdprefixes': frozenset(mdformat.mdprefix for mdformat in mdformats)})
+
+
+def is_enabled():
+    """Return True if conditional requests are answered.
+
+    :rtype: bool
+    """
+    return _VALIDATORS.enabled
+
+
+def add_cli_args(parser):
+    """Add command line arguments to argument parser.
+
+    :param parser: Argument parser.
+    :type parser: :obj:`configargparse.ArgumentParser`
+    """
+    parser.add('--oai-pmh-conditional-requests',
+               help='Add strong ETag headers to OAI-PMH responses and answer requests with a '
+               'matching If-None-Match header with 304 Not Modified. GetRecord requests with '
+               'If-None-Match cost an extra DocStore query.',
+               action='store_true',
+               env_var='OPRH_OP_CONDITIONAL_REQUESTS')
+    parser.add('--oai-pmh-conditional-requests-cache-size',
+               help='Number of GetRecord entity-tags remembered to answer conditional GetRecord '
+               'requests without rendering the record.',
+               default=10000,
+               env_var='OPRH_OP_CONDITIONAL_REQUESTS_CACHE_SIZE',
+               type=int)
+
+
+def configure(settings):
+    """Configure conditional requests with loaded settings.
+
+    :param settings: Loaded settings.
+    :type settings: :obj:`argparse.Namespace`
+    """
+    _VALIDATORS.configure(settings)
@@ -0,0 +1,248 @@
+# Copyright CESSDA ERIC 2021-2025
+#
+# Licensed under the EUPL, Version 1.2 (the "License"); you may not
+# use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Shed OAI-PMH requests when the server is overloaded.
+
+Event loop lag is measured by scheduling a callback at a fixed
+interval and observing how late it runs. The lag grows when callbacks
+block the event loop, for example while rendering large responses.
+
+New OAI-PMH requests are rejected with ``503 Service Unavailable`` and
+a ``Retry-After`` header when the event loop lag or the number of
+OAI-PMH requests in progress exceeds the configured thresholds. The
+response has no body, as OAI-PMH flow control uses only the HTTP
+status and header. Requests already in progress are not affected, so
+the server recovers instead of slowing down every request.
+
+A request is in progress while its response is being produced.
+Requests waiting for admission or answered from the response cache
+are not counted.
+
+Lag and requests in progress are tracked per server process.
+"""
+import logging
+
+from tornado.ioloop import IOLoop
+
+from cdcagg_oai.metrics import (
+    set_event_loop_lag,
+    observe_request_shed
+)
+
+
+_logger = logging.getLogger(__name__)
+
+
+class _LagMonitor:
+    """Measure event loop lag."""
+
+    def __init__(self):
+        self.interval = 0
+        self.lag = 0.0
+        self._io_loop = None
+        self._expected = None
+
+    def start(self):
+        """Start measuring lag of current event loop.
+
+        Does nothing if measurements are disabled or the monitor is
+        already running on the current event loop.
+        """
+        if self.interval <= 0:
+            return
+        io_loop = IOLoop.current()
+        if io_loop is self._io_loop:
+            return
+        self._io_loop = io_loop
+        self.lag = 0.0
+        self._schedule()
+
+    def _schedule(self):
+        self._expected = self._io_loop.time() + self.interval
+        self._io_loop.call_later(self.interval, self._measure, self._io_loop)
+
+    def _measure(self, io_loop):
+        if io_loop is not self._io_loop:
+            return
+        self.lag = max(0.0, io_loop.time() - self._expected)
+        set_event_loop_lag(self.lag)
+        self._schedule()
+
+    def current_lag(self):
+        """Return lag in seconds.
+
+        Includes the time the next measurement is overdue, so that a
+        blocked event loop is noticed before the measurement runs.
+
+        :rtype: float
+        """
+        if self._io_loop is None:
+            return 0.0
+        return max(self.lag, self._io_loop.time() - self._expected)
+
+
+_MONITOR = _LagMonitor()
+
+
+class _LoadShedder:
+    """Decide whether new requests are shed."""
+
+    def __init__(self):
+        self.max_lag = 0.0
+        self.max_in_flight = 0
+        self.retry_after = 10
+        self.in_flight = 0
+        self._shedding = False
+
+    def configure(self, max_lag, max_in_flight, retry_after):
+        """Configure thresholds.
+
+        :param float max_lag: Maximum event loop lag in seconds.
+                              Zero for no limit.
+        :param int max_in_flight: Maximum number of requests in progress.
+                                  Zero for no limit.
+        :param int retry_after: Seconds in Retry-After header.
+        """
+        self.max_lag = max_lag
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+
+    @property
+    def enabled(self):
+        """True if requests are shed."""
+        return self.max_lag > 0 or self.max_in_flight > 0
+
+    def is_overloaded(self):
+        """Return True if new requests should be shed.
+
+        Logs a warning when shedding starts and stops.
+
+        :rtype: bool
+        """
+        lag = _MONITOR.current_lag()
+        overloaded = (0 < self.max_lag < lag) or (0 < self.max_in_flight <= self.in_flight)
+        if overloaded != self._shedding:
+            self._shedding = overloaded
+            if overloaded:
+                _logger.warning('Server overloaded. Shedding OAI-PMH requests. Event loop lag %.3fs, '
+                                '%s requests in progress.', lag, self.in_flight)
+            else:
+                _logger.info('Server recovered. Accepting OAI-PMH requests.')
+        return overloaded
+
+
+_SHEDDER = _LoadShedder()
+
+
+class _LoadSheddingMixin:
+    """Reject OAI-PMH request if the server is overloaded.
+
+    Mixed in to OAI route handler class by :func:`handler_class`.
+    """
+
+    _in_progress = False
+
+    async def prepare(self):
+        """Reject the request or continue processing it.
+
+        The request is counted as in progress once the wrapped handlers
+        have prepared it without finishing it.
+        """
+        if _SHEDDER.is_overloaded():
+            observe_request_shed()
+            self.set_status(503)
+            self.set_header('Retry-After', str(_SHEDDER.retry_after))
+            self.finish()
+            return
+        result = super().prepare()
+        if result is not None:
+            await result
+        if not self._finished:
+            self._in_progress = True
+            _SHEDDER.in_flight += 1
+
+    def on_finish(self):
+        """Count the request as completed."""
+        if self._in_progress:
+            self._in_progress = False
+            _SHEDDER.in_flight -= 1
+        super().on_finish()
+
+
+def handler_class(oai_route_handler_class):
+    """Return OAI route handler class shedding load.
+
+    :param oai_route_handler_class: Handler responsible for OAI-PMH requests.
+    :returns: Subclass of oai_route_handler_class.
+    """
+    return type('LoadShedding' + oai_route_handler_class.__name__,
+                (_LoadSheddingMixin, oai_route_handler_class), {})
+
+
+def is_enabled():
+    """Return True if requests are shed when overloaded.
+
+    :rtype: bool
+    """
+    return _SHEDDER.enabled
+
+
+def start_lag_monitor():
+    """Start measuring event loop lag of the current event loop.
+
+    Call in each server process.
+    """
+    _MONITOR.start()
+
+
+def add_cli_args(parser):
+    """Add command line arguments to argument parser.
+
+    :param parser: Argument parser.
+    :type parser: :obj:`configargparse.ArgumentParser`
+    """
+    parser.add('--event-loop-lag-interval',
+               help='Seconds between event loop lag measurements. Set to 0 to disable '
+               'measurements and shedding by event loop lag.',
+               default=1.0,
+               env_var='OPRH_EVENT_LOOP_LAG_INTERVAL',
+               type=float)
+    parser.add('--oai-pmh-shed-event-loop-lag',
+               help='Reject new OAI-PMH requests with 503 Service Unavailable when event loop '
+               'lag exceeds this many seconds. Set to 0 to disable.',
+               default=0,
+               env_var='OPRH_OP_SHED_EVENT_LOOP_LAG',
+               type=float)
+    parser.add('--oai-pmh-shed-in-flight',
+               help='Reject new OAI-PMH requests with 503 Service Unavailable when this many '
+               'OAI-PMH requests are in progress. Set to 0 to disable.',
+               default=0,
+               env_var='OPRH_OP_SHED_IN_FLIGHT',
+               type=int)
+
+
+def configure(settings):
+    """Configure load shedding with loaded settings.
+
+    Uses ``oai_pmh_retry_after`` defined by :mod:`cdcagg_oai.admission`.
+
+    :param settings: Loaded settings.
+    :type settings: :obj:`argparse.Namespace`
+    :raises ValueError: If shedding by event loop lag is enabled
+                        without lag measurements.
+    """
+    if settings.oai_pmh_shed_event_loop_lag > 0 and settings.event_loop_lag_interval <= 0:
+        raise ValueError('--oai-pmh-shed-event-loop-lag requires --event-loop-lag-interval')
+    _MONITOR.interval = settings.event_loop_lag_interval
+    _SHEDDER.configure(settings.oai_pmh_shed_event_loop_lag,
+                       settings.oai_pmh_shed_in_flight,
+                       settings.oai_pmh_retry_after)
@@ -13,8 +13,22 @@
 """Define metadataformats and sets of the OAI-PMH Repo Handler."""
 # Stdlib
 import os
+import sys
+import glob
+import time
+import marshal
+import hashlib
+import tempfile
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
 # PyPI
-from yaml import safe_load
+from yaml import load
+try:
+    from yaml import CSafeLoader as _YAMLLoader
+except ImportError:
+    from yaml import SafeLoader as _YAMLLoader
+from tornado.ioloop import IOLoop
 # Kuha Common
 from kuha_common.query import QueryController
 # Kuha OAI-PMH
@@ -29,6 +43,12 @@ from kuha_oai_pmh_repo_handler.constants import TEMPLATE_FOLDER
 from kuha_oai_pmh_repo_handler.oai.constants import OAI_RESPONSE_LIST_SIZE
 # CDCAGG Common
 from cdcagg_common.records import Study
+# CDCAGG OAI
+from cdcagg_oai import serializers
+from cdcagg_oai.metrics import observe_mapping_files_duration, observe_get_record_batch_size
+
+
+_logger = logging.getLogger(__name__)
 
 
 class InvalidMappingConfig(Exception):
@@ -43,6 +63,61 @@ def _is_nonempty_list(value):
     return hasattr(value, 'sort') and len(value) > 0
 
 
+def _write_yaml_cache(cache_path, contents):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file_obj:
+            marshal.dump(contents, file_obj)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _load_yaml(path, cache_dir=None):
+    """Load YAML file using libyaml based loader if available.
+
+    If cache_dir is given, the parsed contents are stored there in
+    marshal format keyed by the file contents hash. Subsequent loads
+    of unchanged contents read the cache instead of parsing YAML.
+    Cache files are written atomically. Stale cache files for the
+    same path are removed when a new one gets written. Cache errors
+    are logged and the file is parsed as YAML.
+
+    :param str path: Path to YAML file.
+    :param str or None cache_dir: Directory for cache files.
+    :returns: Parsed contents.
+    """
+    with open(path, 'rb') as file_obj:
+        content = file_obj.read()
+    if cache_dir is None:
+        return load(content, Loader=_YAMLLoader)
+    path_key = hashlib.sha256(os.path.abspath(path).encode('utf8')).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, '%s-%s.%s.marshal' % (
+        path_key, hashlib.sha256(content).hexdigest(), sys.implementation.cache_tag))
+    try:
+        with open(cache_path, 'rb') as file_obj:
+            return marshal.load(file_obj)
+    except FileNotFoundError:
+        pass
+    except (OSError, EOFError, ValueError, TypeError):
+        _logger.warning("Unable to read mapping file cache '%s'", cache_path, exc_info=True)
+    result = load(content, Loader=_YAMLLoader)
+    try:
+        _write_yaml_cache(cache_path, result)
+    except (OSError, ValueError):
+        # ValueError is raised for unmarshallable values, such as YAML timestamps.
+        _logger.warning("Unable to write mapping file cache '%s'", cache_path, exc_info=True)
+        return result
+    for stale_path in glob.glob(os.path.join(cache_dir, '%s-*.marshal' % (path_key,))):
+        if stale_path != cache_path:
+            try:
+                os.remove(stale_path)
+            except OSError:
+                pass
+    return result
+
+
 def _validate_keys_values(node, path, *keys_funcs):
     keys_funcs = [('spec', _is_nonempty_str),
                   ('name', _is_nonempty_str)] + list(keys_funcs)
@@ -56,14 +131,383 @@ def _validate_keys_values(node, path, *keys_funcs):
                                        % (path, value, key))
 
 
-class ConfigurableAggMDSet(MDFormat.MDSet):
+class _MappingFileIO:
+    """Run blocking mapping file I/O outside the event loop.
+
+    Reading and parsing mapping files is submitted to a bounded
+    executor, which is created on first use. Time spent in each
+    operation is observed in ``mapping_files_duration`` metric.
+    """
+
+    max_workers = 1
+    _executor = None
+
+    @staticmethod
+    def timed(operation, func, *args):
+        """Call func with args and observe the duration.
+
+        :param str operation: Operation label used in metric.
+        :param callable func: Blocking function to call.
+        :returns: Return value of func.
+        """
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            observe_mapping_files_duration(operation, time.perf_counter() - start)
+
+    @classmethod
+    async def run(cls, operation, func, *args):
+        """Call func with args in the executor and observe the duration.
+
+        :param str operation: Operation label used in metric.
+        :param callable func: Blocking function to call.
+        :returns: Return value of func.
+        """
+        if cls._executor is None:
+            cls._executor = ThreadPoolExecutor(max_workers=cls.max_workers,
+                                               thread_name_prefix='cdcagg-oai-mapping-files')
+        return await IOLoop.current().run_in_executor(cls._executor, cls.timed, operation, func, *args)
+
+
+class _ConfigurableSetIndex:
+    """In-memory index of configurable set mapping.
+
+    Built once from a validated mapping file contents with external
+    nodes merged in. Maps identifiers to second-level setspecs and
+    second-level setspecs to identifiers.
+
+    :param dict cnf: Validated mapping file contents.
+    """
+
+    def __init__(self, cnf):
+        self.name = cnf.get('name')
+        self.description = cnf.get('description')
+        #: Second-level set definitions as (spec, name, description) tuples in declaration order.
+        self.nodes = []
+        #: Maps second-level spec to a frozenset of identifiers.
+        self.identifiers_by_spec = {}
+        specs_by_identifier = {}
+        for node in cnf['nodes']:
+            spec = node['spec']
+            self.nodes.append((spec, node.get('name'), node.get('description')))
+            identifiers = frozenset(node['identifiers'])
+            self.identifiers_by_spec[spec] = identifiers
+            for identifier in identifiers:
+                specs_by_identifier.setdefault(identifier, set()).add(spec)
+        #: Maps identifier to a frozenset of second-level specs.
+        self.specs_by_identifier = {identifier: frozenset(specs)
+                                    for identifier, specs in specs_by_identifier.items()}
+        self.identifiers = frozenset(self.specs_by_identifier)
+        self._spec_order = {spec: index for index, (spec, _, __) in enumerate(self.nodes)}
+        # Query filter values are built once here, so that building the index on reload
+        # happens outside the event loop and requests share the same lists.
+        # Sorting keeps the filter stable between requests and processes.
+        self._filter_values = {spec: self._sorted(identifiers)
+                               for spec, identifiers in self.identifiers_by_spec.items()}
+        self._filter_values[None] = self._sorted(self.identifiers)
+
+    @staticmethod
+    def _sorted(identifiers):
+        # Mapping files may mix identifier types, such as int and str.
+        return sorted(identifiers, key=lambda identifier: (type(identifier).__name__, identifier))
+
+    def get_specs(self, identifier):
+        """Return second-level specs of identifier in declaration order.
+
+        :param str identifier: Record identifier.
+        :returns: List of specs.
+        :rtype: list
+        """
+        return sorted(self.specs_by_identifier.get(identifier, ()), key=self._spec_order.__getitem__)
+
+    def get_identifiers(self, spec=None):
+        """Return identifiers belonging to second-level spec.
+
+        :param str or None spec: Second-level spec. None returns identifiers of all specs.
+        :returns: Identifiers.
+        :rtype: frozenset
+        """
+        if spec is None:
+            return self.identifiers
+        return self.identifiers_by_spec.get(spec, frozenset())
+
+    def get_filter_values(self, spec=None):
+        """Return sorted identifiers belonging to second-level spec for use in query filter.
+
+        The returned list is shared between callers and must not be modified.
+
+        :param str or None spec: Second-level spec. None returns identifiers of all specs.
+        :returns: Sorted identifiers.
+        :rtype: list
+        """
+        return self._filter_values.get(spec, [])
+
+
+class _ListSetsCache:
+    """Process-wide cache of OAI sets declared in ListSets responses.
+
+    Records the (spec, name, description) values each MDSet passes to
+    the ListSets callback and replays them for subsequent requests until
+    ttl seconds have passed or the cache entry gets invalidated. Entries
+    are keyed by MDSet class. Caching is disabled if ttl is not positive.
+    """
+
+    def __init__(self):
+        self.ttl = 0
+        self._entries = {}
+        self._generation = 0
+
+    def invalidate(self, key=None):
+        """Invalidate cached sets of key. None invalidates all.
+
+        :param key: MDSet class or None.
+        """
+        self._generation += 1
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    async def query(self, key, query_func, on_set_cb):
+        """Call on_set_cb for cached sets of key. Call query_func on cache miss.
+
+        :param key: MDSet class.
+        :param query_func: Async function querying sets with signature (on_set_cb).
+        :param on_set_cb: Async callback with signature (spec, name=None, description=None)
+        """
+        if self.ttl <= 0:
+            await query_func(on_set_cb)
+            return
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() < entry[0]:
+            for spec, name, description in entry[1]:
+                await on_set_cb(spec, name=name, description=description)
+            return
+        generation = self._generation
+        sets = []
+
+        async def _record(spec, name=None, description=None):
+            sets.append((spec, name, description))
+            await on_set_cb(spec, name=name, description=description)
+        await query_func(_record)
+        if generation == self._generation:
+            # Sets did not get invalidated while querying.
+            self._entries[key] = (time.monotonic() + self.ttl, sets)
+
+
+_LIST_SETS_CACHE = _ListSetsCache()
+
+
+class _GetRecordBatch:
+
+    __slots__ = ('headers', 'merged_headers', 'futures', 'handle')
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.merged_headers = []
+        self.futures = {}
+        self.handle = None
+
+
+class _GetRecordBatcher:
+    """Process-wide batching of GetRecord DocStore lookups.
+
+    Lookups of the same record class and fields received within window
+    seconds of the first lookup of a batch are fetched with a single
+    DocStore query on aggregator identifiers. A batch is queried early
+    when it holds max_size distinct identifiers. Concurrent lookups of
+    the same identifier share the result. Batching is disabled if
+    window is not positive.
+
+    A batch is fetched with the DocStore request headers of its first
+    lookup, so headers must not change the query results. Headers are
+    only expected to carry the correlation id of the request.
+    """
+
+    def __init__(self):
+        self.window = 0
+        self.max_size = 0
+        self._batches = {}
+
+    @property
+    def enabled(self):
+        """True if lookups are batched."""
+        return self.window > 0
+
+    async def get(self, study_class, identifier, headers=None, fields=None):
+        """Look up study by aggregator identifier as part of a batch.
+
+        :param study_class: Study record class.
+        :param str identifier: Aggregator identifier of the study.
+        :param dict or None headers: Headers for DocStore request. Must not
+                                     change the query results. Headers of
+                                     the first lookup are used for the
+                                     whole batch. Headers of the other
+                                     lookups are logged with them.
+        :param list or None fields: Fields to fetch. Lookups with
+                                    different fields are batched separately.
+        :returns: Study or None if not found.
+        """
+        key = (study_class, None if fields is None else tuple(fields))
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = _GetRecordBatch(headers)
+            batch.handle = asyncio.get_event_loop().call_later(self.window, self._dispatch, key, batch)
+        else:
+            batch.merged_headers.append(headers)
+        future = batch.futures.get(identifier)
+        if future is None:
+            future = batch.futures[identifier] = asyncio.get_event_loop().create_future()
+            if len(batch.futures) >= self.max_size:
+                batch.handle.cancel()
+                self._dispatch(key, batch)
+        return await asyncio.shield(future)
+
+    def _dispatch(self, key, batch):
+        if self._batches.get(key) is batch:
+            del self._batches[key]
+        asyncio.ensure_future(self._query(key, batch))
+
+    async def _query(self, key, batch):
+        # pylint: disable=protected-access
+        study_class, fields = key
+        studies = {}
+
+        async def _on_record(study):
+            studies[study._aggregator_identifier.get_value()] = study
+        if batch.merged_headers:
+            _logger.debug('Querying %s GetRecord lookups with headers %s for requests with headers %s',
+                          len(batch.futures), batch.headers, batch.merged_headers)
+        query_kwargs = {} if fields is None else {'fields': list(fields)}
+        try:
+            await QueryController().query_multiple(
+                study_class, _on_record, headers=batch.headers,
+                _filter={study_class._aggregator_identifier:
+                         {QueryController.fk_constants.in_: list(batch.futures)}},
+                **query_kwargs)
+            observe_get_record_batch_size(len(batch.futures))
+            for identifier, future in batch.futures.items():
+                future.set_result(studies.get(identifier))
+        except Exception as exc:  # pylint: disable=broad-except
+            for future in batch.futures.values():
+                if not future.done():
+                    future.set_exception(exc)
+        finally:
+            # Query got cancelled. Don't leave lookups waiting.
+            for future in batch.futures.values():
+                if not future.done():
+                    future.cancel()
+
+
+_GET_RECORD_BATCHER = _GetRecordBatcher()
+
+
+def add_cli_args(parser):
+    """Add command line arguments shared by all metadataformats.
+
+    :param parser: Argument parser.
+    :type parser: :obj:`configargparse.ArgumentParser`
+    """
+    parser.add('--oai-pmh-list-sets-cache-ttl',
+               help='Seconds to serve OAI sets of ListSets responses from memory. '
+               'Set to 0 to disable caching.',
+               default=0,
+               env_var='OPRH_OP_LIST_SETS_CACHE_TTL',
+               type=float)
+    parser.add('--oai-pmh-serializer-engine',
+               help='Engine used to serialize record metadata. The compiled engine writes '
+               'OAI-DC and OAI-Datacite metadata without Genshi template processing. '
+               'Output is the same for both engines.',
+               default=serializers.SERIALIZER_ENGINE_GENSHI,
+               choices=serializers.SERIALIZER_ENGINES,
+               env_var='OPRH_OP_SERIALIZER_ENGINE',
+               type=str)
+    parser.add('--oai-pmh-fragment-cache-size',
+               help='Number of serialized record metadata kept in memory by the compiled '
+               'serializer engine. Only OAI-DC and OAI-Datacite metadata is cached. '
+               'Set to 0 to disable caching.',
+               default=0,
+               env_var='OPRH_OP_FRAGMENT_CACHE_SIZE',
+               type=int)
+    parser.add('--oai-pmh-fragment-cache-dir',
+               help='Directory to store serialized record metadata evicted from memory. '
+               'Leave unset to keep the cache in memory only.',
+               env_var='OPRH_OP_FRAGMENT_CACHE_DIR',
+               type=str)
+    parser.add('--oai-pmh-fragment-cache-dir-max-files',
+               help='Maximum number of files in --oai-pmh-fragment-cache-dir. The oldest '
+               'files are removed when there are more. Set to 0 for no limit.',
+               default=100000,
+               env_var='OPRH_OP_FRAGMENT_CACHE_DIR_MAX_FILES',
+               type=int)
+    parser.add('--oai-pmh-get-record-batch-window',
+               help='Milliseconds to collect GetRecord requests into a single Document Store '
+               'query. Set to 0 to query each record separately.',
+               default=0,
+               env_var='OPRH_OP_GET_RECORD_BATCH_WINDOW',
+               type=float)
+    parser.add('--oai-pmh-get-record-batch-size',
+               help='Maximum number of records fetched by a single batched GetRecord query.',
+               default=100,
+               env_var='OPRH_OP_GET_RECORD_BATCH_SIZE',
+               type=int)
+
+
+def configure(settings):
+    """Configure settings shared by all metadataformats.
+
+    :param settings: Loaded settings.
+    :type settings: :obj:`argparse.Namespace`
+    """
+    _LIST_SETS_CACHE.ttl = settings.oai_pmh_list_sets_cache_ttl
+    _LIST_SETS_CACHE.invalidate()
+    serializers.set_engine(settings.oai_pmh_serializer_engine)
+    serializers.configure_fragment_cache(settings.oai_pmh_fragment_cache_size,
+                                         settings.oai_pmh_fragment_cache_dir,
+                                         settings.oai_pmh_fragment_cache_dir_max_files)
+    if settings.oai_pmh_get_record_batch_window > 0 and settings.oai_pmh_get_record_batch_size < 1:
+        raise ValueError('GetRecord batch size must be positive.')
+    _GET_RECORD_BATCHER.window = settings.oai_pmh_get_record_batch_window / 1000.0
+    _GET_RECORD_BATCHER.max_size = settings.oai_pmh_get_record_batch_size
+
+
+class _CachedListSetsMixin:
+    """Serve :meth:`query` of MDSet from the process-wide ListSets cache.
+
+    Sets are queried with :meth:`_query_sets` on cache miss. Sets
+    defining their own query override :meth:`_query_sets` instead of
+    :meth:`query`.
+    """
+
+    async def _query_sets(self, on_set_cb):
+        await super().query(on_set_cb)
+
+    async def query(self, on_set_cb):
+        """Query sets or replay them from cache.
+
+        :param on_set_cb: Async callback with signature (spec, name=None, description=None)
+        :returns: None
+        """
+        await _LIST_SETS_CACHE.query(type(self), self._query_sets, on_set_cb)
+
+
+def _cached_list_sets(set_class):
+    return type(set_class.__name__, (_CachedListSetsMixin, set_class), {'__doc__': set_class.__doc__})
+
+
+class ConfigurableAggMDSet(_CachedListSetsMixin, MDFormat.MDSet):
     """Configurable arbitrary OAI set
 
     Groups records to arbitrary sets.
 
     The grouping relies on a mapping file that maps OAI setspecs to
-    record's aggregator_identifiers. The mapping file is read everytime this class is used
-    to query(), get() or filter() records.
+    record's aggregator_identifiers. The mapping file is read on configure()
+    and kept in-memory as an index. If reload interval is configured, the
+    mapping file and external configuration files are checked for changes
+    at most once per interval. Changed files are reloaded and validated in
+    an executor thread and the index is replaced only if the new contents are
+    valid.
 
     The mapping file is expected to be valid YAML. A single
     spec-key must be found from top-level. The spec value is used as a
@@ -104,9 +548,10 @@ class ConfigurableAggMDSet(MDFormat.MDSet):
 
       * Supports hierachical set of records with a single top-level node. Example setspec: ``top_level_node``
       * Only direct child nodes are supported after the top-level node. Example setspec: ``top_level_node:child_node``
-      * The mapping file YAML syntax is checked on configure() and mandatory keys are validated. Since it is not loaded
-        to memory, it is possible to modify the file contents while the server is operating. This may lead to
-        errors during runtime.
+      * The mapping file YAML syntax is checked on configure() and mandatory keys are validated.
+        The same checks are made on reload. Invalid contents are logged and the previously loaded
+        index is kept in use.
+      * The top-level spec cannot be changed by reloading the mapping file.
       * The top-level spec node is used to identify this particular MDSet.
         For example if the configuration file declares spec: ``first`` a request with
         OAI setspec value ``first:second`` implies that the correct MDSet class to consult is this one.
@@ -151,6 +596,15 @@ class ConfigurableAggMDSet(MDFormat.MDSet):
         - id_8
     """
     _loaded_filepath = None
+    # Index of the mapping file contents. Populated on configure and
+    # replaced on reload.
+    _index = None
+    # Modification times of loaded files keyed by filepath.
+    _mtimes = None
+    _reload_interval = 0
+    _last_reload_check = 0
+    _cache_dir = None
+    _reload_future = None
 
     @classmethod
     def add_cli_args(cls, parser):
@@ -164,6 +618,18 @@ class ConfigurableAggMDSet(MDFormat.MDSet):
                    'Leave unset to discard configurable set.',
                    env_var='OPRH_OS_CONFIGURABLE_PATH',
                    type=str)
+        parser.add('--oai-set-configurable-reload-interval',
+                   help='Interval in seconds to check configurable OAI set definitions '
+                   'for changes. Changed definitions are reloaded. Set to 0 to disable reloading.',
+                   default=0,
+                   env_var='OPRH_OS_CONFIGURABLE_RELOAD_INTERVAL',
+                   type=float)
+        parser.add('--oai-set-configurable-cache-dir',
+                   help='Directory to cache parsed configurable OAI set definitions. '
+                   'Unchanged definitions are read from cache instead of parsing YAML. '
+                   'Leave unset to disable caching.',
+                   env_var='OPRH_OS_CONFIGURABLE_CACHE_DIR',
+                   type=str)
 
     @classmethod
     def _validate_node(cls, node, path):
@@ -171,9 +637,15 @@ class ConfigurableAggMDSet(MDFormat.MDSet):
 
     @classmethod
     def _validate_config(cls, cnf_path):
+        """Load and validate mapping file and external mapping files.
+
+        :param str cnf_path: Path to mapping file.
+        :returns: Mapping file contents with external nodes merged in
+                  and a set of paths of all loaded files.
+        :rtype: tuple
+        """
         def _load_file(cnf_path):
-            with open(cnf_path, 'r') as file_obj:
-                return safe_load(file_obj)
+            return _load_yaml(cnf_path, cache_dir=cls._cache_dir)
         cnf = _load_file(cnf_path)
         _validate_keys_values(cnf, cnf_path, ('nodes', _is_nonempty_list))
 
@@ -189,13 +661,89 @@ class ConfigurableAggMDSet(MDFormat.MDSet):
                     continue
                 yield (node_or_path, cnf_path)
 
+        nodes = []
+        paths = {cnf_path}
         for node, path in _iter_node_and_path(cnf):
             cls._validate_node(node, path)
-        return cnf
+            nodes.append(node)
+            paths.add(path)
+        cnf['nodes'] = nodes
+        return cnf, paths
+
+    @staticmethod
+    def _stat_mtimes(paths):
+        return {path: os.stat(path).st_mtime_ns for path in paths}
+
+    @classmethod
+    def _build_index(cls, cnf_path, known_paths):
+        """Load, validate and index mapping files.
+
+        Modification times of known paths are read before the files are
+        loaded, so that changes made during the load get noticed on the next
+        check.
+
+        :param str cnf_path: Path to mapping file.
+        :param known_paths: Paths of previously loaded files.
+        :returns: Mapping file contents, index and modification times of loaded files.
+        :rtype: tuple
+        """
+        mtimes = cls._stat_mtimes(known_paths)
+        cnf, paths = cls._validate_config(cnf_path)
+        mtimes.update(cls._stat_mtimes(paths.difference(mtimes)))
+        return cnf, _ConfigurableSetIndex(cnf), mtimes
+
+    @classmethod
+    def _files_changed(cls):
+        try:
+            return cls._stat_mtimes(cls._mtimes) != cls._mtimes
+        except OSError:
+            # File is missing. Let reload report the error.
+            return True
+
+    @classmethod
+    async def _reload(cls):
+        """Reload mapping files if they have changed.
+
+        Files are checked and loaded in a bounded executor. The index is
+        replaced only if the new contents are valid.
+        """
+        try:
+            if not await _MappingFileIO.run('stat', cls._files_changed):
+                return
+            cnf, index, mtimes = await _MappingFileIO.run(
+                'load', cls._build_index, cls._loaded_filepath, set(cls._mtimes))
+        except Exception:  # pylint: disable=broad-except
+            _logger.exception("Unable to reload configurable set mapping '%s'. "
+                              "Keeping previously loaded mapping.", cls._loaded_filepath)
+            return
+        if cnf['spec'] != cls.spec:
+            _logger.error("Unable to reload configurable set mapping '%s'. Top-level spec cannot be "
+                          "changed from '%s' to '%s'. Keeping previously loaded mapping.",
+                          cls._loaded_filepath, cls.spec, cnf['spec'])
+            return
+        cls._index = index
+        cls._mtimes = mtimes
+        _LIST_SETS_CACHE.invalidate(cls)
+        _logger.info("Reloaded configurable set mapping '%s'", cls._loaded_filepath)
+
+    @classmethod
+    def _schedule_reload(cls):
+        if cls._reload_interval <= 0 or cls._reload_future is not None:
+            return
+        now = time.monotonic()
+        if now - cls._last_reload_check < cls._reload_interval:
+            return
+        cls._last_reload_check = now
+
+        def _on_done(_):
+            cls._reload_future = None
+        cls._reload_future = asyncio.ensure_future(cls._reload())
+        cls._reload_future.add_done_callback(_on_done)
 
     @classmethod
     def configure(cls, settings):
-        """Configure set with loaded settings. Validate mapping file.
+        """Configure set with loaded settings. Validate mapping file and
+        load it to memory. Setup reload interval.
 
         :param settings: Loaded settings.
         :type settings: :obj:`argparse.Namespace`
@@ -204,32 +752,31 @@ class ConfigurableAggMDSet(MDFormat.MDSet):
         if path is None:
             # Don't load this set.
             return False
-        # Load to ensure correct yaml syntax.
-        cnf = cls._validate_config(path)
+        cls._cache_dir = settings.oai_set_configurable_cache_dir
+        cnf, cls._index, cls._mtimes = _MappingFileIO.timed('load', cls._build_index, path, {path})
         cls.spec = cnf['spec']
         cls._loaded_filepath = path
+        cls._reload_interval = settings.oai_set_configurable_reload_interval
+        cls._last_reload_check = time.monotonic()
+        _LIST_SETS_CACHE.invalidate(cls)
         return True
 
-    @staticmethod
-    async def _load_file(filepath):
-        with open(filepath, 'r') as file_obj:
-            return safe_load(file_obj)
+    @classmethod
+    async def _get_index(cls):
+        cls._schedule_reload()
+        return cls._index
 
     @classmethod
-    async def _get_config(cls):
-        cnf = await cls._load_file(cls._loaded_filepath)
-        nodes = []
-        for node in cnf.get('nodes', []):
-            if 'path' in node:
-                ext_cnf = await cls._load_file(node['path'])
-                if hasattr(ext_cnf, 'items'):
-                    # ext_cnf is a dict
-                    ext_cnf = [ext_cnf]
-                nodes.extend(ext_cnf)
-            else:
-                nodes.append(node)
-        cnf['nodes'] = nodes
-        return cnf
+    async def get_mapping_mtimes(cls):
+        """Return modification times of loaded mapping files.
+
+        The modification times change when the mapping gets reloaded.
+
+        :returns: Modification times in nanoseconds keyed by filepath.
+        :rtype: dict
+        """
+        await cls._get_index()
+        return dict(cls._mtimes or {})
 
     async def fields(self):
         """Return list of fields to include when querying for record headers.
@@ -243,6 +790,16 @@ class ConfigurableAggMDSet(MDFormat.MDSet):
         return [self._mdformat.study_class._aggregator_identifier]
 
     async def query(self, on_set_cb):
+        """Check mapping files for changes and query sets or replay them from cache.
+
+        :param on_set_cb: Async callback with signature (spec, name=None, description=None)
+        :returns: None
+        """
+        # Cached sets are replayed without looking up the index.
+        self._schedule_reload()
+        await super().query(on_set_cb)
+
+    async def _query_sets(self, on_set_cb):
         """Query and add distinct values for setspecs
 
         This is used when constructing ListSets OAI response.
@@ -250,12 +807,10 @@ class ConfigurableAggMDSet(MDFormat.MDSet):
         :param on_set_cb: Async callback with signature (spec, name=None, description=None)
         :returns: None
         """
-        cnf = await self._get_config()
-        await on_set_cb(self.spec, name=cnf.get('name'), description=cnf.get('description'))
-        for node in cnf.get('nodes', []):
-            await on_set_cb(':'.join((self.spec, node['spec'])),
-                            name=node.get('name'),
-                            description=node.get('description'))
+        index = await self._get_index()
+        await on_set_cb(self.spec, name=index.name, description=index.description)
+        for spec, name, description in index.nodes:
+            await on_set_cb(':'.join((self.spec, spec)), name=name, description=description)
 
     async def get(self, study):
         """Get values from record used in setspec: ':<value>'.
@@ -266,13 +821,8 @@ class ConfigurableAggMDSet(MDFormat.MDSet):
         :param study: study record to get set values from
         :returns: List of values
         """
-        identifier = study._aggregator_identifier.get_value()
-        cnf = await self._get_config()
-        values = []
-        for node in cnf.get('nodes', []):
-            if identifier in node.get('identifiers', []):
-                values.append(node['spec'])
-        return values
+        index = await self._get_index()
+        return index.get_specs(study._aggregator_identifier.get_value())
 
     async def filter(self, value):
         """Return a query filter that includes all studies matching 'value'.
@@ -284,23 +834,18 @@ class ConfigurableAggMDSet(MDFormat.MDSet):
         :returns: query filter
         :rtype: dict
         """
-        cnf = await self._get_config()
-        identifiers = []
-        for node in cnf.get('nodes', []):
-            if value is None or value == node.get('spec'):
-                identifiers.extend(node.get('identifiers', []))
-                if value is not None:
-                    break
+        index = await self._get_index()
         return {self._mdformat.study_class._aggregator_identifier:
-                {QueryController.fk_constants.in_: list(set(identifiers))}}
+                {QueryController.fk_constants.in_: index.get_filter_values(value)}}
 
 
-class SourceAggMDSet(MDFormat.MDSet):
+class SourceAggMDSet(_CachedListSetsMixin, MDFormat.MDSet):
     """OAI set grouping records by their originating source archive
 
     The grouping relies on a mapping file that maps a record source url (OAI base url)
     to a source value. This file is read once on configure() and kept in-memory for
-    the rest of the application run time.
+    the rest of the application run time. Each url and each source value must be
+    unique within the mapping file.
 
     Mapping file syntax::
 
@@ -319,6 +864,11 @@ class SourceAggMDSet(MDFormat.MDSet):
     # Contains source definitions. Populated once on configure and kept in-memory
     # for the rest of the application run time.
     _source_defs = None
+    # Lookup tables built from source definitions on configure.
+    # Maps url to (source, setname, description)
+    _defs_by_url = None
+    # Maps source to url
+    _url_by_source = None
 
     @classmethod
     def add_cli_args(cls, parser):
@@ -334,35 +884,47 @@ class SourceAggMDSet(MDFormat.MDSet):
 
     @classmethod
     def configure(cls, settings):
-        """Configure set with loaded settings. Load mapping file to memory.
+        """Configure set with loaded settings. Load mapping file to memory
+        and build lookup tables.
 
         :param settings: Loaded settings.
         :type settings: :obj:`argparse.Namespace`
+        :raises: :exc:`InvalidMappingConfig` if mapping file contains duplicate urls or sources.
         """
         path = settings.oai_set_sources_path
         if path is None:
             # Don't load this set.
             return False
-        with open(path, 'r') as file_obj:
-            cls._source_defs = safe_load(file_obj) or []
+        source_defs = _MappingFileIO.timed('load', cls._load_source_defs, path)
+        defs_by_url = {}
+        url_by_source = {}
+        for source_def in source_defs:
+            url, source = source_def['url'], source_def['source']
+            if url in defs_by_url:
+                raise InvalidMappingConfig("Invalid mapping file '%s'. Duplicate url '%s'." % (path, url))
+            if source in url_by_source:
+                raise InvalidMappingConfig("Invalid mapping file '%s'. Duplicate source '%s'." % (path, source))
+            defs_by_url[url] = (source, source_def['setname'], source_def.get('description'))
+            url_by_source[source] = url
+        cls._source_defs = source_defs
+        cls._defs_by_url = defs_by_url
+        cls._url_by_source = url_by_source
+        _LIST_SETS_CACHE.invalidate(cls)
         return True
 
+    @staticmethod
+    def _load_source_defs(path):
+        return _load_yaml(path) or []
+
     @classmethod
     async def _get_source_defs(cls):
         return cls._source_defs
 
     async def _get_definitions_by_url(self, url):
-        source_defs = await self._get_source_defs()
-        for source_def in source_defs:
-            if source_def['url'] == url:
-                return (source_def['source'], source_def['setname'], source_def.get('description'))
-        return (None, None, None)
+        return self._defs_by_url.get(url, (None, None, None))
 
     async def _get_url_by_source(self, source):
-        source_defs = await self._get_source_defs()
-        for source_def in source_defs:
-            if source_def['source'] == source:
-                return source_def['url']
+        return self._url_by_source.get(source)
 
     async def fields(self):
         """Return list of fields to include when querying for record headers.
@@ -375,7 +937,7 @@ class SourceAggMDSet(MDFormat.MDSet):
         """
         return [self._mdformat.study_class._provenance]
 
-    async def query(self, on_set_cb):
+    async def _query_sets(self, on_set_cb):
         """Query and add distinct values for setspecs
 
         This is used when constructing ListSets OAI response.
@@ -444,7 +1006,8 @@ class AggMetadataFormatBase(MDFormat):
     Overrides parent's :attr:`sets` to keep Kuha's `language` and
     `openaire_data` OAI sets, and to include Aggregator's
     :class:`SourceAggMDSet` and :class:`ConfigurableAggMDSet` OAI
-    sets.
+    sets. All sets are served from the ListSets cache when it is
+    enabled.
 
     Overrides parent's :meth:`_header_fields` to include
     :attr:`cdcagg_common.records.Study._aggregator_identifier` and
@@ -457,15 +1020,26 @@ class AggMetadataFormatBase(MDFormat):
     Overrides parents :meth:`_valid_record_filter` to use
     :attr:`cdcagg_common.records.Study._aggregator_identifier` for
     record lookup in DocStore query.
+
+    Overrides parents :meth:`_on_record` to read serialized metadata of
+    the record cached on disk before the response gets rendered.
+
+    Overrides parents :meth:`_get_record` to look up the record as part
+    of a batched DocStore query when GetRecord batching is enabled.
+    Records not found or not added to the response by :meth:`_on_record`
+    are looked up again by the parent, which responds with
+    idDoesNotExist.
     """
 
     default_template_folders = MDFormat.default_template_folders + [
         os.path.join(os.path.dirname(os.path.realpath(__file__)), TEMPLATE_FOLDER)]
     study_class = Study
-    sets = [MDFormat.get_set('language'),
-            MDFormat.get_set('openaire_data'),
+    sets = [_cached_list_sets(MDFormat.get_set('language')),
+            _cached_list_sets(MDFormat.get_set('openaire_data')),
             SourceAggMDSet,
             ConfigurableAggMDSet]
+    # Number of records passed on to the parent's _on_record.
+    _added_records = 0
 
     async def _header_fields(self):
         return await super()._header_fields() + [self.study_class._aggregator_identifier,
@@ -477,6 +1051,26 @@ class AggMetadataFormatBase(MDFormat):
     async def _valid_record_filter(self):
         return {self.study_class._aggregator_identifier: self._oai.arguments.get_local_identifier()}
 
+    async def _on_record(self, study, **record_objs):
+        self._added_records += 1
+        await serializers.load_fragment(self.mdprefix, study)
+        await super()._on_record(study, **record_objs)
+
+    async def _get_record(self):
+        if not _GET_RECORD_BATCHER.enabled:
+            return await super()._get_record()
+        study = await _GET_RECORD_BATCHER.get(self.study_class, self._oai.arguments.get_local_identifier(),
+                                              headers=self.corr_id_header,
+                                              fields=await self._header_fields() + self._record_fields)
+        if study is not None:
+            added_records = self._added_records
+            await self._on_record(study)
+            if self._added_records > added_records:
+                return None
+        # Not found, or dropped by _on_record. Let Kuha look up the
+        # record and respond with idDoesNotExist.
+        return await super()._get_record()
+
 
 class AggDCMetadataFormat(AggMetadataFormatBase):
     """Define metadataformat for OAI-DC.
@@ -25,6 +25,10 @@ For more information, see the prometheus client docs
 (https://github.com/prometheus/client_python#multiprocess-mode-eg-gunicorn).
 """
 import os
+import time
+import asyncio
+import logging
+from tornado.ioloop import IOLoop, PeriodicCallback
 from prometheus_client import (
     CollectorRegistry,
     Gauge,
@@ -43,6 +47,10 @@ from kuha_common.document_store.constants import REC_STATUS_DELETED
 from cdcagg_common.records import Study
 
 
+_logger = logging.getLogger(__name__)
+# File in the multiprocess directory whose modification time tells when
+# records & publishers gauges were last refreshed by any worker process.
+_SHARED_REFRESH_FILE = "records_refreshed"
 # Disable default metrics
 REGISTRY.unregister(GC_COLLECTOR)
 REGISTRY.unregister(PLATFORM_COLLECTOR)
@@ -60,6 +68,56 @@ _METRICS = {
     "requests_succeeded": Counter("requests_succeeded", "Number of successful catalogue requests"),
     "requests_failed": Counter("requests_failed", "Number of failed catalogue requests"),
     "requests_duration": Summary("requests_duration", "Response time in milliseconds", ["verb", "metadataPrefix"]),
+    "mapping_files_duration": Summary(
+        "mapping_files_duration",
+        "Time spent reading and parsing OAI set mapping files in milliseconds",
+        ["operation"],
+    ),
+    "fragment_cache_lookups": Counter(
+        "fragment_cache_lookups",
+        "Number of serialized record metadata cache lookups",
+        ["result"],
+    ),
+    "response_cache_lookups": Counter(
+        "response_cache_lookups",
+        "Number of OAI-PMH response cache lookups",
+        ["result"],
+    ),
+    "requests_queued": Gauge(
+        "requests_queued",
+        "Number of OAI-PMH requests waiting for admission",
+        multiprocess_mode="livesum",
+    ),
+    "requests_queue_duration": Summary(
+        "requests_queue_duration",
+        "Time OAI-PMH requests waited for admission in milliseconds",
+    ),
+    "requests_rejected": Counter(
+        "requests_rejected",
+        "Number of OAI-PMH requests rejected because the admission queue was full",
+    ),
+    "requests_shed": Counter(
+        "requests_shed",
+        "Number of OAI-PMH requests rejected because the server was overloaded",
+    ),
+    "requests_coalesced": Counter(
+        "requests_coalesced",
+        "Number of OAI-PMH requests answered with the response of an identical concurrent request",
+    ),
+    "get_record_batch_size": Summary(
+        "get_record_batch_size",
+        "Number of GetRecord lookups fetched by a single batched Document Store query",
+    ),
+    "event_loop_lag": Gauge(
+        "event_loop_lag",
+        "Delay of scheduled event loop callbacks in milliseconds",
+        multiprocess_mode="livemax",
+    ),
+    "publishers_counts_failures": Counter(
+        "publishers_counts_failures",
+        "Number of failed record count queries per Publisher",
+        ["publisher"],
+    ),
     # Define Aggregator OAI-PMH metrics - Service provider (Publisher) metrics
     "records_total": None,
     "records_total_without_deleted": None,
@@ -70,6 +128,78 @@ _METRICS = {
 }
 
 
+def observe_mapping_files_duration(operation, seconds):
+    """Observe time spent reading and parsing OAI set mapping files.
+
+    :param str operation: Operation label value.
+    :param float seconds: Duration in seconds.
+    """
+    _METRICS["mapping_files_duration"].labels(operation=operation).observe(1000.0 * seconds)
+
+
+def observe_fragment_cache_lookup(result):
+    """Count serialized record metadata cache lookup.
+
+    :param str result: Lookup result label value.
+    """
+    _METRICS["fragment_cache_lookups"].labels(result=result).inc()
+
+
+def observe_response_cache_lookup(result):
+    """Count OAI-PMH response cache lookup.
+
+    :param str result: Lookup result, hit or miss.
+    """
+    _METRICS["response_cache_lookups"].labels(result=result).inc()
+
+
+def set_requests_queued(count):
+    """Set number of OAI-PMH requests waiting for admission.
+
+    :param int count: Number of queued requests.
+    """
+    _METRICS["requests_queued"].set(count)
+
+
+def observe_requests_queue_duration(seconds):
+    """Observe time an OAI-PMH request waited for admission.
+
+    :param float seconds: Duration in seconds.
+    """
+    _METRICS["requests_queue_duration"].observe(1000.0 * seconds)
+
+
+def observe_request_rejected():
+    """Count OAI-PMH request rejected by admission control."""
+    _METRICS["requests_rejected"].inc()
+
+
+def observe_request_shed():
+    """Count OAI-PMH request rejected by load shedding."""
+    _METRICS["requests_shed"].inc()
+
+
+def observe_request_coalesced():
+    """Count OAI-PMH request answered with the response of another request."""
+    _METRICS["requests_coalesced"].inc()
+
+
+def observe_get_record_batch_size(size):
+    """Observe number of GetRecord lookups in a batched query.
+
+    :param int size: Number of looked up records.
+    """
+    _METRICS["get_record_batch_size"].observe(size)
+
+
+def set_event_loop_lag(seconds):
+    """Set measured event loop lag.
+
+    :param float seconds: Lag in seconds.
+    """
+    _METRICS["event_loop_lag"].set(1000.0 * seconds)
+
+
 class _Gauge(Gauge):
     _MULTIPROC_MODES = set(list(Gauge._MULTIPROC_MODES) + ["current"])
 
@@ -109,7 +239,12 @@ def _initialize_metrics_registry():
         if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
             registry = CollectorRegistry()
             _MultiProcessCollector(registry)
-            _common_kwargs = {"multiprocess_mode": "current", "registry": registry}
+            if _REFRESHER.shared_refresh_path is None:
+                _common_kwargs = {"multiprocess_mode": "current", "registry": registry}
+            else:
+                # Worker processes share a single refresh. Serve the most
+                # recent values set by any worker from the multiprocess files.
+                _common_kwargs = {"multiprocess_mode": "mostrecent", "registry": None}
         else:
             registry = REGISTRY
             # The mode is not read at all when not using the MultiProcessCollector.
@@ -145,57 +280,260 @@ def _initialize_metrics_registry():
     )
 
 
-class CDCAggMetricsHandler(server.RequestHandler):
-    """Interface for prometheus server
-
-    Provides a HTTP GET for collecting metrics using pull model over
-    HTTP.
+async def _count_records(query_ctrl, concurrency=1):
+    """Count records and records per Publisher with DocStore count queries.
+
+    Queries distinct Publisher base URLs and counts records for each
+    Publisher. Count queries are run concurrently, at most
+    `concurrency` at a time. A failed count query for a single
+    Publisher is logged and reported via
+    ``publishers_counts_failures`` metric, and the Publisher is left
+    out of the result.
+
+    :param query_ctrl: Query controller to use.
+    :type query_ctrl: :obj:`kuha_common.query.QueryController`
+    :param int concurrency: Maximum number of concurrent count queries.
+    :returns: Tuple of total records count, total records count
+              without deleted records and a dict mapping each
+              Publisher base URL to a two-item list of record counts
+              with and without deleted records.
+    :rtype: tuple
+    """
+    # pylint: disable=protected-access
+    semaphore = asyncio.Semaphore(concurrency)
+    not_deleted_filter = {Study._metadata.attr_status: {query_ctrl.fk_constants.not_equal: REC_STATUS_DELETED}}
+
+    async def _count(**kwargs):
+        async with semaphore:
+            return await query_ctrl.query_count(Study, **kwargs)
+
+    async def _count_publisher(base_url):
+        try:
+            return await asyncio.gather(
+                _count(_filter={Study._direct_base_url: base_url}),
+                _count(
+                    _filter={query_ctrl.fk_constants.and_: [{Study._direct_base_url: base_url}, not_deleted_filter]}
+                ),
+            )
+        except Exception:  # pylint: disable=broad-except
+            _logger.exception("Unable to count records for publisher %s", base_url)
+            _METRICS["publishers_counts_failures"].labels(publisher=base_url).inc()
+            return None
+
+    distinct_base_urls, records_total, records_total_without_deleted = await asyncio.gather(
+        query_ctrl.query_distinct(Study, fieldname=Study._direct_base_url),
+        _count(),
+        _count(_filter=not_deleted_filter),
+    )
+    base_urls = distinct_base_urls[Study._direct_base_url.path]
+    publishers = {}
+    for base_url, counts in zip(base_urls, await asyncio.gather(*map(_count_publisher, base_urls))):
+        if counts is None or counts[0] == 0:
+            # Either the count failed or the base_url is not the direct source
+            continue
+        publishers[base_url] = counts
+    return records_total, records_total_without_deleted, publishers
+
+
+class _RecordsGaugesRefresher:
+    """Keep records & publishers gauges up-to-date.
+
+    Gauges may be refreshed periodically in background or on demand
+    from :class:`CDCAggMetricsHandler`. Gauge values older than
+    :attr:`max_age` seconds are considered stale and get refreshed
+    before they are served. Concurrent refresh requests share a
+    single refresh.
+
+    If :attr:`shared_refresh_path` is set, gauge values and the time
+    of the last refresh are shared between worker processes, so that a
+    refresh made by one worker is served by all of them.
     """
 
-    async def get(self):
-        """HTTP GET handler for prometheus metrics"""
-        # Disable pylint protected-acccess in this method scope, since
-        # it is giving lots of noise.
-        # pylint: disable=protected-access
+    def __init__(self):
+        self.interval = 0
+        self.max_age = 0
+        self.count_concurrency = 1
+        self.shared_refresh_path = None
+        self._refreshed_at = None
+        self._refreshing = None
+        self._periodic_callback = None
+
+    def configure(self, interval, max_age, count_concurrency=1, shared_refresh_path=None):
+        """Configure refresh interval, staleness bound and counting.
+
+        :param float interval: Seconds between background refreshes. 0 disables background refresh.
+        :param float max_age: Maximum age of served gauge values in seconds.
+        :param int count_concurrency: Maximum number of concurrent DocStore count queries.
+        :param str or None shared_refresh_path: File to record refresh time shared between
+                                                worker processes. None if not shared.
+        """
+        self.interval = interval
+        self.max_age = max_age
+        self.count_concurrency = count_concurrency
+        self.shared_refresh_path = shared_refresh_path
+
+    def is_stale(self):
+        """Return True if gauge values should be refreshed before serving them.
+
+        :rtype: bool
+        """
+        if self.shared_refresh_path is None:
+            return self._refreshed_at is None or time.monotonic() - self._refreshed_at >= self.max_age
+        try:
+            refreshed_at = os.stat(self.shared_refresh_path).st_mtime
+        except FileNotFoundError:
+            return True
+        return time.time() - refreshed_at >= self.max_age
+
+    def start(self):
+        """Start background refresh in the current IOLoop.
+
+        Gauges are refreshed as soon as the IOLoop runs and then every
+        :attr:`interval` seconds. Does nothing if background refresh is
+        disabled or already running.
+        """
+        if self.interval <= 0 or self._periodic_callback is not None:
+            return
+        self._periodic_callback = PeriodicCallback(self._refresh_in_background, self.interval * 1000)
+        self._periodic_callback.start()
+        IOLoop.current().add_callback(self._refresh_in_background)
+
+    def stop(self):
+        """Stop background refresh."""
+        if self._periodic_callback is not None:
+            self._periodic_callback.stop()
+            self._periodic_callback = None
+
+    async def _refresh_in_background(self):
+        try:
+            await self.refresh()
+        except Exception:  # pylint: disable=broad-except
+            _logger.exception("Unable to refresh records metrics")
+
+    async def _refresh(self, headers):
         (
-            registry,
+            _,
             metric_records_total,
             metric_records_total_without_deleted,
             metric_publishers_total,
             metric_publishers_counts,
             metric_publishers_counts_without_deleted,
         ) = _initialize_metrics_registry()
-        query_ctrl = query.QueryController(headers=self._correlation_id.as_header())
-        # Total number of records included
-        metric_records_total.set(await query_ctrl.query_count(Study))
-        # Total number of records included without deleted ones
-        metric_records_total_without_deleted.set(
-            await query_ctrl.query_count(
-                Study, _filter={Study._metadata.attr_status: {query_ctrl.fk_constants.not_equal: REC_STATUS_DELETED}}
-            )
+        query_ctrl = query.QueryController(headers=headers)
+        records_total, records_total_without_deleted, publishers = await _count_records(
+            query_ctrl, concurrency=self.count_concurrency
         )
-        # Number of Publishers (Service Providers) included and
-        # Number of records included per Publisher
-        distinct_base_urls = await query_ctrl.query_distinct(Study, fieldname=Study._direct_base_url)
-        publishers_total_count = 0
-        for base_url in distinct_base_urls[Study._direct_base_url.path]:
-            count = await query_ctrl.query_count(Study, _filter={Study._direct_base_url: base_url})
-            if count == 0:
-                # The base_url is not the direct source
-                continue
-            publishers_total_count += 1
+        metric_records_total.set(records_total)
+        metric_records_total_without_deleted.set(records_total_without_deleted)
+        for base_url, (count, count_sans_deleted) in publishers.items():
             metric_publishers_counts.labels(publisher=base_url).set(count)
-            count_sans_deleted = await query_ctrl.query_count(
-                Study,
-                _filter={
-                    query_ctrl.fk_constants.and_: [
-                        {Study._direct_base_url: base_url},
-                        {Study._metadata.attr_status: {query_ctrl.fk_constants.not_equal: REC_STATUS_DELETED}},
-                    ]
-                },
-            )
             metric_publishers_counts_without_deleted.labels(publisher=base_url).set(count_sans_deleted)
-        metric_publishers_total.set(publishers_total_count)
+        metric_publishers_total.set(len(publishers))
+        self._refreshed_at = time.monotonic()
+        if self.shared_refresh_path is not None:
+            with open(self.shared_refresh_path, "a", encoding="utf-8"):
+                pass
+            os.utime(self.shared_refresh_path)
+
+    async def refresh(self, headers=None):
+        """Query DocStore and refresh gauge values.
+
+        If a refresh is already in progress, wait for it to complete
+        instead of starting a new one.
+
+        :param dict or None headers: Headers to send to DocStore.
+        """
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(self._refresh(headers))
+        try:
+            await self._refreshing
+        finally:
+            self._refreshing = None
+
+
+_REFRESHER = _RecordsGaugesRefresher()
+
+
+def add_cli_args(parser):
+    """Add command line arguments to argument parser.
+
+    :param parser: Argument parser.
+    :type parser: :obj:`configargparse.ArgumentParser`
+    """
+    parser.add(
+        "--metrics-refresh-interval",
+        help="Interval in seconds to refresh records and publishers metrics in background. "
+        "Set to 0 to disable background refresh. Requires --metrics-max-age of at least the interval.",
+        default=0,
+        env_var="METRICS_REFRESH_INTERVAL",
+        type=float,
+    )
+    parser.add(
+        "--metrics-max-age",
+        help="Maximum age in seconds of records and publishers metrics. Older metrics are "
+        "refreshed before responding. Set to 0 to refresh on every request.",
+        default=0,
+        env_var="METRICS_MAX_AGE",
+        type=float,
+    )
+    parser.add(
+        "--metrics-count-concurrency",
+        help="Maximum number of concurrent DocStore count queries per refresh. "
+        "Bounded by the maximum number of DocStore client connections.",
+        default=10,
+        env_var="METRICS_COUNT_CONCURRENCY",
+        type=int,
+    )
+
+
+def configure(settings):
+    """Configure metrics with loaded settings.
+
+    :param settings: Loaded settings.
+    :type settings: :obj:`argparse.Namespace`
+    :raises ValueError: If background refresh is enabled and metrics
+                        would get stale before they are refreshed.
+    """
+    if settings.metrics_refresh_interval > 0 and settings.metrics_max_age < settings.metrics_refresh_interval:
+        raise ValueError("--metrics-max-age must be at least --metrics-refresh-interval")
+    shared_refresh_path = None
+    if settings.workers > 1 and "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        shared_refresh_path = os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], _SHARED_REFRESH_FILE)
+    _REFRESHER.configure(
+        settings.metrics_refresh_interval,
+        settings.metrics_max_age,
+        count_concurrency=max(1, min(settings.metrics_count_concurrency, settings.document_store_client_max_clients)),
+        shared_refresh_path=shared_refresh_path,
+    )
+
+
+def start_refresh():
+    """Start refreshing records and publishers metrics in background.
+
+    Call in a single server process. With multiple worker processes
+    the refreshed values are shared between workers. Does nothing if
+    background refresh is disabled.
+    """
+    _REFRESHER.start()
+
+
+class CDCAggMetricsHandler(server.RequestHandler):
+    """Interface for prometheus server
+
+    Provides a HTTP GET for collecting metrics using pull model over
+    HTTP.
+
+    Records & publishers gauges are refreshed before responding only
+    if they are stale. See :func:`start_refresh` for refreshing them
+    in background.
+    """
+
+    async def get(self):
+        """HTTP GET handler for prometheus metrics"""
+        # pylint: disable=protected-access
+        registry = _initialize_metrics_registry()[0]
+        if _REFRESHER.is_stale():
+            await _REFRESHER.refresh(headers=self._correlation_id.as_header())
         encoder, content_type = choose_encoder(self.request.headers.get("accept"))
         self.set_header("Content-Type", content_type)
         self.finish(encoder(registry))
@@ -233,7 +571,11 @@ class CDCAggWebApp(server.WebApplication):
             return
         _METRICS["requests_total"].inc()
         _METRICS["requests_per_user_agent"].labels(harvester=handler.request.headers.get("User-Agent")).inc()
-        if handler.get_status() < 300:
+        if handler.get_status() == 304 or getattr(handler, "shared_response", False) is True:
+            # Answered before OAI-PMH processing by a conditional request,
+            # a coalesced request or from the response cache.
+            _METRICS["requests_succeeded"].inc()
+        elif handler.get_status() < 300:
             _METRICS["requests_succeeded"].inc()
             if not handler.oai_protocol.response.context["error"]:
                 # If the response is an oai error, the duration
@@ -0,0 +1,350 @@
+# Copyright CESSDA ERIC 2021-2025
+#
+# Licensed under the EUPL, Version 1.2 (the "License"); you may not
+# use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Serve using multiple pre-forked worker processes.
+
+The listening sockets are bound in the main process, which then forks
+the worker processes. Each worker sets up its own application and
+accepts connections from the shared sockets. The main process
+supervises the workers:
+
+- A worker that exits is replaced by a new one. If a worker exits
+  soon after starting, all workers are stopped and the main process
+  exits with an error.
+- SIGHUP restarts all workers gracefully. New workers are started
+  before the old ones are stopped.
+- SIGTERM and SIGINT stop all workers gracefully and exit.
+
+A worker stops gracefully by closing its listening sockets and
+waiting for in-flight requests to finish, at most for the shutdown
+timeout.
+
+Each worker has an index from 0 to the number of workers minus one,
+which is kept when the worker is replaced or restarted. Work that
+should be done only once, such as refreshing records metrics in
+background, is done in the primary worker with index 0. See
+:func:`is_primary_process`.
+
+Prometheus metrics are shared between workers using a multiprocess
+directory. See :mod:`cdcagg_oai.metrics`. A temporary directory
+created for the metrics is removed when the main process exits.
+"""
+import os
+import sys
+import time
+import shutil
+import signal
+import asyncio
+import logging
+import tempfile
+
+from prometheus_client import multiprocess
+from tornado import httputil
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+
+
+_logger = logging.getLogger(__name__)
+MULTIPROC_DIR_ENV = 'PROMETHEUS_MULTIPROC_DIR'
+# Set to the multiprocess directory if it was created by this module.
+TEMPORARY_MULTIPROC_DIR_ENV = 'CDCAGG_OAI_TEMPORARY_MULTIPROC_DIR'
+# Workers exiting sooner after starting are considered to fail on startup.
+_MIN_WORKER_LIFETIME = 1.0
+_POLL_INTERVAL = 0.2
+# Index of the current worker process. None if not a worker process.
+_WORKER_INDEX = None
+
+
+def ensure_multiprocess_metrics_dir():
+    """Make sure Prometheus metrics are shared between workers.
+
+    prometheus-client reads the multiprocess directory from the
+    environment when it is imported. If the directory is not set, a
+    temporary directory is created and the program is executed again
+    with the environment variable set. This function does not return
+    in that case. The temporary directory is removed by :func:`serve`
+    when the main process exits.
+
+    Call before configuring the application, so that the program is
+    not executed again after configuration has been acted upon.
+    """
+    if MULTIPROC_DIR_ENV in os.environ:
+        return
+    os.environ[MULTIPROC_DIR_ENV] = tempfile.mkdtemp(prefix='cdcagg_oai_metrics_')
+    os.environ[TEMPORARY_MULTIPROC_DIR_ENV] = os.environ[MULTIPROC_DIR_ENV]
+    _logger.info("Using '%s' to share metrics between worker processes", os.environ[MULTIPROC_DIR_ENV])
+    os.execv(sys.executable, [sys.executable, '-m', 'cdcagg_oai'] + sys.argv[1:])
+
+
+def worker_index():
+    """Return index of the current worker process.
+
+    :returns: Index of the worker process or None if not running in a
+              worker process.
+    :rtype: int or None
+    """
+    return _WORKER_INDEX
+
+
+def is_primary_process():
+    """Return True in the primary worker process or when not using workers.
+
+    :rtype: bool
+    """
+    return _WORKER_INDEX in (None, 0)
+
+
+def _remove_temporary_multiprocess_metrics_dir():
+    path = os.environ.get(TEMPORARY_MULTIPROC_DIR_ENV)
+    if path is None or path != os.environ.get(MULTIPROC_DIR_ENV):
+        return
+    _logger.info("Removing '%s'", path)
+    shutil.rmtree(path, ignore_errors=True)
+
+
+class _Supervisor:
+    """Fork and supervise worker processes."""
+
+    def __init__(self, workers):
+        self._workers = workers
+        self._children = {}
+        self._retiring = set()
+        self._stopping = False
+        self._restart_requested = False
+        #: True if workers were stopped because one failed on startup.
+        self.failed = False
+
+    def _on_stop(self, signum, _frame):
+        _logger.info('Received signal %s. Stopping workers.', signum)
+        self._stopping = True
+
+    def _on_restart(self, signum, _frame):
+        _logger.info('Received signal %s. Restarting workers.', signum)
+        self._restart_requested = True
+
+    def _spawn(self, index):
+        global _WORKER_INDEX  # pylint: disable=global-statement
+        pid = os.fork()
+        if pid == 0:
+            for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                signal.signal(signum, signal.SIG_DFL)
+            _WORKER_INDEX = index
+            return True
+        self._children[pid] = (time.monotonic(), index)
+        _logger.info('Started worker process %s with index %s', pid, index)
+        return False
+
+    def _signal_children(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _reap(self):
+        while self._children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+            child = self._children.pop(pid, None)
+            if child is None:
+                continue
+            started, index = child
+            if MULTIPROC_DIR_ENV in os.environ:
+                # Drop live gauge values of the exited worker.
+                multiprocess.mark_process_dead(pid)
+            if pid in self._retiring:
+                self._retiring.discard(pid)
+                continue
+            if os.WIFSIGNALED(status) or os.WEXITSTATUS(status) != 0:
+                _logger.warning('Worker process %s exited unexpectedly with status %s', pid, status)
+            yield time.monotonic() - started, index
+
+    def run(self):
+        """Fork workers and supervise them until stopped.
+
+        If a worker exits within :data:`_MIN_WORKER_LIFETIME` seconds
+        of starting, all workers are stopped and :attr:`failed` is set.
+
+        :returns: True in worker processes, False in the main process
+                  after all workers have exited.
+        :rtype: bool
+        """
+        for index in range(self._workers):
+            if self._spawn(index):
+                return True
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_restart)
+        stopped = False
+        while self._children:
+            if self._stopping and not stopped:
+                self._signal_children(list(self._children), signal.SIGTERM)
+                stopped = True
+            if self._restart_requested and not self._stopping:
+                self._restart_requested = False
+                old_children = set(self._children)
+                for index in range(self._workers):
+                    if self._spawn(index):
+                        return True
+                self._retiring.update(old_children)
+                self._signal_children(old_children, signal.SIGTERM)
+            for lifetime, index in list(self._reap()):
+                if self._stopping:
+                    continue
+                if lifetime < _MIN_WORKER_LIFETIME:
+                    _logger.error('Worker process exited within %s seconds of starting. Stopping workers.',
+                                  _MIN_WORKER_LIFETIME)
+                    self.failed = True
+                    self._stopping = True
+                    continue
+                if self._spawn(index):
+                    return True
+            time.sleep(_POLL_INTERVAL)
+        _logger.info('All worker processes exited')
+        return False
+
+
+class _TrackedConnection(httputil.HTTPConnection):
+    """Connection of a request counted by :class:`_RequestTracker`."""
+
+    def __init__(self, connection, tracker):
+        self._connection = connection
+        self._tracker = tracker
+        self.in_progress = False
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def write_headers(self, start_line, headers, chunk=None):
+        return self._connection.write_headers(start_line, headers, chunk)
+
+    def write(self, chunk):
+        return self._connection.write(chunk)
+
+    def finish(self):
+        self._connection.finish()
+        self._tracker.request_done(self)
+
+
+class _TrackedMessage(httputil.HTTPMessageDelegate):
+    """Request message delegate counted by :class:`_RequestTracker`."""
+
+    def __init__(self, delegate, connection, tracker):
+        self._delegate = delegate
+        self._connection = connection
+        self._tracker = tracker
+
+    def headers_received(self, start_line, headers):
+        self._tracker.request_started(self._connection)
+        return self._delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        return self._delegate.data_received(chunk)
+
+    def finish(self):
+        self._delegate.finish()
+
+    def on_connection_close(self):
+        self._tracker.request_done(self._connection)
+        self._delegate.on_connection_close()
+
+
+class _RequestTracker(httputil.HTTPServerConnectionDelegate):
+    """Count requests in progress for the wrapped application.
+
+    A request is in progress from receiving its headers until its
+    response is finished or its connection is closed.
+
+    :param delegate: Application to serve.
+    """
+
+    def __init__(self, delegate):
+        self._delegate = delegate
+        self.in_progress = 0
+
+    def start_request(self, server_conn, request_conn):
+        connection = _TrackedConnection(request_conn, self)
+        return _TrackedMessage(self._delegate.start_request(server_conn, connection), connection, self)
+
+    def on_close(self, server_conn):
+        self._delegate.on_close(server_conn)
+
+    def request_started(self, connection):
+        connection.in_progress = True
+        self.in_progress += 1
+
+    def request_done(self, connection):
+        if connection.in_progress:
+            connection.in_progress = False
+            self.in_progress -= 1
+
+
+async def _drain(http_server, tracker, shutdown_timeout):
+    """Stop accepting connections and wait for requests to finish.
+
+    Stops the IOLoop when no requests are in progress, or when
+    shutdown_timeout seconds have passed.
+    """
+    _logger.info('Stopping worker process %s', os.getpid())
+    http_server.stop()
+    io_loop = IOLoop.current()
+    deadline = io_loop.time() + shutdown_timeout
+    while tracker.in_progress > 0 and io_loop.time() < deadline:
+        await asyncio.sleep(_POLL_INTERVAL)
+    if tracker.in_progress > 0:
+        _logger.warning('Stopping worker process %s with %s requests in progress',
+                        os.getpid(), tracker.in_progress)
+    io_loop.stop()
+
+
+def _stop_gracefully(http_server, tracker, shutdown_timeout):
+    io_loop = IOLoop.current()
+
+    def _on_signal(_signum, _frame):
+        io_loop.add_callback_from_signal(_drain, http_server, tracker, shutdown_timeout)
+
+    signal.signal(signal.SIGTERM, _on_signal)
+    signal.signal(signal.SIGINT, _on_signal)
+
+
+def serve(app_factory, port, workers, shutdown_timeout):
+    """Serve application using pre-forked worker processes.
+
+    Returns in the main process after all workers have exited and in
+    worker processes after the worker has stopped.
+
+    :param app_factory: Callable returning the Tornado web application.
+                        Called in each worker process.
+    :param int port: Port to listen to.
+    :param int workers: Number of worker processes.
+    :param float shutdown_timeout: Maximum number of seconds to keep
+                                   serving in-flight requests after a
+                                   worker is stopped.
+    :raises RuntimeError: In the main process if workers were stopped
+                          because one failed on startup.
+    """
+    sockets = bind_sockets(port)
+    supervisor = _Supervisor(workers)
+    if not supervisor.run():
+        for sock in sockets:
+            sock.close()
+        _remove_temporary_multiprocess_metrics_dir()
+        if supervisor.failed:
+            raise RuntimeError('Worker process failed on startup')
+        return
+    tracker = _RequestTracker(app_factory())
+    http_server = HTTPServer(tracker)
+    http_server.add_sockets(sockets)
+    _stop_gracefully(http_server, tracker, shutdown_timeout)
+    IOLoop.current().start()
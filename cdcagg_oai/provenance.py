@@ -0,0 +1,91 @@
+# Copyright CESSDA ERIC 2021-2025
+#
+# Licensed under the EUPL, Version 1.2 (the "License"); you may not
+# use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Generate OAI provenance markup for Genshi templates.
+
+Provenance containers are nested, each older ``originDescription``
+inside the newer one. Rendering them with a recursive template function
+is costly, so the markup stream is generated here in a single pass.
+The generated stream is identical to the stream of the template it
+replaces, including whitespace.
+"""
+from genshi.core import (
+    Attrs,
+    QName,
+    START,
+    END,
+    TEXT
+)
+
+
+PROVENANCE_NS = 'http://www.openarchives.org/OAI/2.0/provenance'
+
+_POS = (None, -1, -1)
+_ORIGIN_DESCRIPTION = QName('%s}originDescription' % (PROVENANCE_NS,))
+_HARVEST_DATE = QName('harvestDate')
+_ALTERED = QName('altered')
+_CHILDREN = (
+    (QName('%s}baseURL' % (PROVENANCE_NS,)), 'attr_base_url'),
+    (QName('%s}identifier' % (PROVENANCE_NS,)), 'attr_identifier'),
+    (QName('%s}datestamp' % (PROVENANCE_NS,)), 'attr_datestamp'),
+    (QName('%s}metadataNamespace' % (PROVENANCE_NS,)), 'attr_metadata_namespace'))
+# Whitespace between elements, as it was in the template.
+_INDENT_CONTAINER = '\n    '
+_INDENT_CHILD = '\n      '
+_INDENT_NESTED = '\n        '
+_INDENT_AFTER = '\n  '
+
+
+def _text(value):
+    # Convert like Genshi does for expressions: None is left out.
+    if value is None or isinstance(value, str):
+        return value
+    return str(value)
+
+
+def _start_container(prov):
+    attrs = []
+    harvest_date = _text(prov.get_value())
+    if harvest_date is not None:
+        attrs.append((_HARVEST_DATE, harvest_date))
+    attrs.append((_ALTERED, 'true' if prov.attr_altered.get_value() is True else 'false'))
+    yield START, (_ORIGIN_DESCRIPTION, Attrs(attrs)), _POS
+    for qname, attr in _CHILDREN:
+        yield TEXT, _INDENT_CHILD, _POS
+        yield START, (qname, Attrs()), _POS
+        value = _text(getattr(prov, attr).get_value())
+        if value is not None:
+            yield TEXT, value, _POS
+        yield END, qname, _POS
+    yield TEXT, _INDENT_CHILD, _POS
+
+
+def origin_descriptions(provenance):
+    """Generate markup stream of nested originDescription elements.
+
+    The first provenance container is the outermost element.
+
+    :param provenance: Provenance containers of a record.
+    :type provenance: list
+    :returns: Genshi markup stream events.
+    """
+    for index, prov in enumerate(provenance):
+        if index > 0:
+            yield TEXT, _INDENT_NESTED, _POS
+        yield TEXT, _INDENT_CONTAINER, _POS
+        yield from _start_container(prov)
+    for index in range(len(provenance)):
+        if index > 0:
+            yield TEXT, _INDENT_CHILD, _POS
+        yield TEXT, _INDENT_CONTAINER, _POS
+        yield END, _ORIGIN_DESCRIPTION, _POS
+        yield TEXT, _INDENT_AFTER, _POS
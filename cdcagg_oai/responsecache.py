@@ -0,0 +1,407 @@
+# Copyright CESSDA ERIC 2021-2025
+#
+# Licensed under the EUPL, Version 1.2 (the "License"); you may not
+# use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cache first pages of OAI-PMH list responses.
+
+Responses to ListRecords and ListIdentifiers requests without a
+resumption token are kept in memory and served without querying the
+Document Store or rendering the response. The cache is bounded by the
+number of entries and their total size in bytes. Least recently used
+entries are evicted first, and entries expire after a time-to-live.
+
+All entries are invalidated when the datestamp of the most recently
+updated or deleted record in the Document Store changes. The
+datestamps are looked up at most once per check interval, so changes
+are noticed after a delay of up to the check interval.
+
+The ``responseDate`` of a cached response is rewritten to the time
+it is served from cache. Responses with a resumption token that has an
+``expirationDate`` are not cached, because the token would expire
+sooner than advertised for requests served from cache.
+
+If response compression is enabled, compressed variants of cached
+responses are stored with the entry, so each variant is compressed
+at most once per ``responseDate``.
+
+Responses are cached within each server process.
+"""
+import re
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from kuha_common.query import QueryController
+from cdcagg_common.records import Study
+
+from cdcagg_oai import compression
+from cdcagg_oai.coalescing import request_key
+from cdcagg_oai.metrics import observe_response_cache_lookup
+
+
+_logger = logging.getLogger(__name__)
+_CACHED_VERBS = ('ListRecords', 'ListIdentifiers')
+LOOKUP_HIT = 'hit'
+LOOKUP_MISS = 'miss'
+_RESPONSE_DATE = re.compile(rb'<responseDate>([^<]*)</responseDate>')
+_EXPIRING_RESUMPTION_TOKEN = re.compile(rb'<resumptionToken\s[^>]*expirationDate=')
+
+
+def _response_date():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ').encode('ascii')
+
+
+async def _latest_datestamp(attribute, headers):
+    # pylint: disable=protected-access
+    studies = []
+
+    async def _on_record(study):
+        studies.append(study)
+
+    await QueryController().query_multiple(Study, _on_record, headers=headers,
+                                           fields=[Study._metadata],
+                                           sort_by=getattr(Study._metadata, attribute),
+                                           sort_order=-1, limit=1)
+    if not studies:
+        return None
+    return getattr(studies[0]._metadata, attribute).get_value()
+
+
+class _Entry:
+
+    __slots__ = ('marker', 'expires_at', 'status', 'content_type', 'variants', 'response_date_span')
+
+    def __init__(self, marker, expires_at, status, content_type, body):
+        self.marker = marker
+        self.expires_at = expires_at
+        self.status = status
+        self.content_type = content_type
+        self.variants = {None: body}
+        match = _RESPONSE_DATE.search(body)
+        self.response_date_span = None if match is None else match.span(1)
+
+    @property
+    def size(self):
+        return sum(len(body) for body in self.variants.values())
+
+    @property
+    def response_date(self):
+        if self.response_date_span is None:
+            return None
+        start, end = self.response_date_span
+        return self.variants[None][start:end]
+
+
+class _ResponseCache:
+    """Keep responses in least recently used order."""
+
+    def __init__(self):
+        self.max_entries = 0
+        self.max_bytes = 0
+        self.ttl = 0
+        self.check_interval = 0
+        self.key_includes_url = False
+        self._entries = OrderedDict()
+        self._size = 0
+        self._marker = None
+        self._checked_at = None
+        self._checking = None
+
+    def configure(self, max_entries, max_bytes, ttl, check_interval, key_includes_url):
+        """Configure cache budgets and expiration.
+
+        :param int max_entries: Maximum number of cached responses.
+                                Zero disables the cache.
+        :param int max_bytes: Maximum total size of cached responses in bytes.
+        :param float ttl: Seconds to keep responses.
+        :param float check_interval: Seconds between Document Store
+                                     datestamp lookups.
+        :param bool key_includes_url: True if requests with different
+                                      URLs get different responses.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.key_includes_url = key_includes_url
+        self.clear()
+
+    @property
+    def enabled(self):
+        """True if responses are cached."""
+        return self.max_entries > 0 and self.max_bytes > 0
+
+    def clear(self):
+        """Remove all entries."""
+        self._entries.clear()
+        self._size = 0
+        self._marker = None
+        self._checked_at = None
+
+    async def _check(self, headers):
+        marker = tuple(await asyncio.gather(_latest_datestamp('attr_updated', headers),
+                                            _latest_datestamp('attr_deleted', headers)))
+        if marker != self._marker:
+            self._entries.clear()
+            self._size = 0
+            self._marker = marker
+        self._checked_at = time.monotonic()
+        return marker
+
+    async def marker(self, headers=None):
+        """Return datestamps of the latest changes in Document Store.
+
+        The datestamps are looked up if they are older than the check
+        interval. Entries cached with other datestamps are removed.
+        Concurrent lookups share a single Document Store query.
+
+        :param dict or None headers: Headers for DocStore requests.
+        :rtype: tuple
+        """
+        if self._checked_at is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return self._marker
+        if self._checking is None:
+            self._checking = asyncio.ensure_future(self._check(headers))
+            self._checking.add_done_callback(self._on_checked)
+        return await asyncio.shield(self._checking)
+
+    def _on_checked(self, _future):
+        self._checking = None
+
+    def get(self, key, marker):
+        """Return cached entry or None.
+
+        :param tuple key: Request key.
+        :param tuple marker: Current Document Store datestamps.
+        :rtype: :obj:`_Entry` or None
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.marker != marker or entry.expires_at <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, marker, status, content_type, body):
+        """Cache response.
+
+        Responses with an expiring resumption token are not cached.
+
+        :param tuple key: Request key.
+        :param tuple marker: Document Store datestamps looked up before
+                             the response was created.
+        :param int status: HTTP status code.
+        :param str content_type: Value of Content-Type header.
+        :param bytes body: Response body.
+        """
+        if marker != self._marker or len(body) > self.max_bytes or _EXPIRING_RESUMPTION_TOKEN.search(body):
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = _Entry(marker, time.monotonic() + self.ttl, status, content_type, body)
+        self._size += len(body)
+        self._evict()
+
+    def add_variant(self, key, entry, encoding, body):
+        """Store compressed variant of cached response.
+
+        :param tuple key: Request key.
+        :param entry: Cached entry.
+        :type entry: :obj:`_Entry`
+        :param str encoding: Content encoding of variant.
+        :param bytes body: Compressed response body.
+        """
+        if self._entries.get(key) is not entry:
+            return
+        entry.variants[encoding] = body
+        self._size += len(body)
+        self._evict()
+
+    def set_response_date(self, key, entry, response_date):
+        """Rewrite responseDate of cached response.
+
+        Compressed variants containing the previous responseDate are
+        removed.
+
+        :param tuple key: Request key.
+        :param entry: Cached entry.
+        :type entry: :obj:`_Entry`
+        :param bytes response_date: New responseDate.
+        """
+        if self._entries.get(key) is not entry or entry.response_date_span is None:
+            return
+        self._size -= entry.size
+        start, end = entry.response_date_span
+        body = entry.variants[None]
+        entry.variants = {None: body[:start] + response_date + body[end:]}
+        entry.response_date_span = (start, start + len(response_date))
+        self._size += entry.size
+
+    def _remove(self, key):
+        self._size -= self._entries.pop(key).size
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._size > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+
+
+_CACHE = _ResponseCache()
+
+
+class _ResponseCacheMixin:
+    """Serve first pages of list responses from cache.
+
+    Mixed in to OAI route handler class by :func:`handler_class`.
+    """
+
+    #: True if the response was served from cache.
+    shared_response = False
+    _cache_key = None
+    _cache_marker = None
+    _cache_recorded = None
+
+    def _is_cacheable(self):
+        if self.request.method != 'GET' or 'resumptionToken' in self.request.query_arguments:
+            return False
+        verbs = self.get_query_arguments('verb')
+        return len(verbs) == 1 and verbs[0] in _CACHED_VERBS
+
+    def _respond_from_cache(self, entry):
+        response_date = _response_date()
+        if entry.response_date not in (None, response_date):
+            _CACHE.set_response_date(self._cache_key, entry, response_date)
+        encoding = None
+        if compression.is_enabled():
+            encoding = compression.response_encoding(self.request.headers.get('Accept-Encoding', ''),
+                                                     entry.content_type or '', len(entry.variants[None]))
+        body = entry.variants.get(encoding)
+        if body is None:
+            body = compression.compress(entry.variants[None], encoding)
+            _CACHE.add_variant(self._cache_key, entry, encoding, body)
+        self.shared_response = True
+        self.set_status(entry.status)
+        if entry.content_type is not None:
+            self.set_header('Content-Type', entry.content_type)
+        if encoding is not None:
+            self.set_header('Content-Encoding', encoding)
+        self.finish(body)
+
+    async def prepare(self):
+        """Respond from cache or continue processing the request.
+
+        Responses of cacheable requests are recorded and cached when
+        the request finishes.
+        """
+        if self._is_cacheable():
+            try:
+                marker = await _CACHE.marker(headers=self._correlation_id.as_header())
+            except Exception:  # pylint: disable=broad-except
+                _logger.exception('Unable to look up latest datestamps. Not using response cache.')
+            else:
+                key = await request_key(self.request, _CACHE.key_includes_url)
+                entry = _CACHE.get(key, marker)
+                observe_response_cache_lookup(LOOKUP_MISS if entry is None else LOOKUP_HIT)
+                self._cache_key = key
+                if entry is not None:
+                    self._respond_from_cache(entry)
+                    return
+                self._cache_marker = marker
+                self._cache_recorded = []
+        result = super().prepare()
+        if result is not None:
+            await result
+
+    def flush(self, include_footers=False):
+        """Record response body before flushing it.
+
+        :param bool include_footers: Passed to
+                                     :meth:`tornado.web.RequestHandler.flush`
+        """
+        if self._cache_recorded is not None:
+            self._cache_recorded.extend(self._write_buffer)
+        return super().flush(include_footers=include_footers)
+
+    def on_finish(self):
+        """Cache recorded response."""
+        if self._cache_recorded is not None:
+            if self.get_status() == 200:
+                _CACHE.put(self._cache_key, self._cache_marker, self.get_status(),
+                           self._headers.get('Content-Type'), b''.join(self._cache_recorded))
+            self._cache_recorded = None
+        super().on_finish()
+
+
+def handler_class(oai_route_handler_class):
+    """Return OAI route handler class serving responses from cache.
+
+    :param oai_route_handler_class: Handler responsible for OAI-PMH requests.
+    :returns: Subclass of oai_route_handler_class.
+    """
+    return type('Cached' + oai_route_handler_class.__name__,
+                (_ResponseCacheMixin, oai_route_handler_class), {})
+
+
+def is_enabled():
+    """Return True if responses are cached.
+
+    :rtype: bool
+    """
+    return _CACHE.enabled
+
+
+def add_cli_args(parser):
+    """Add command line arguments to argument parser.
+
+    :param parser: Argument parser.
+    :type parser: :obj:`configargparse.ArgumentParser`
+    """
+    parser.add('--oai-pmh-response-cache-size',
+               help='Number of first pages of ListRecords and ListIdentifiers responses to keep '
+               'in memory. Pages with a resumption token that has an expirationDate are not cached. '
+               'Set to 0 to disable the response cache.',
+               default=0,
+               env_var='OPRH_OP_RESPONSE_CACHE_SIZE',
+               type=int)
+    parser.add('--oai-pmh-response-cache-max-bytes',
+               help='Maximum total size of cached responses in bytes, including compressed variants.',
+               default=64 * 1024 * 1024,
+               env_var='OPRH_OP_RESPONSE_CACHE_MAX_BYTES',
+               type=int)
+    parser.add('--oai-pmh-response-cache-ttl',
+               help='Seconds to keep cached responses. The responseDate of cached responses is '
+               'rewritten when they are served.',
+               default=300,
+               env_var='OPRH_OP_RESPONSE_CACHE_TTL',
+               type=float)
+    parser.add('--oai-pmh-response-cache-check-interval',
+               help='Seconds between Document Store lookups of the latest record datestamps. '
+               'Cached responses are invalidated when the datestamps change. Each lookup makes two '
+               'Document Store queries in each worker process.',
+               default=10,
+               env_var='OPRH_OP_RESPONSE_CACHE_CHECK_INTERVAL',
+               type=float)
+
+
+def configure(settings):
+    """Configure response cache with loaded settings.
+
+    :param settings: Loaded settings.
+    :type settings: :obj:`argparse.Namespace`
+    """
+    _CACHE.configure(settings.oai_pmh_response_cache_size,
+                     settings.oai_pmh_response_cache_max_bytes,
+                     settings.oai_pmh_response_cache_ttl,
+                     settings.oai_pmh_response_cache_check_interval,
+                     settings.oai_pmh_respond_with_requested_url)
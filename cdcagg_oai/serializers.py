@@ -0,0 +1,606 @@
+# Copyright CESSDA ERIC 2021-2025
+#
+# Licensed under the EUPL, Version 1.2 (the "License"); you may not
+# use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Serialize record metadata without Genshi template processing.
+
+Used by the ``compiled`` serializer engine. The functions in this
+module write the contents of a metadata root element directly to
+markup, which is passed through Genshi as a single text event. This
+skips evaluating template directives and serializing each element
+event by event. Only the root element of the metadata is left for
+Genshi, so that namespace declarations get handled as before.
+
+The written markup is the same that Genshi outputs for the
+corresponding templates ``agg_oai_dc.xml`` and ``agg_oai_datacite.xml``.
+Template values are expected to be strings, numbers or None.
+"""
+import os
+import re
+import asyncio
+import sys
+import marshal
+import hashlib
+import logging
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
+from genshi.core import (
+    Attrs,
+    Markup,
+    QName,
+    START,
+    END,
+    TEXT,
+    XML_NAMESPACE,
+    escape
+)
+
+from cdcagg_oai.metrics import observe_fragment_cache_lookup
+
+
+_logger = logging.getLogger(__name__)
+SERIALIZER_ENGINE_GENSHI = 'genshi'
+SERIALIZER_ENGINE_COMPILED = 'compiled'
+SERIALIZER_ENGINES = (SERIALIZER_ENGINE_GENSHI, SERIALIZER_ENGINE_COMPILED)
+
+_POS = (None, -1, -1)
+# Genshi strips whitespace of text events, but leaves attribute values
+# as is. Attribute values matching this are passed as element events
+# to keep them out of the stripped text.
+_strippable_whitespace = re.compile('[ \t]\n|\n\n').search
+
+
+def _text(value):
+    # Convert like Genshi does for expressions. None is left out.
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)):
+        return Markup(value)
+    return str(value)
+
+
+class _MarkupWriter:
+    """Write markup for Genshi stream.
+
+    :param dict namespaces: Namespace URIs keyed by prefix used in tags.
+    """
+
+    def __init__(self, namespaces):
+        self._namespaces = dict(namespaces, xml=XML_NAMESPACE.uri)
+        self._buf = []
+        self._events = []
+
+    def _qname(self, name, default_namespace=True):
+        prefix, _, localname = name.rpartition(':')
+        if prefix == '' and not default_namespace:
+            return QName(name)
+        return QName('%s}%s' % (self._namespaces[prefix], localname))
+
+    def _flush(self):
+        if self._buf:
+            self._events.append((TEXT, Markup(''.join(self._buf)), _POS))
+            self._buf = []
+
+    def text(self, markup):
+        """Write markup as is.
+
+        :param str markup: Markup to write.
+        """
+        self._buf.append(markup)
+
+    def start(self, tag, *attrs):
+        """Write start tag with constant attributes.
+
+        :param str tag: Tag name.
+        :param attrs: Attribute (name, value) pairs.
+        """
+        self._buf.append('<%s%s>' % (tag, ''.join(' %s="%s"' % (name, escape(value)) for name, value in attrs)))
+
+    def end(self, tag):
+        """Write end tag.
+
+        :param str tag: Tag name.
+        """
+        self._buf.append('</%s>' % (tag,))
+
+    def element(self, tag, value, *attrs):
+        """Write element with text content and attributes.
+
+        Attributes and content with None value are left out.
+        Element without content is written as an empty element.
+
+        :param str tag: Tag name.
+        :param value: Text content.
+        :param attrs: Attribute (name, value) pairs.
+        """
+        value = _text(value)
+        attrs = [(name, _text(attr_value)) for name, attr_value in attrs if attr_value is not None]
+        if any(_strippable_whitespace(attr_value) for _, attr_value in attrs):
+            self._flush()
+            qname = self._qname(tag)
+            self._events.append((START, (qname, Attrs([(self._qname(name, default_namespace=False), attr_value)
+                                                       for name, attr_value in attrs])), _POS))
+            if value is not None:
+                self._events.append((TEXT, value, _POS))
+            self._events.append((END, qname, _POS))
+            return
+        buf = self._buf
+        buf.append('<')
+        buf.append(tag)
+        for name, attr_value in attrs:
+            buf.append(' %s="%s"' % (name, escape(attr_value)))
+        if value is None:
+            buf.append('/>')
+        else:
+            buf.append('>%s</%s>' % (escape(value, quotes=False), tag))
+
+    def events(self):
+        """Return written markup as Genshi stream events.
+
+        :returns: Genshi stream events.
+        :rtype: list
+        """
+        self._flush()
+        return self._events
+
+
+_OAI_DC_NAMESPACES = {'dc': 'http://purl.org/dc/elements/1.1/'}
+_DATACITE_NAMESPACES = {'': 'http://datacite.org/schema/kernel-3'}
+
+
+def _write_oai_dc(record):
+    study = record.study
+    writer = _MarkupWriter(_OAI_DC_NAMESPACES)
+    element, text = writer.element, writer.text
+    text('\n\n  ')
+    for identifier in set([id_.get_value() for id_ in study.identifiers]):
+        element('dc:identifier', identifier)
+    text('\n  ')
+    for distinct_uri in set([uri.get_value() for uri in chain(study.document_uris, study.study_uris)]):
+        element('dc:identifier', distinct_uri)
+    text('\n\n  ')
+    for title in study.study_titles:
+        element('dc:title', title.get_value(), ('xml:lang', title.get_language()))
+    text('\n\n  ')
+    for principal_investigator in study.principal_investigators:
+        element('dc:creator', principal_investigator.get_value(),
+                ('xml:lang', principal_investigator.get_language()))
+    text('\n\n  ')
+    for publisher in study.publishers:
+        element('dc:publisher', publisher.get_value(), ('xml:lang', publisher.get_language()))
+    text('\n\n  ')
+    for abstr in study.abstract:
+        element('dc:description', abstr.get_value(), ('xml:lang', abstr.get_language()))
+    text('\n\n  ')
+    for keyword in study.keywords:
+        subject_value = keyword.attr_description.get_value() if keyword.attr_description.get_value() \
+            else keyword.get_value()
+        element('dc:subject', subject_value, ('xml:lang', keyword.get_language()))
+    text('\n\n  ')
+    for language in set([v.get_language() for v in study.study_titles]):
+        element('dc:language', language)
+    text('\n\n  ')
+    for publication_year in study.publication_years:
+        date = publication_year.get_value() if publication_year.get_value() \
+            else publication_year.attr_distribution_date.get_value()
+        element('dc:date', date, ('xml:lang', publication_year.get_language()))
+    text('\n\n  ')
+    element('dc:type', 'Dataset', ('xml:lang', 'en'))
+    text('\n\n  ')
+    for copyright_ in study.data_collection_copyrights:
+        element('dc:rights', copyright_.get_value(), ('xml:lang', copyright_.get_language()))
+    text('\n\n  ')
+    for country in study.study_area_countries:
+        element('dc:coverage', country.get_value(), ('xml:lang', country.get_language()))
+    text('\n\n')
+    return writer.events()
+
+
+def _write_oai_datacite(record):
+    study = record.study
+    pref_id = record.preferred_identifier
+    publ_year = record.publication_year
+    publisher_lang_val = record.publisher_lang_val
+    funders = record.funders
+    writer = _MarkupWriter(_DATACITE_NAMESPACES)
+    element, text, start, end = writer.element, writer.text, writer.start, writer.end
+    text('\n  ')
+    element('identifier', pref_id[1], ('identifierType', pref_id[0]))
+    text('\n  ')
+    start('creators')
+    text('\n    ')
+    for pi in study.principal_investigators:
+        start('creator')
+        text('\n      ')
+        element('creatorName', pi.get_value())
+        text('\n      ')
+        element('affiliation', pi.attr_organization.get_value(), ('xml:lang', pi.get_language()))
+        text('\n    ')
+        end('creator')
+    text('\n  ')
+    end('creators')
+    text('\n  ')
+    start('titles')
+    text('\n    ')
+    for title in study.study_titles:
+        element('title', title.get_value(), ('xml:lang', title.get_language()))
+    text('\n  ')
+    end('titles')
+    text('\n  ')
+    if publisher_lang_val != ():
+        element('publisher', publisher_lang_val[1])
+    text('\n  ')
+    if publ_year:
+        element('publicationYear', publ_year)
+    text('\n  ')
+    start('subjects')
+    text('\n    ')
+    for subject in chain(study.keywords, study.classifications):
+        element('subject', subject.attr_description.get_value(),
+                ('xml:lang', subject.get_language()),
+                ('subjectScheme', subject.attr_system_name.get_value()),
+                ('schemeURI', subject.attr_uri.get_value()))
+    text('\n  ')
+    end('subjects')
+    text('\n  ')
+    if funders != []:
+        start('contributors')
+        text('\n    ')
+        for _, nameid, agency in funders:
+            start('contributor', ('contributorType', 'Funder'))
+            text('\n      ')
+            element('contributorName', agency)
+            text('\n      ')
+            element('nameIdentifier', nameid, ('nameIdentifierScheme', 'info'))
+            text('\n    ')
+            end('contributor')
+        text('\n  ')
+        end('contributors')
+    text('\n  ')
+    start('dates')
+    text('\n    ')
+    for pub_year in study.publication_years:
+        date = pub_year.attr_distribution_date.get_value()
+        text('\n      ')
+        if date:
+            element('date', date, ('dateType', 'Issued'))
+        text('\n    ')
+    text('\n  ')
+    end('dates')
+    text('\n  ')
+    element('resourceType', 'Dataset', ('resourceTypeGeneral', 'Dataset'))
+    text('\n  ')
+    start('relatedIdentifiers')
+    text('\n    ')
+    for _type, _id in record.related_identifier_types_ids:
+        element('relatedIdentifier', _id, ('relationType', 'IsCitedBy'), ('relatedIdentifierType', _type))
+    text('\n  ')
+    end('relatedIdentifiers')
+    text('\n  ')
+    start('rightsList')
+    text('\n    ')
+    for accs in study.data_access:
+        element('rights', accs.get_value())
+    text('\n  ')
+    end('rightsList')
+    text('\n  ')
+    start('descriptions')
+    text('\n    ')
+    for abstract in study.abstract:
+        element('description', abstract.get_value(), ('descriptionType', 'Abstract'),
+                ('xml:lang', abstract.get_language()))
+    text('\n  ')
+    end('descriptions')
+    text('\n  ')
+    start('geoLocations')
+    text('\n    ')
+    for cov in study.geographic_coverages:
+        start('geoLocation')
+        text('\n      ')
+        element('geoLocationPlace', cov.get_value(), ('xml:lang', cov.get_language()))
+        text('\n    ')
+        end('geoLocation')
+    text('\n  ')
+    end('geoLocations')
+    text('\n')
+    return writer.events()
+
+
+def _write_fragment_file(path, contents):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file_obj:
+            marshal.dump(contents, file_obj)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class _FragmentCache:
+    """Bounded LRU cache of serialized record metadata.
+
+    Entries are keyed by record's aggregator identifier, metadata prefix
+    and the time the record was last updated, so that updated records
+    miss the cache. Caching is disabled if max_entries is not positive.
+
+    If directory is given, entries evicted from memory are written
+    to disk in a background thread. Entries on disk are read back to
+    memory by :meth:`load` before the record gets rendered, so that
+    rendering never waits for disk. There is a single file per
+    identifier and metadata prefix, which gets replaced when the record
+    is updated. The oldest files are removed when there are more than
+    max_files of them.
+    """
+
+    # Increase when the written markup changes, so that fragments on disk
+    # written by previous versions are not used.
+    FORMAT_VERSION = 1
+    # Share of max_files kept when pruning, so that pruning does not run
+    # on every write.
+    PRUNE_TO = 0.9
+
+    def __init__(self):
+        self.max_entries = 0
+        self.directory = None
+        self.max_files = 0
+        # Maps key to (events, on_disk).
+        self._entries = OrderedDict()
+        # Keys loaded from disk and not looked up since.
+        self._loaded = set()
+        self._file_count = None
+        self._executor = None
+
+    def configure(self, max_entries, directory=None, max_files=0):
+        """Configure cache and drop cached entries from memory.
+
+        :param int max_entries: Maximum number of entries kept in memory.
+        :param str or None directory: Directory to spill evicted entries to.
+        :param int max_files: Maximum number of files kept in directory.
+                              Zero for no limit.
+        """
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_files = max_files
+        self._entries.clear()
+        self._loaded.clear()
+        self._file_count = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            # Created on first use, so that worker processes forked after
+            # configuration get their own thread.
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cdcagg-oai-fragment-cache')
+        return self._executor
+
+    def _path(self, identifier, prefix):
+        name = hashlib.sha256(('%s\n%s' % (prefix, identifier)).encode('utf8')).hexdigest()
+        return os.path.join(self.directory, '%s.%s.%s.marshal' % (
+            name, self.FORMAT_VERSION, sys.implementation.cache_tag))
+
+    def _read(self, identifier, prefix, updated):
+        path = self._path(identifier, prefix)
+        try:
+            with open(path, 'rb') as file_obj:
+                stored_updated, markup = marshal.load(file_obj)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError, TypeError):
+            _logger.warning("Unable to read fragment cache file '%s'", path, exc_info=True)
+            return None
+        if stored_updated != updated:
+            return None
+        return [(TEXT, Markup(markup), _POS)]
+
+    def _write(self, identifier, prefix, updated, markup):
+        path = self._path(identifier, prefix)
+        try:
+            _write_fragment_file(path, (updated, markup))
+        except (OSError, ValueError):
+            _logger.warning("Unable to write fragment cache file '%s'", path, exc_info=True)
+            return
+        if self.max_files <= 0:
+            return
+        if self._file_count is None:
+            self._file_count = len(self._list_files())
+        else:
+            # Replaced files are counted again. This only makes pruning
+            # run early, which recounts the files.
+            self._file_count += 1
+        if self._file_count > self.max_files:
+            self._prune()
+
+    def _list_files(self):
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.marshal'):
+                    continue
+                try:
+                    files.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    # Removed by another process.
+                    continue
+        return files
+
+    def _prune(self):
+        try:
+            files = sorted(self._list_files())
+        except OSError:
+            _logger.warning("Unable to list fragment cache directory '%s'", self.directory, exc_info=True)
+            return
+        keep = int(self.max_files * self.PRUNE_TO)
+        for _, path in files[:max(0, len(files) - keep)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            except OSError:
+                _logger.warning("Unable to remove fragment cache file '%s'", path, exc_info=True)
+        self._file_count = min(len(files), keep)
+
+    def _spill(self, key, entry):
+        self._loaded.discard(key)
+        events, on_disk = entry
+        # Only plain markup is written to disk.
+        if self.directory is None or on_disk or len(events) != 1 or events[0][0] is not TEXT:
+            return
+        identifier, prefix, updated = key
+        self._get_executor().submit(self._write, identifier, prefix, updated, str(events[0][1]))
+
+    def _add(self, key, events, on_disk=False):
+        self._entries[key] = (events, on_disk)
+        while len(self._entries) > self.max_entries:
+            self._spill(*self._entries.popitem(last=False))
+
+    @staticmethod
+    def _key(prefix, study):
+        identifier = study._aggregator_identifier.get_value()
+        updated = study._metadata.attr_updated.get_value()
+        if identifier is None or updated is None:
+            return None
+        return (identifier, prefix, str(updated))
+
+    async def load(self, prefix, study):
+        """Read cached events of study from disk to memory.
+
+        Reading is done in the background thread. Does nothing if the
+        entry is already in memory or there is no directory.
+
+        :param str prefix: Metadata prefix.
+        :param study: Study record.
+        """
+        if self.max_entries <= 0 or self.directory is None:
+            return
+        key = self._key(prefix, study)
+        if key is None or key in self._entries:
+            return
+        events = await asyncio.get_running_loop().run_in_executor(self._get_executor(), self._read, *key)
+        if events is None or key in self._entries:
+            return
+        self._loaded.add(key)
+        self._add(key, events, on_disk=True)
+
+    def get_or_write(self, prefix, record, write_func):
+        """Return cached events for record or write and cache them.
+
+        Looks up entries from memory only. See :meth:`load`.
+
+        :param str prefix: Metadata prefix.
+        :param record: Record in template context.
+        :param write_func: Function writing record metadata.
+        :returns: Genshi stream events.
+        :rtype: list
+        """
+        if self.max_entries <= 0:
+            return write_func(record)
+        key = self._key(prefix, record.study)
+        if key is None:
+            return write_func(record)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            if key in self._loaded:
+                self._loaded.discard(key)
+                observe_fragment_cache_lookup('disk_hit')
+            else:
+                observe_fragment_cache_lookup('hit')
+            return entry[0]
+        observe_fragment_cache_lookup('miss')
+        events = write_func(record)
+        self._add(key, events)
+        return events
+
+
+_FRAGMENT_CACHE = _FragmentCache()
+# Metadata prefixes of the formats using the fragment cache.
+_FRAGMENT_CACHE_PREFIXES = ('oai_dc', 'oai_datacite')
+
+
+def configure_fragment_cache(max_entries, directory=None, max_files=0):
+    """Configure cache of serialized record metadata.
+
+    :param int max_entries: Maximum number of entries kept in memory.
+                            Zero disables caching.
+    :param str or None directory: Directory to spill evicted entries to.
+    :param int max_files: Maximum number of files kept in directory.
+                          Zero for no limit.
+    """
+    _FRAGMENT_CACHE.configure(max_entries, directory, max_files)
+
+
+async def load_fragment(prefix, study):
+    """Read serialized metadata of study from disk before rendering it.
+
+    Call for each record added to the response. Does nothing unless the
+    compiled serializer engine caches metadata of prefix on disk.
+    OAI-DDI25 metadata is rendered by Genshi and is not cached.
+
+    :param str prefix: Metadata prefix.
+    :param study: Study record.
+    """
+    if _engine == SERIALIZER_ENGINE_COMPILED and prefix in _FRAGMENT_CACHE_PREFIXES:
+        await _FRAGMENT_CACHE.load(prefix, study)
+
+
+def oai_dc_content(record):
+    """Return contents of oai_dc:dc element of record.
+
+    :param record: Record in template context.
+    :returns: Genshi stream events.
+    :rtype: list
+    """
+    return _FRAGMENT_CACHE.get_or_write('oai_dc', record, _write_oai_dc)
+
+
+def oai_datacite_content(record):
+    """Return contents of resource element of record.
+
+    :param record: Record in template context.
+    :returns: Genshi stream events.
+    :rtype: list
+    """
+    return _FRAGMENT_CACHE.get_or_write('oai_datacite', record, _write_oai_datacite)
+
+
+_COMPILED_SUBTEMPLATES = {'agg_oai_dc.xml': 'agg_oai_dc_compiled.xml',
+                          'agg_oai_datacite.xml': 'agg_oai_datacite_compiled.xml'}
+_engine = SERIALIZER_ENGINE_GENSHI
+
+
+def set_engine(engine):
+    """Set serializer engine used for record metadata.
+
+    :param str engine: One of :data:`SERIALIZER_ENGINES`.
+    :raises: :exc:`ValueError` for unknown engine.
+    """
+    global _engine  # pylint: disable=global-statement
+    if engine not in SERIALIZER_ENGINES:
+        raise ValueError("Unknown serializer engine '%s'" % (engine,))
+    _engine = engine
+
+
+def subtemplate(name):
+    """Return metadata subtemplate to use with configured serializer engine.
+
+    Subtemplates without a compiled counterpart are always rendered
+    by Genshi.
+
+    :param str name: Subtemplate declared by metadataformat.
+    :returns: Subtemplate to include.
+    :rtype: str
+    """
+    if _engine == SERIALIZER_ENGINE_COMPILED:
+        return _COMPILED_SUBTEMPLATES.get(name, name)
+    return name
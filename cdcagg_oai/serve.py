@@ -16,6 +16,7 @@ Handle command line arguments, application setup, discovery & load of plugins,
 server startup and critical exception logging.
 """
 import logging
+from functools import partial
 from tornado.httputil import HTTPServerRequest
 from py12flogging.log_formatter import (
     set_ctx_populator,
@@ -33,7 +34,17 @@ from kuha_oai_pmh_repo_handler import (
 )
 from kuha_oai_pmh_repo_handler.serve import load_metadataformats
 
-from cdcagg_oai import metrics
+from cdcagg_oai import (
+    admission,
+    coalescing,
+    compression,
+    conditional,
+    loadshed,
+    metadataformats,
+    metrics,
+    prefork,
+    responsecache
+)
 
 
 _logger = logging.getLogger(__name__)
@@ -44,6 +55,8 @@ def configure(mdformats):
 
     Define configuration options. Load settings.
     Configure metadataformats. Setup logging.
+    If more than one worker is configured, make sure metrics
+    are shared between workers before configuring modules.
     Return loaded settings.
 
     :param list mdformats: Loaded metadataformats.
@@ -55,19 +68,43 @@ def configure(mdformats):
              default='v0', type=str, env_var='OAIPMH_API_VERSION')
     conf.add('--port', help='Port to listen to', type=int, env_var='OAIPMH_PORT',
              default=6003)
+    conf.add('--workers', help='Number of worker processes serving requests. Workers share '
+             'the listening port. Set to 1 to serve in a single process.',
+             type=int, env_var='OAIPMH_WORKERS', default=1)
+    conf.add('--workers-shutdown-timeout', help='Maximum number of seconds to keep serving '
+             'in-flight requests when a worker process is stopped or restarted.',
+             type=float, env_var='OAIPMH_WORKERS_SHUTDOWN_TIMEOUT', default=10)
     conf.add_print_arg()
     conf.add_config_arg()
     conf.add_loglevel_arg()
     server.add_cli_args()
     controller.add_cli_args()
+    metrics.add_cli_args(conf)
+    metadataformats.add_cli_args(conf)
+    compression.add_cli_args(conf)
+    conditional.add_cli_args(conf)
+    admission.add_cli_args(conf)
+    loadshed.add_cli_args(conf)
+    coalescing.add_cli_args(conf)
+    responsecache.add_cli_args(conf)
     for mdformat in mdformats:
         mdformat.add_cli_args(conf)
     settings = conf.get_conf()
     set_ctx_populator(server.serverlog_ctx_populator)
     setup_app_logging(conf.get_package(), loglevel=settings.loglevel, port=settings.port)
+    if settings.workers > 1 and not settings.print_configuration:
+        prefork.ensure_multiprocess_metrics_dir()
+    metadataformats.configure(settings)
     for mdformat in mdformats:
         mdformat.configure(settings)
     server.configure(settings)
+    metrics.configure(settings)
+    compression.configure(settings)
+    conditional.configure(settings)
+    admission.configure(settings)
+    loadshed.configure(settings)
+    coalescing.configure(settings)
+    responsecache.configure(settings)
     return settings
 
 
@@ -81,19 +118,52 @@ def app_setup(settings, mdformats):
     ctrl = controller.from_settings(settings, mdformats)
     app = http_api.get_app(settings.api_version, controller=ctrl, app_class=metrics.CDCAggWebApp)
     # Dynamically resolve handler for oai requests
-    app.set_oai_route_handler_class(app.find_handler(
-        HTTPServerRequest('GET', f'/{settings.api_version}/oai')).handler_class)
+    oai_route = app.find_handler(HTTPServerRequest('GET', f'/{settings.api_version}/oai'))
+    app.set_oai_route_handler_class(oai_route.handler_class)
     app.add_handlers('.*', [('/metrics', metrics.CDCAggMetricsHandler)])
+    oai_route_handler_class = oai_route.handler_class
+    if conditional.is_enabled():
+        oai_route_handler_class = conditional.handler_class(oai_route_handler_class, mdformats)
+    if coalescing.is_enabled():
+        # Conditional requests are answered before they are coalesced.
+        oai_route_handler_class = coalescing.handler_class(oai_route_handler_class)
+    if admission.is_enabled():
+        # Admission control wraps the others to limit all OAI-PMH processing.
+        oai_route_handler_class = admission.handler_class(oai_route_handler_class)
+    if responsecache.is_enabled():
+        # Cached responses are served without waiting for admission.
+        oai_route_handler_class = responsecache.handler_class(oai_route_handler_class)
+    if loadshed.is_enabled():
+        # Overloaded servers reject requests before they are queued.
+        oai_route_handler_class = loadshed.handler_class(oai_route_handler_class)
+    if oai_route_handler_class is not oai_route.handler_class:
+        # Handlers added later take precedence over the ones given to get_app.
+        app.add_handlers('.*', [(oai_route.request.path, oai_route_handler_class, oai_route.handler_kwargs)])
+    if compression.is_enabled():
+        app.add_transform(compression.CompressionTransform)
+    loadshed.start_lag_monitor()
+    if prefork.is_primary_process():
+        metrics.start_refresh()
     return app
 
 
+def _setup_app(settings, mdformats):
+    try:
+        return app_setup(settings, mdformats)
+    except Exception:
+        _logger.exception('Exception in application setup')
+        raise
+
+
 def main():
     """Starts the server.
 
     Load metadataformats using entrypoint discovery group
     `cdcagg.oai.metadataformats`. Call :func:`configure` to
     define, load and setup configurations. Initiate controller
-    and start server.
+    and start server. If more than one worker is configured,
+    serve using pre-forked worker processes, each setting up its
+    own controller.
     """
     mdformats = load_metadataformats('cdcagg.oai.metadataformats')
     settings = configure(mdformats)
@@ -101,13 +171,13 @@ def main():
         print('Print active configuration and exit\n')
         conf.print_conf()
         return
+    if settings.workers > 1:
+        serve_func = partial(prefork.serve, partial(_setup_app, settings, mdformats), settings.port,
+                             settings.workers, settings.workers_shutdown_timeout)
+    else:
+        serve_func = partial(server.serve, _setup_app(settings, mdformats), settings.port)
     try:
-        app = app_setup(settings, mdformats)
-    except Exception:
-        _logger.exception('Exception in application setup')
-        raise
-    try:
-        server.serve(app, settings.port)
+        serve_func()
     except KeyboardInterrupt:
         _logger.warning('Shutdown by CTRL + C', exc_info=True)
     except Exception:
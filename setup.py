@@ -41,6 +41,7 @@ setup(name='cdcagg_oai',
       packages=find_packages(exclude=['tests']),
       include_package_data=True,
       install_requires=requires,
+      extras_require={'brotli': ['Brotli']},
       entry_points={
         'cdcagg.oai.metadataformats': [
             'AggOAIDDI25MetadataFormat = cdcagg_oai.metadataformats:AggOAIDDI25MetadataFormat',
@@ -106,6 +106,8 @@ class CDCAggOAIHTTPTestBase(testcasebase(AsyncHTTPTestCase)):
                                                  os.path.join(
                                                      os.path.dirname(os.path.realpath(__file__)),
                                                      'data', 'configurable_sets.yaml'))),
+            oai_set_configurable_reload_interval=kw.get('oai_set_configurable_reload_interval', 0),
+            oai_set_configurable_cache_dir=kw.get('oai_set_configurable_cache_dir', None),
             oai_pmh_namespace_identifier=kw.get('oai_pmh_namespace_identifier',
                                                 OAI_REC_NAMESPACE_IDENTIFIER),
             oai_pmh_deleted_records=kw.get('oai_pmh_deleted_records',
@@ -0,0 +1,151 @@
+# Copyright CESSDA ERIC 2021-2025
+#
+# Licensed under the EUPL, Version 1.2 (the "License"); you may not
+# use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from argparse import Namespace
+from unittest import mock
+
+from tornado.testing import AsyncTestCase
+
+from cdcagg_oai import admission
+from . import CDCAggOAIHTTPTestBase
+
+
+def _settings(**kw):
+    return Namespace(oai_pmh_max_in_flight=kw.get('max_in_flight', 0),
+                     oai_pmh_harvester_max_in_flight=kw.get('harvester_max_in_flight', 0),
+                     oai_pmh_harvester_max_queued=kw.get('harvester_max_queued', 10),
+                     oai_pmh_harvester_weights=kw.get('harvester_weights', ''),
+                     oai_pmh_harvester_key=kw.get('harvester_key', admission.HARVESTER_KEY_IP),
+                     oai_pmh_retry_after=kw.get('retry_after', 10))
+
+
+class TestAdmissionController(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(admission, 'set_requests_queued')
+        self._mock_set_requests_queued = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.controller = admission._AdmissionController()
+
+    def test_is_disabled_by_default(self):
+        self.assertFalse(self.controller.enabled)
+
+    def test_admits_immediately_within_limits(self):
+        self.controller.configure(2, 0, 1)
+        self.assertTrue(self.controller.admit('a').result())
+        self.assertTrue(self.controller.admit('b').result())
+
+    def test_queues_over_limit(self):
+        self.controller.configure(1, 0, 1)
+        self.controller.admit('a')
+        future = self.controller.admit('b')
+        self.assertFalse(future.done())
+        self._mock_set_requests_queued.assert_called_once_with(1)
+
+    def test_queues_over_harvester_limit(self):
+        self.controller.configure(0, 1, 1)
+        self.controller.admit('a')
+        self.assertFalse(self.controller.admit('a').done())
+        self.assertTrue(self.controller.admit('b').result())
+
+    def test_rejects_when_harvester_queue_is_full(self):
+        self.controller.configure(1, 0, 1)
+        self.controller.admit('a')
+        self.controller.admit('b')
+        self.assertIsNone(self.controller.admit('b'))
+        # Other harvesters have their own queues.
+        self.assertIsNotNone(self.controller.admit('c'))
+
+    def test_release_admits_waiting_request(self):
+        self.controller.configure(1, 0, 1)
+        self.controller.admit('a')
+        future = self.controller.admit('b')
+        self.controller.release('a')
+        self.assertTrue(future.result())
+        self._mock_set_requests_queued.assert_called_with(0)
+
+    def test_withdraw_removes_waiting_request(self):
+        self.controller.configure(1, 0, 1)
+        self.controller.admit('a')
+        future = self.controller.admit('b')
+        self.controller.withdraw('b', future)
+        self.assertFalse(future.result())
+        self.controller.release('a')
+        self.assertEqual(self.controller._harvesters, {})
+
+    def test_shares_slots_fairly_between_harvesters(self):
+        self.controller.configure(1, 0, 10)
+        self.controller.admit('greedy')
+        greedy = [self.controller.admit('greedy') for _ in range(4)]
+        polite = self.controller.admit('polite')
+        self.controller.release('greedy')
+        # The harvester that was waiting behind the greedy one goes first.
+        self.assertTrue(polite.done())
+        self.assertFalse(any(future.done() for future in greedy))
+
+    def test_shares_slots_by_weight(self):
+        self.controller.configure(1, 0, 10, {'heavy': 3})
+        self.controller.admit('other')
+        heavy = [self.controller.admit('heavy') for _ in range(6)]
+        light = [self.controller.admit('light') for _ in range(6)]
+        order = []
+        key = 'other'
+        for _ in range(8):
+            self.controller.release(key)
+            key = 'heavy' if sum(future.done() for future in heavy) > order.count('heavy') else 'light'
+            order.append(key)
+        self.assertEqual(order.count('heavy'), 6)
+        self.assertEqual(order.count('light'), 2)
+        self.assertEqual(sum(future.done() for future in light), 2)
+
+
+class TestConfigure(AsyncTestCase):
+
+    def tearDown(self):
+        admission.configure(_settings())
+        super().tearDown()
+
+    def test_enables_with_limit(self):
+        admission.configure(_settings(max_in_flight=5))
+        self.assertTrue(admission.is_enabled())
+
+    def test_parses_weights(self):
+        admission.configure(_settings(max_in_flight=5, harvester_weights='1.2.3.4=2, some=agent=0.5'))
+        self.assertEqual(admission._CONTROLLER.weights, {'1.2.3.4': 2.0, 'some=agent': 0.5})
+
+    def test_raises_for_invalid_weights(self):
+        for weights in ('1.2.3.4', '1.2.3.4=0', '1.2.3.4=x'):
+            with self.subTest(weights=weights), self.assertRaises(ValueError):
+                admission.configure(_settings(harvester_weights=weights))
+
+
+class TestAdmissionControlledOAIRoute(CDCAggOAIHTTPTestBase):
+
+    def get_app(self):
+        admission.configure(_settings(max_in_flight=1, harvester_max_queued=0, retry_after=30))
+        self._resets.append(lambda: admission.configure(_settings()))
+        return super().get_app()
+
+    def test_responds_and_releases_slot(self):
+        for _ in range(2):
+            resp = self.fetch('/v0/oai?verb=Identify')
+            self.assertEqual(resp.code, 200)
+        self.assertEqual(admission._CONTROLLER._in_flight, 0)
+
+    def test_rejects_with_retry_after_when_queue_is_full(self):
+        admission._CONTROLLER.admit('another harvester')
+        self._resets.append(lambda: admission._CONTROLLER.release('another harvester'))
+        resp = self.fetch('/v0/oai?verb=Identify')
+        self.assertEqual(resp.code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '30')
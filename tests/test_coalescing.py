@@ -0,0 +1,167 @@
+# Copyright CESSDA ERIC 2021-2025
+#
+# Licensed under the EUPL, Version 1.2 (the "License"); you may not
+# use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from argparse import Namespace
+from unittest import mock
+
+from tornado.httputil import HTTPHeaders
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado.web import Application, RequestHandler, HTTPError
+
+from cdcagg_common.records import Study
+from cdcagg_oai import coalescing
+from . import CDCAggOAIHTTPTestBase
+
+
+GET_RECORD_URL = '/v0/oai?verb=GetRecord&metadataPrefix=oai_dc&identifier=agg_id_1'
+
+
+def _settings(**kw):
+    return Namespace(oai_pmh_coalesce_requests=kw.get('coalesce_requests', True),
+                     oai_pmh_respond_with_requested_url=kw.get('respond_with_requested_url', False))
+
+
+class _SlowHandler(RequestHandler):
+
+    calls = 0
+
+    async def get(self):
+        _SlowHandler.calls += 1
+        await asyncio.sleep(0.05)
+        if self.get_query_argument('fail', None):
+            raise HTTPError(500)
+        self.set_header('Content-Type', 'text/xml')
+        self.set_header('Cache-Control', 'max-age=60')
+        self.add_header('Link', '</a>; rel="a"')
+        self.add_header('Link', '</b>; rel="b"')
+        self.write('<response calls="%s"/>' % (_SlowHandler.calls,))
+
+    post = get
+
+
+class TestCoalescingHandler(AsyncHTTPTestCase):
+
+    def setUp(self):
+        super().setUp()
+        _SlowHandler.calls = 0
+        patcher = mock.patch.object(coalescing.ConfigurableAggMDSet, 'get_mapping_mtimes',
+                                    new=mock.AsyncMock(return_value={}))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(coalescing, 'observe_request_coalesced')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        coalescing.configure(_settings())
+        self.addCleanup(coalescing.configure, _settings(coalesce_requests=False))
+
+    def get_app(self):
+        return Application([('/oai', coalescing.handler_class(_SlowHandler))])
+
+    async def _fetch_concurrently(self, *urls, **kwargs):
+        return await asyncio.gather(*(self.http_client.fetch(self.get_url(url), raise_error=False, **kwargs)
+                                      for url in urls))
+
+    @gen_test
+    async def test_coalesces_identical_concurrent_requests(self):
+        responses = await self._fetch_concurrently('/oai?verb=ListRecords&set=a', '/oai?set=a&verb=ListRecords')
+        self.assertEqual(_SlowHandler.calls, 1)
+        self.assertEqual([resp.code for resp in responses], [200, 200])
+        self.assertEqual(responses[0].body, responses[1].body)
+        self.assertEqual(responses[1].headers['Content-Type'], 'text/xml')
+        self.assertFalse(coalescing._FLIGHTS._pending)
+
+    @gen_test
+    async def test_replays_response_headers(self):
+        responses = await self._fetch_concurrently('/oai?verb=Identify', '/oai?verb=Identify')
+        self.assertEqual(_SlowHandler.calls, 1)
+        self.assertEqual(responses[1].headers['Cache-Control'], 'max-age=60')
+        self.assertEqual(responses[1].headers.get_list('Link'), ['</a>; rel="a"', '</b>; rel="b"'])
+        self.assertEqual(responses[1].headers['Content-Length'], str(len(responses[1].body)))
+        self.assertEqual(len(responses[1].headers.get_list('Date')), 1)
+
+    def test_shared_headers_exclude_hop_by_hop_and_length(self):
+        headers = HTTPHeaders({'Content-Type': 'text/xml', 'Connection': 'close', 'Content-Length': '10',
+                               'Transfer-Encoding': 'chunked', 'X-Custom': 'value'})
+        self.assertEqual(coalescing._shared_headers(headers), [('Content-Type', 'text/xml'), ('X-Custom', 'value')])
+
+    @gen_test
+    async def test_does_not_coalesce_different_requests(self):
+        await self._fetch_concurrently('/oai?verb=ListRecords&set=a', '/oai?verb=ListRecords&set=b')
+        self.assertEqual(_SlowHandler.calls, 2)
+
+    @gen_test
+    async def test_does_not_coalesce_consecutive_requests(self):
+        await self._fetch_concurrently('/oai?verb=Identify')
+        await self._fetch_concurrently('/oai?verb=Identify')
+        self.assertEqual(_SlowHandler.calls, 2)
+
+    @gen_test
+    async def test_does_not_coalesce_post_requests(self):
+        await self._fetch_concurrently('/oai', '/oai', method='POST', body='verb=Identify')
+        self.assertEqual(_SlowHandler.calls, 2)
+
+    @gen_test
+    async def test_processes_waiting_requests_if_response_fails(self):
+        responses = await self._fetch_concurrently('/oai?fail=1', '/oai?fail=1')
+        self.assertEqual(_SlowHandler.calls, 2)
+        self.assertEqual([resp.code for resp in responses], [500, 500])
+
+    @gen_test
+    async def test_does_not_share_not_modified_response(self):
+        etag = (await self.http_client.fetch(self.get_url('/oai?verb=Identify'))).headers['Etag']
+        _SlowHandler.calls = 0
+        responses = await asyncio.gather(
+            self.http_client.fetch(self.get_url('/oai?verb=Identify'), headers={'If-None-Match': etag},
+                                   raise_error=False),
+            self.http_client.fetch(self.get_url('/oai?verb=Identify'), raise_error=False))
+        self.assertEqual([resp.code for resp in responses], [304, 200])
+        self.assertEqual(responses[1].body, b'<response calls="2"/>')
+
+    @gen_test
+    async def test_key_includes_url_if_requested_url_is_echoed(self):
+        coalescing.configure(_settings(respond_with_requested_url=True))
+        await self._fetch_concurrently('/oai?verb=ListRecords&set=a', '/oai?set=a&verb=ListRecords')
+        self.assertEqual(_SlowHandler.calls, 2)
+
+
+class TestCoalescingOAIRoute(CDCAggOAIHTTPTestBase):
+
+    def setUp(self):
+        super().setUp()
+        self._mock_query_single = self._init_patcher(mock.patch(
+            'kuha_common.query.QueryController.query_single'))
+        self._init_patcher(mock.patch('kuha_common.query.QueryController.query_multiple'))
+        study = Study()
+        study.add_study_number('some_number')
+        study._aggregator_identifier.add_value('agg_id_1')
+
+        async def _query_single(record, on_record, **_discard):
+            await asyncio.sleep(0.05)
+            await on_record(study)
+        self._mock_query_single.side_effect = _query_single
+
+    def get_app(self):
+        coalescing.configure(_settings())
+        self._resets.append(lambda: coalescing.configure(_settings(coalesce_requests=False)))
+        return super().get_app()
+
+    @gen_test
+    async def test_coalesced_requests_share_document_store_queries(self):
+        await self.http_client.fetch(self.get_url(GET_RECORD_URL))
+        queries_per_request = self._mock_query_single.call_count
+        self._mock_query_single.reset_mock()
+        responses = await asyncio.gather(*(self.http_client.fetch(self.get_url(GET_RECORD_URL))
+                                           for _ in range(3)))
+        self.assertEqual(self._mock_query_single.call_count, queries_per_request)
+        self.assertEqual(len(set(resp.body for resp in responses)), 1)
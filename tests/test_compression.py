@@ -0,0 +1,200 @@
+# Copyright CESSDA ERIC 2021-2025
+#
+# Licensed under the EUPL, Version 1.2 (the "License"); you may not
+# use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import zlib
+from argparse import Namespace
+from unittest import mock, skipIf, TestCase
+
+from tornado.httputil import HTTPHeaders, HTTPServerRequest
+
+from cdcagg_oai import compression
+
+
+BODY = b'<?xml version="1.0" encoding="utf-8"?>\n<OAI-PMH>' + b'<record>some record</record>' * 100 + b'</OAI-PMH>'
+
+
+def _settings(**kw):
+    return Namespace(api_version=kw.get('api_version', 'v0'),
+                     oai_pmh_compression_encodings=kw.get('encodings', 'gzip,deflate'),
+                     oai_pmh_compression_level=kw.get('level', 6),
+                     oai_pmh_compression_brotli_quality=kw.get('brotli_quality', 4),
+                     oai_pmh_compression_min_length=kw.get('min_length', 1024))
+
+
+def _request(accept_encoding='gzip', path='/v0/oai'):
+    return HTTPServerRequest('GET', path, headers=HTTPHeaders({'Accept-Encoding': accept_encoding}))
+
+
+def _headers(content_type='text/xml; charset=UTF-8', **kw):
+    return HTTPHeaders({'Content-Type': content_type, **kw})
+
+
+def _isolate_transform_settings(test_case):
+    for attr in ('encodings', 'level', 'brotli_quality', 'min_length', 'path'):
+        patcher = mock.patch.object(compression.CompressionTransform, attr,
+                                    getattr(compression.CompressionTransform, attr))
+        patcher.start()
+        test_case.addCleanup(patcher.stop)
+
+
+class TestNegotiateEncoding(TestCase):
+
+    def test_prefers_server_order_on_equal_quality(self):
+        self.assertEqual(compression.negotiate_encoding('deflate, gzip', ('gzip', 'deflate')), 'gzip')
+
+    def test_prefers_higher_quality(self):
+        self.assertEqual(compression.negotiate_encoding('gzip;q=0.5, deflate', ('gzip', 'deflate')), 'deflate')
+
+    def test_ignores_refused_encodings(self):
+        self.assertIsNone(compression.negotiate_encoding('gzip;q=0', ('gzip',)))
+
+    def test_wildcard_accepts_any_encoding(self):
+        self.assertEqual(compression.negotiate_encoding('*', ('deflate',)), 'deflate')
+
+    def test_returns_none_for_missing_header(self):
+        self.assertIsNone(compression.negotiate_encoding('', ('gzip', 'deflate')))
+
+    def test_treats_invalid_quality_as_refused(self):
+        self.assertEqual(compression.negotiate_encoding('gzip;q=x, deflate', ('gzip', 'deflate')), 'deflate')
+
+
+class TestCompressionTransform(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        _isolate_transform_settings(self)
+        compression.configure(_settings())
+
+    def _transform(self, chunk=BODY, headers=None, status_code=200, finishing=True, **kw):
+        transform = compression.CompressionTransform(_request(**kw))
+        headers = _headers() if headers is None else headers
+        return transform.transform_first_chunk(status_code, headers, chunk, finishing)
+
+    def test_compresses_gzip(self):
+        _, headers, chunk = self._transform(headers=_headers(**{'Content-Length': str(len(BODY))}))
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Content-Length'], str(len(chunk)))
+        self.assertEqual(gzip.decompress(chunk), BODY)
+
+    def test_compresses_deflate(self):
+        _, headers, chunk = self._transform(accept_encoding='deflate')
+        self.assertEqual(headers['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(chunk), BODY)
+
+    @skipIf(compression.brotli is None, 'brotli is not installed')
+    def test_compresses_brotli(self):
+        compression.configure(_settings(encodings='br,gzip'))
+        _, headers, chunk = self._transform(accept_encoding='gzip, br')
+        self.assertEqual(headers['Content-Encoding'], 'br')
+        self.assertEqual(compression.brotli.decompress(chunk), BODY)
+
+    def test_compresses_multiple_chunks(self):
+        transform = compression.CompressionTransform(_request())
+        _, headers, first = transform.transform_first_chunk(
+            200, _headers(**{'Content-Length': str(len(BODY))}), BODY[:10], False)
+        self.assertNotIn('Content-Length', headers)
+        chunks = [first, transform.transform_chunk(BODY[10:100], False), transform.transform_chunk(BODY[100:], True)]
+        self.assertEqual(gzip.decompress(b''.join(chunks)), BODY)
+
+    def test_adds_vary_header(self):
+        _, headers, _ = self._transform(accept_encoding='', headers=_headers(Vary='Origin'))
+        self.assertEqual(headers['Vary'], 'Origin, Accept-Encoding')
+
+    def test_does_not_compress_short_responses(self):
+        _, headers, chunk = self._transform(chunk=BODY[:100])
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(chunk, BODY[:100])
+
+    def test_does_not_compress_other_content_types(self):
+        _, headers, chunk = self._transform(headers=_headers(content_type='text/plain'))
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(chunk, BODY)
+
+    def test_does_not_compress_not_modified(self):
+        _, headers, _ = self._transform(status_code=304)
+        self.assertNotIn('Content-Encoding', headers)
+
+    def test_does_not_compress_unaccepted_encodings(self):
+        _, headers, chunk = self._transform(accept_encoding='br')
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(chunk, BODY)
+
+    def test_does_not_touch_other_routes(self):
+        _, headers, chunk = self._transform(path='/metrics')
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertNotIn('Vary', headers)
+        self.assertEqual(chunk, BODY)
+
+
+class TestCompressCompleteResponse(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        _isolate_transform_settings(self)
+        compression.configure(_settings())
+
+    def test_chooses_same_encoding_as_transform(self):
+        _, headers, _ = compression.CompressionTransform(_request('deflate')).transform_first_chunk(
+            200, _headers(), BODY, True)
+        self.assertEqual(compression.response_encoding('deflate', 'text/xml; charset=UTF-8', len(BODY)),
+                         headers['Content-Encoding'])
+
+    def test_does_not_choose_encoding_for_short_or_other_responses(self):
+        self.assertIsNone(compression.response_encoding('gzip', 'text/xml', 10))
+        self.assertIsNone(compression.response_encoding('gzip', 'text/html', len(BODY)))
+
+    def test_compresses_body(self):
+        self.assertEqual(gzip.decompress(compression.compress(BODY, 'gzip')), BODY)
+        self.assertEqual(zlib.decompress(compression.compress(BODY, 'deflate')), BODY)
+
+
+class TestConfigure(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        _isolate_transform_settings(self)
+
+    def test_disabled_by_default(self):
+        compression.configure(_settings(encodings=''))
+        self.assertFalse(compression.is_enabled())
+
+    def test_configures_transform(self):
+        compression.configure(_settings(encodings=' Gzip, deflate ', level=9, min_length=10, api_version='v1'))
+        self.assertTrue(compression.is_enabled())
+        self.assertEqual(compression.CompressionTransform.encodings, ('gzip', 'deflate'))
+        self.assertEqual(compression.CompressionTransform.level, 9)
+        self.assertEqual(compression.CompressionTransform.min_length, 10)
+        self.assertEqual(compression.CompressionTransform.path, '/v1/oai')
+
+    def test_raises_for_unsupported_encoding(self):
+        with self.assertRaises(ValueError):
+            compression.configure(_settings(encodings='gzip,compress'))
+
+    def test_raises_for_brotli_without_package(self):
+        with mock.patch.object(compression, 'brotli', None):
+            with self.assertRaises(ValueError):
+                compression.configure(_settings(encodings='br'))
+
+    def test_raises_for_invalid_level(self):
+        for kw in ({'level': 0}, {'level': 10}, {'brotli_quality': 12}):
+            with self.subTest(**kw):
+                with self.assertRaises(ValueError):
+                    compression.configure(_settings(**kw))
+
+    def test_add_cli_args(self):
+        parser = mock.Mock()
+        compression.add_cli_args(parser)
+        self.assertEqual([call[0][0] for call in parser.add.call_args_list],
+                         ['--oai-pmh-compression-encodings', '--oai-pmh-compression-level',
+                          '--oai-pmh-compression-brotli-quality', '--oai-pmh-compression-min-length'])
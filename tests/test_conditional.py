@@ -0,0 +1,123 @@
+# Copyright CESSDA ERIC 2021-2025
+#
+# Licensed under the EUPL, Version 1.2 (the "License"); you may not
+# use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from argparse import Namespace
+from unittest import mock, TestCase
+
+from cdcagg_common.records import Study
+from cdcagg_oai import conditional
+from . import CDCAggOAIHTTPTestBase
+
+
+OAI_URL = '/v0/oai'
+GET_RECORD_URL = OAI_URL + '?verb=GetRecord&metadataPrefix=oai_dc&identifier=agg_id_1'
+
+
+def _study(updated='2001-01-01T23:23:23Z'):
+    study = Study()
+    study.add_study_number('some_number')
+    study._aggregator_identifier.add_value('agg_id_1')
+    study.set_updated(updated)
+    return study
+
+
+class TestEntityTag(TestCase):
+
+    def test_ignores_response_date(self):
+        self.assertEqual(
+            conditional.entity_tag(b'<OAI-PMH><responseDate>2001-01-01T00:00:00Z</responseDate><a/></OAI-PMH>'),
+            conditional.entity_tag(b'<OAI-PMH><responseDate>2002-02-02T00:00:00Z</responseDate><a/></OAI-PMH>'))
+
+    def test_depends_on_response_contents(self):
+        self.assertNotEqual(conditional.entity_tag(b'<OAI-PMH><a/></OAI-PMH>'),
+                            conditional.entity_tag(b'<OAI-PMH><b/></OAI-PMH>'))
+
+    def test_is_strong(self):
+        self.assertRegex(conditional.entity_tag(b'<OAI-PMH><a/></OAI-PMH>'), r'^"[0-9a-f]{64}"$')
+
+    def test_returns_none_for_oai_pmh_error(self):
+        self.assertIsNone(conditional.entity_tag(b'<OAI-PMH><error code="idDoesNotExist">No record</error>'
+                                                 b'</OAI-PMH>'))
+
+
+class TestConditionalRequests(CDCAggOAIHTTPTestBase):
+
+    def setUp(self):
+        super().setUp()
+        self._mock_query_single = self._init_patcher(mock.patch(
+            'kuha_common.query.QueryController.query_single'))
+        self._init_patcher(mock.patch('kuha_common.query.QueryController.query_multiple'))
+        self.set_record(_study())
+
+    def get_app(self):
+        settings = self.settings()
+        settings.oai_pmh_conditional_requests = True
+        settings.oai_pmh_conditional_requests_cache_size = 10
+        conditional.configure(settings)
+        self._resets.append(lambda: conditional.configure(Namespace(oai_pmh_conditional_requests=False)))
+        return super().get_app()
+
+    def set_record(self, study):
+        async def _query_single(record, on_record, **_discard):
+            if study is not None:
+                await on_record(study)
+        self._mock_query_single.side_effect = _query_single
+
+    def test_get_record_has_strong_etag(self):
+        resp = self.fetch(GET_RECORD_URL)
+        self.assertEqual(resp.code, 200)
+        self.assertTrue(resp.headers['ETag'].startswith('"'))
+
+    def test_does_not_look_up_record_versions_for_unconditional_requests(self):
+        self.fetch(GET_RECORD_URL)
+        # Only the record is fetched.
+        self._mock_query_single.assert_called_once()
+
+    def test_responds_not_modified_for_matching_etag(self):
+        etag = self.fetch(GET_RECORD_URL).headers['ETag']
+        resp = self.fetch(GET_RECORD_URL, headers={'If-None-Match': etag})
+        self.assertEqual(resp.code, 304)
+        self.assertEqual(resp.body, b'')
+
+    def test_responds_not_modified_before_rendering_for_remembered_etag(self):
+        etag = self.fetch(GET_RECORD_URL, headers={'If-None-Match': '"other"'}).headers['ETag']
+        self._mock_query_single.reset_mock()
+        resp = self.fetch(GET_RECORD_URL, headers={'If-None-Match': etag})
+        self.assertEqual(resp.code, 304)
+        self.assertEqual(resp.headers['ETag'], etag)
+        # Only the record version is looked up.
+        self._mock_query_single.assert_called_once()
+
+    def test_responds_with_record_if_record_is_updated(self):
+        etag = self.fetch(GET_RECORD_URL, headers={'If-None-Match': '"other"'}).headers['ETag']
+        self.set_record(_study(updated='2002-01-01T23:23:23Z'))
+        resp = self.fetch(GET_RECORD_URL, headers={'If-None-Match': etag})
+        self.assertEqual(resp.code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_etag_depends_on_metadata_prefix(self):
+        etag = self.fetch(GET_RECORD_URL).headers['ETag']
+        resp = self.fetch(GET_RECORD_URL.replace('oai_dc', 'oai_ddi25'), headers={'If-None-Match': etag})
+        self.assertEqual(resp.code, 200)
+
+    def test_error_response_has_no_etag(self):
+        self.set_record(None)
+        resp = self.fetch(GET_RECORD_URL, headers={'If-None-Match': '*'})
+        self.assertEqual(resp.code, 200)
+        self.assertIn(b'idDoesNotExist', resp.body)
+        self.assertNotIn('ETag', resp.headers)
+
+    def test_identify_has_etag(self):
+        etag = self.fetch(OAI_URL + '?verb=Identify').headers['ETag']
+        resp = self.fetch(OAI_URL + '?verb=Identify', headers={'If-None-Match': etag})
+        self.assertEqual(resp.code, 304)
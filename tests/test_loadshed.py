@@ -0,0 +1,176 @@
+# Copyright CESSDA ERIC 2021-2025
+#
+# Licensed under the EUPL, Version 1.2 (the "License"); you may not
+# use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import asyncio
+from argparse import Namespace
+from unittest import mock
+
+from tornado.testing import AsyncTestCase, AsyncHTTPTestCase, gen_test
+from tornado.web import Application, RequestHandler
+
+from cdcagg_oai import loadshed
+from . import CDCAggOAIHTTPTestBase
+
+
+def _settings(**kw):
+    return Namespace(event_loop_lag_interval=kw.get('event_loop_lag_interval', 1.0),
+                     oai_pmh_shed_event_loop_lag=kw.get('shed_event_loop_lag', 0),
+                     oai_pmh_shed_in_flight=kw.get('shed_in_flight', 0),
+                     oai_pmh_retry_after=kw.get('retry_after', 10))
+
+
+class TestLagMonitor(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(loadshed, 'set_event_loop_lag')
+        self._mock_set_event_loop_lag = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.monitor = loadshed._LagMonitor()
+        self.monitor.interval = 0.01
+
+    def test_does_not_start_if_disabled(self):
+        self.monitor.interval = 0
+        self.monitor.start()
+        self.assertEqual(self.monitor.current_lag(), 0.0)
+
+    @gen_test
+    async def test_measures_lag(self):
+        self.monitor.start()
+        await asyncio.sleep(0.005)
+        # Block the event loop.
+        time.sleep(0.1)
+        self.assertGreater(self.monitor.current_lag(), 0.05)
+        await asyncio.sleep(0.02)
+        self.assertGreater(self._mock_set_event_loop_lag.call_args_list[0][0][0], 0.05)
+
+    @gen_test
+    async def test_measures_no_lag_for_idle_loop(self):
+        self.monitor.start()
+        await asyncio.sleep(0.05)
+        self.assertLess(self.monitor.current_lag(), 0.01)
+
+
+class TestLoadShedder(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.shedder = loadshed._LoadShedder()
+
+    def test_is_disabled_by_default(self):
+        self.assertFalse(self.shedder.enabled)
+        self.assertFalse(self.shedder.is_overloaded())
+
+    def test_is_overloaded_with_too_many_requests_in_progress(self):
+        self.shedder.configure(0, 2, 10)
+        self.shedder.in_flight = 1
+        self.assertFalse(self.shedder.is_overloaded())
+        self.shedder.in_flight = 2
+        with self.assertLogs(loadshed._logger, level='WARNING'):
+            self.assertTrue(self.shedder.is_overloaded())
+
+    @mock.patch.object(loadshed._MONITOR, 'current_lag', return_value=0.5)
+    def test_is_overloaded_with_event_loop_lag(self, mock_current_lag):
+        self.shedder.configure(0.2, 0, 10)
+        with self.assertLogs(loadshed._logger, level='WARNING'):
+            self.assertTrue(self.shedder.is_overloaded())
+        mock_current_lag.return_value = 0.1
+        self.assertFalse(self.shedder.is_overloaded())
+
+
+class TestConfigure(AsyncTestCase):
+
+    def tearDown(self):
+        loadshed.configure(_settings())
+        super().tearDown()
+
+    def test_enables_with_threshold(self):
+        loadshed.configure(_settings(shed_event_loop_lag=0.5))
+        self.assertTrue(loadshed.is_enabled())
+        self.assertEqual(loadshed._SHEDDER.max_lag, 0.5)
+
+    def test_raises_if_lag_is_not_measured(self):
+        with self.assertRaises(ValueError):
+            loadshed.configure(_settings(event_loop_lag_interval=0, shed_event_loop_lag=0.5))
+
+
+class TestLoadSheddingOAIRoute(CDCAggOAIHTTPTestBase):
+
+    def get_app(self):
+        loadshed.configure(_settings(shed_in_flight=1, retry_after=30))
+        self._resets.append(lambda: loadshed.configure(_settings()))
+        return super().get_app()
+
+    def test_responds_and_completes_request(self):
+        for _ in range(2):
+            resp = self.fetch('/v0/oai?verb=Identify')
+            self.assertEqual(resp.code, 200)
+        self.assertEqual(loadshed._SHEDDER.in_flight, 0)
+
+    def test_rejects_with_retry_after_when_overloaded(self):
+        loadshed._SHEDDER.in_flight += 1
+        self._resets.append(lambda: setattr(loadshed._SHEDDER, 'in_flight', loadshed._SHEDDER.in_flight - 1))
+        resp = self.fetch('/v0/oai?verb=Identify')
+        self.assertEqual(resp.code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '30')
+        self.assertEqual(resp.body, b'')
+
+
+class _WaitingHandler(RequestHandler):
+
+    in_flight_while_rendering = None
+    admission = None
+
+    async def prepare(self):
+        if self.get_query_argument('cached', None):
+            self.finish('cached')
+            return
+        # Wait in prepare, as requests waiting for admission do.
+        await _WaitingHandler.admission
+
+    def get(self):
+        _WaitingHandler.in_flight_while_rendering = loadshed._SHEDDER.in_flight
+        self.write('rendered')
+
+
+class TestLoadSheddingHandler(AsyncHTTPTestCase):
+
+    def setUp(self):
+        super().setUp()
+        loadshed.configure(_settings(shed_in_flight=1))
+        self.addCleanup(loadshed.configure, _settings())
+        patcher = mock.patch.object(loadshed, 'observe_request_shed')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        _WaitingHandler.admission = self.io_loop.asyncio_loop.create_future()
+
+    def get_app(self):
+        return Application([('/oai', loadshed.handler_class(_WaitingHandler))])
+
+    @gen_test
+    async def test_does_not_count_requests_waiting_in_prepare(self):
+        waiting = [self.http_client.fetch(self.get_url('/oai'), raise_error=False) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        self.assertEqual(loadshed._SHEDDER.in_flight, 0)
+        _WaitingHandler.admission.set_result(True)
+        responses = await asyncio.gather(*waiting)
+        self.assertEqual([resp.code for resp in responses], [200, 200])
+        self.assertEqual(_WaitingHandler.in_flight_while_rendering, 1)
+        self.assertEqual(loadshed._SHEDDER.in_flight, 0)
+
+    @gen_test
+    async def test_does_not_count_requests_finished_in_prepare(self):
+        resp = await self.http_client.fetch(self.get_url('/oai?cached=1'))
+        self.assertEqual(resp.body, b'cached')
+        self.assertEqual(loadshed._SHEDDER.in_flight, 0)
@@ -12,13 +12,17 @@
 # limitations under the License.
 
 import os.path
-from tempfile import NamedTemporaryFile
+import asyncio
+import threading
+from xml.etree import ElementTree
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 from unittest import mock, TestCase, IsolatedAsyncioTestCase
 from argparse import Namespace
 from yaml.parser import ParserError
 from cdcagg_common.records import Study
 from cdcagg_oai import metadataformats
-from . import testcasebase
+from tornado.testing import gen_test
+from . import testcasebase, CDCAggOAIHTTPTestBase
 
 
 CONFIGURABLE_SETS = """
@@ -77,11 +81,290 @@ nodes:
         'data', filename)))
 
 
+class TestMappingFileIO(IsolatedAsyncioTestCase):
+
+    @mock.patch.object(metadataformats, 'observe_mapping_files_duration')
+    def test_timed_returns_func_return_value_and_observes_duration(self, mock_observe):
+        mock_func = mock.Mock(return_value='result')
+        self.assertEqual(metadataformats._MappingFileIO.timed('load', mock_func, 'arg'), 'result')
+        mock_func.assert_called_once_with('arg')
+        self.assertEqual(mock_observe.call_count, 1)
+        self.assertEqual(mock_observe.call_args[0][0], 'load')
+
+    @mock.patch.object(metadataformats, 'observe_mapping_files_duration')
+    def test_timed_observes_duration_on_exception(self, mock_observe):
+        with self.assertRaises(ValueError):
+            metadataformats._MappingFileIO.timed('load', mock.Mock(side_effect=ValueError))
+        self.assertEqual(mock_observe.call_count, 1)
+
+    @mock.patch.object(metadataformats, 'observe_mapping_files_duration')
+    async def test_run_calls_func_outside_event_loop_thread(self, mock_observe):
+        func_thread_ids = []
+        rval = await metadataformats._MappingFileIO.run(
+            'load', lambda value: func_thread_ids.append(threading.get_ident()) or value, 'result')
+        self.assertEqual(rval, 'result')
+        self.assertNotEqual(func_thread_ids, [threading.get_ident()])
+        self.assertEqual(len(func_thread_ids), 1)
+        mock_observe.assert_called_once()
+
+
+class TestListSetsCache(IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self._cache = metadataformats._ListSetsCache()
+        self._cache.ttl = 60
+        self._mock_query = mock.AsyncMock(side_effect=self._query)
+        super().setUp()
+
+    @staticmethod
+    async def _query(on_set_cb):
+        await on_set_cb('spec', name='Name')
+        await on_set_cb('spec:sub', name='Sub', description='Desc')
+
+    async def test_query_calls_query_func_if_ttl_is_zero(self):
+        self._cache.ttl = 0
+        for _ in range(2):
+            await self._cache.query('key', self._mock_query, mock.AsyncMock())
+        self.assertEqual(self._mock_query.call_count, 2)
+
+    async def test_query_replays_cached_sets(self):
+        await self._cache.query('key', self._mock_query, mock.AsyncMock())
+        mock_on_set_cb = mock.AsyncMock()
+        await self._cache.query('key', self._mock_query, mock_on_set_cb)
+        self._mock_query.assert_called_once()
+        self.assertEqual(mock_on_set_cb.call_args_list, [
+            mock.call('spec', name='Name', description=None),
+            mock.call('spec:sub', name='Sub', description='Desc')])
+
+    async def test_query_caches_by_key(self):
+        await self._cache.query('key', self._mock_query, mock.AsyncMock())
+        await self._cache.query('other', self._mock_query, mock.AsyncMock())
+        self.assertEqual(self._mock_query.call_count, 2)
+
+    @mock.patch.object(metadataformats.time, 'monotonic')
+    async def test_query_calls_query_func_if_ttl_has_passed(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        await self._cache.query('key', self._mock_query, mock.AsyncMock())
+        mock_monotonic.return_value = 160
+        await self._cache.query('key', self._mock_query, mock.AsyncMock())
+        self.assertEqual(self._mock_query.call_count, 2)
+
+    async def test_invalidate_key(self):
+        await self._cache.query('key', self._mock_query, mock.AsyncMock())
+        await self._cache.query('other', self._mock_query, mock.AsyncMock())
+        self._cache.invalidate('key')
+        await self._cache.query('key', self._mock_query, mock.AsyncMock())
+        await self._cache.query('other', self._mock_query, mock.AsyncMock())
+        self.assertEqual(self._mock_query.call_count, 3)
+
+    async def test_invalidate_all(self):
+        await self._cache.query('key', self._mock_query, mock.AsyncMock())
+        await self._cache.query('other', self._mock_query, mock.AsyncMock())
+        self._cache.invalidate()
+        await self._cache.query('key', self._mock_query, mock.AsyncMock())
+        await self._cache.query('other', self._mock_query, mock.AsyncMock())
+        self.assertEqual(self._mock_query.call_count, 4)
+
+    async def test_query_does_not_cache_if_invalidated_while_querying(self):
+        async def _query(on_set_cb):
+            await on_set_cb('spec')
+            self._cache.invalidate('key')
+        mock_query = mock.AsyncMock(side_effect=_query)
+        for _ in range(2):
+            await self._cache.query('key', mock_query, mock.AsyncMock())
+        self.assertEqual(mock_query.call_count, 2)
+
+    async def test_query_does_not_cache_on_exception(self):
+        self._mock_query.side_effect = ValueError
+        with self.assertRaises(ValueError):
+            await self._cache.query('key', self._mock_query, mock.AsyncMock())
+        self._mock_query.side_effect = self._query
+        await self._cache.query('key', self._mock_query, mock.AsyncMock())
+        self.assertEqual(self._mock_query.call_count, 2)
+
+
+class TestListSetsCacheConfiguration(TestCase):
+
+    def tearDown(self):
+        metadataformats._LIST_SETS_CACHE.ttl = 0
+        metadataformats._GET_RECORD_BATCHER.window = 0
+        super().tearDown()
+
+    def test_add_cli_args_adds_args(self):
+        mock_parser = mock.Mock()
+        metadataformats.add_cli_args(mock_parser)
+        self.assertEqual(mock_parser.add.call_args_list, [
+            mock.call('--oai-pmh-list-sets-cache-ttl',
+                      help='Seconds to serve OAI sets of ListSets responses from memory. Set to 0 to disable caching.',
+                      default=0, env_var='OPRH_OP_LIST_SETS_CACHE_TTL', type=float),
+            mock.call('--oai-pmh-serializer-engine',
+                      help='Engine used to serialize record metadata. The compiled engine writes OAI-DC and '
+                      'OAI-Datacite metadata without Genshi template processing. Output is the same for both engines.',
+                      default='genshi', choices=('genshi', 'compiled'), env_var='OPRH_OP_SERIALIZER_ENGINE',
+                      type=str),
+            mock.call('--oai-pmh-fragment-cache-size',
+                      help='Number of serialized record metadata kept in memory by the compiled serializer '
+                      'engine. Only OAI-DC and OAI-Datacite metadata is cached. Set to 0 to disable caching.',
+                      default=0, env_var='OPRH_OP_FRAGMENT_CACHE_SIZE', type=int),
+            mock.call('--oai-pmh-fragment-cache-dir',
+                      help='Directory to store serialized record metadata evicted from memory. Leave unset to '
+                      'keep the cache in memory only.',
+                      env_var='OPRH_OP_FRAGMENT_CACHE_DIR', type=str),
+            mock.call('--oai-pmh-fragment-cache-dir-max-files',
+                      help='Maximum number of files in --oai-pmh-fragment-cache-dir. The oldest files are '
+                      'removed when there are more. Set to 0 for no limit.',
+                      default=100000, env_var='OPRH_OP_FRAGMENT_CACHE_DIR_MAX_FILES', type=int),
+            mock.call('--oai-pmh-get-record-batch-window',
+                      help='Milliseconds to collect GetRecord requests into a single Document Store query. '
+                      'Set to 0 to query each record separately.',
+                      default=0, env_var='OPRH_OP_GET_RECORD_BATCH_WINDOW', type=float),
+            mock.call('--oai-pmh-get-record-batch-size',
+                      help='Maximum number of records fetched by a single batched GetRecord query.',
+                      default=100, env_var='OPRH_OP_GET_RECORD_BATCH_SIZE', type=int)])
+
+    def test_configure_sets_ttl_and_invalidates(self):
+        metadataformats._LIST_SETS_CACHE._entries['key'] = (0, [])
+        metadataformats.configure(Namespace(oai_pmh_list_sets_cache_ttl=30,
+                                            oai_pmh_serializer_engine='genshi',
+                                            oai_pmh_fragment_cache_size=0,
+                                            oai_pmh_fragment_cache_dir=None,
+                                            oai_pmh_fragment_cache_dir_max_files=0,
+                                            oai_pmh_get_record_batch_window=0,
+                                            oai_pmh_get_record_batch_size=100))
+        self.assertEqual(metadataformats._LIST_SETS_CACHE.ttl, 30)
+        self.assertEqual(metadataformats._LIST_SETS_CACHE._entries, {})
+
+    @mock.patch.object(metadataformats.serializers, 'configure_fragment_cache')
+    @mock.patch.object(metadataformats.serializers, 'set_engine')
+    def test_configure_sets_serializer_engine(self, mock_set_engine, mock_configure_fragment_cache):
+        metadataformats.configure(Namespace(oai_pmh_list_sets_cache_ttl=0,
+                                            oai_pmh_serializer_engine='compiled',
+                                            oai_pmh_fragment_cache_size=100,
+                                            oai_pmh_fragment_cache_dir='/some/dir',
+                                            oai_pmh_fragment_cache_dir_max_files=1000,
+                                            oai_pmh_get_record_batch_window=0,
+                                            oai_pmh_get_record_batch_size=100))
+        mock_set_engine.assert_called_once_with('compiled')
+        mock_configure_fragment_cache.assert_called_once_with(100, '/some/dir', 1000)
+
+    def test_configure_sets_get_record_batching(self):
+        metadataformats.configure(Namespace(oai_pmh_list_sets_cache_ttl=0,
+                                            oai_pmh_serializer_engine='genshi',
+                                            oai_pmh_fragment_cache_size=0,
+                                            oai_pmh_fragment_cache_dir=None,
+                                            oai_pmh_fragment_cache_dir_max_files=0,
+                                            oai_pmh_get_record_batch_window=5,
+                                            oai_pmh_get_record_batch_size=50))
+        self.assertTrue(metadataformats._GET_RECORD_BATCHER.enabled)
+        self.assertEqual(metadataformats._GET_RECORD_BATCHER.window, 0.005)
+        self.assertEqual(metadataformats._GET_RECORD_BATCHER.max_size, 50)
+
+    def test_configure_raises_for_invalid_get_record_batch_size(self):
+        with self.assertRaises(ValueError):
+            metadataformats.configure(Namespace(oai_pmh_list_sets_cache_ttl=0,
+                                                oai_pmh_serializer_engine='genshi',
+                                                oai_pmh_fragment_cache_size=0,
+                                                oai_pmh_fragment_cache_dir=None,
+                                                oai_pmh_fragment_cache_dir_max_files=0,
+                                                oai_pmh_get_record_batch_window=5,
+                                                oai_pmh_get_record_batch_size=0))
+
+    def test_sets_are_served_from_cache(self):
+        for set_class in metadataformats.AggMetadataFormatBase.sets:
+            with self.subTest(set_class=set_class):
+                self.assertTrue(issubclass(set_class, metadataformats._CachedListSetsMixin))
+
+
+def _study(identifier):
+    study = Study()
+    study.add_study_number(identifier)
+    study._aggregator_identifier.add_value(identifier)
+    return study
+
+
+class TestGetRecordBatcher(IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self._batcher = metadataformats._GetRecordBatcher()
+        self._batcher.window = 0.01
+        self._batcher.max_size = 10
+        self._mock_query_multiple = mock.AsyncMock(side_effect=self._query_multiple)
+        for target, attribute, value in (
+                (metadataformats.QueryController, 'query_multiple', self._mock_query_multiple),
+                (metadataformats, 'observe_get_record_batch_size', mock.Mock())):
+            patcher = mock.patch.object(target, attribute, new=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        super().setUp()
+
+    @staticmethod
+    async def _query_multiple(study_class, on_record, **kwargs):
+        for identifier in kwargs['_filter'][study_class._aggregator_identifier]['$in']:
+            if identifier != 'missing':
+                await on_record(_study(identifier))
+
+    async def test_get_fetches_concurrent_lookups_in_single_query(self):
+        studies = await asyncio.gather(*(self._batcher.get(Study, identifier, headers={'key': 'value'})
+                                         for identifier in ('id_1', 'id_2', 'id_1')))
+        self._mock_query_multiple.assert_called_once()
+        _, kwargs = self._mock_query_multiple.call_args
+        self.assertEqual(kwargs['_filter'], {Study._aggregator_identifier: {'$in': ['id_1', 'id_2']}})
+        self.assertEqual(kwargs['headers'], {'key': 'value'})
+        self.assertEqual([study._aggregator_identifier.get_value() for study in studies], ['id_1', 'id_2', 'id_1'])
+        metadataformats.observe_get_record_batch_size.assert_called_once_with(2)
+
+    async def test_get_returns_none_for_missing_study(self):
+        self.assertIsNone(await self._batcher.get(Study, 'missing'))
+
+    async def test_get_queries_given_fields(self):
+        await self._batcher.get(Study, 'id_1', fields=[Study._metadata, Study.study_titles])
+        _, kwargs = self._mock_query_multiple.call_args
+        self.assertEqual(kwargs['fields'], [Study._metadata, Study.study_titles])
+
+    async def test_get_batches_lookups_with_different_fields_separately(self):
+        await asyncio.gather(self._batcher.get(Study, 'id_1', fields=[Study._metadata]),
+                             self._batcher.get(Study, 'id_2', fields=[Study._metadata, Study.study_titles]),
+                             self._batcher.get(Study, 'id_3', fields=[Study._metadata]))
+        self.assertEqual(self._mock_query_multiple.call_count, 2)
+
+    async def test_get_logs_headers_of_merged_lookups(self):
+        with self.assertLogs(metadataformats._logger, level='DEBUG') as logs:
+            await asyncio.gather(self._batcher.get(Study, 'id_1', headers={'key': 'first'}),
+                                 self._batcher.get(Study, 'id_2', headers={'key': 'second'}))
+        self.assertIn("{'key': 'second'}", logs.output[0])
+
+    async def test_get_queries_full_batch_without_waiting(self):
+        self._batcher.window = 60
+        self._batcher.max_size = 2
+        studies = await asyncio.wait_for(asyncio.gather(self._batcher.get(Study, 'id_1'),
+                                                        self._batcher.get(Study, 'id_2')), 1)
+        self.assertEqual(len(studies), 2)
+        self._mock_query_multiple.assert_called_once()
+
+    async def test_get_queries_consecutive_lookups_separately(self):
+        await self._batcher.get(Study, 'id_1')
+        await self._batcher.get(Study, 'id_2')
+        self.assertEqual(self._mock_query_multiple.call_count, 2)
+
+    async def test_get_raises_query_exception_for_whole_batch(self):
+        self._mock_query_multiple.side_effect = ValueError
+        results = await asyncio.gather(self._batcher.get(Study, 'id_1'), self._batcher.get(Study, 'id_2'),
+                                       return_exceptions=True)
+        self.assertEqual([type(result) for result in results], [ValueError, ValueError])
+
+    async def test_get_cancels_whole_batch_if_query_is_cancelled(self):
+        self._mock_query_multiple.side_effect = asyncio.CancelledError
+        results = await asyncio.gather(self._batcher.get(Study, 'id_1'), self._batcher.get(Study, 'id_2'),
+                                       return_exceptions=True)
+        self.assertEqual([type(result) for result in results], [asyncio.CancelledError, asyncio.CancelledError])
+
+
 class TestConfigurableMDSet(TestCase):
 
     def tearDown(self):
         metadataformats.ConfigurableAggMDSet.spec = None
         metadataformats.ConfigurableAggMDSet._loaded_filepath = None
+        metadataformats.ConfigurableAggMDSet._index = None
         super().tearDown()
 
     def test_init_raises_NotImplementedError_if_no_spec(self):
@@ -91,13 +374,23 @@ class TestConfigurableMDSet(TestCase):
     def test_add_cli_args_adds_args(self):
         mock_parser = mock.Mock()
         metadataformats.ConfigurableAggMDSet.add_cli_args(mock_parser)
-        mock_parser.add.assert_called_once_with(
-            '--oai-set-configurable-path',
-            help='Path to look for configurable OAI set definitions. Leave unset to discard '
-            'configurable set.', env_var='OPRH_OS_CONFIGURABLE_PATH', type=str)
+        self.assertEqual(mock_parser.add.call_args_list, [
+            mock.call('--oai-set-configurable-path',
+                      help='Path to look for configurable OAI set definitions. Leave unset to discard '
+                      'configurable set.', env_var='OPRH_OS_CONFIGURABLE_PATH', type=str),
+            mock.call('--oai-set-configurable-reload-interval',
+                      help='Interval in seconds to check configurable OAI set definitions for changes. '
+                      'Changed definitions are reloaded. Set to 0 to disable reloading.',
+                      default=0, env_var='OPRH_OS_CONFIGURABLE_RELOAD_INTERVAL', type=float),
+            mock.call('--oai-set-configurable-cache-dir',
+                      help='Directory to cache parsed configurable OAI set definitions. Unchanged definitions '
+                      'are read from cache instead of parsing YAML. Leave unset to disable caching.',
+                      env_var='OPRH_OS_CONFIGURABLE_CACHE_DIR', type=str)])
 
     def test_configure_raises_FileNotFoundError_for_invalid_file(self):
-        settings = Namespace(oai_set_configurable_path='/some/invalid/path')
+        settings = Namespace(oai_set_configurable_path='/some/invalid/path',
+                             oai_set_configurable_reload_interval=0,
+                             oai_set_configurable_cache_dir=None)
         with self.assertRaises(FileNotFoundError):
             metadataformats.ConfigurableAggMDSet.configure(settings)
 
@@ -105,31 +398,88 @@ class TestConfigurableMDSet(TestCase):
         with NamedTemporaryFile(mode='w', delete=False) as somefile:
             somefile.write(INVALID_YAML)
             somefile.close()
-            settings = Namespace(oai_set_configurable_path=somefile.name)
+            settings = Namespace(oai_set_configurable_path=somefile.name,
+                                 oai_set_configurable_reload_interval=0,
+                                 oai_set_configurable_cache_dir=None)
             with self.assertRaises(ParserError):
                 metadataformats.ConfigurableAggMDSet.configure(settings)
 
     def test_configure_returns_False_if_file_not_given(self):
         # oai_set_configurable_path attribute in Namespace object is None if it is
         # declared to parser but not given via configuration options.
-        rval = metadataformats.ConfigurableAggMDSet.configure(Namespace(oai_set_configurable_path=None))
+        rval = metadataformats.ConfigurableAggMDSet.configure(Namespace(oai_set_configurable_path=None,
+                                                                        oai_set_configurable_reload_interval=0,
+                                                                        oai_set_configurable_cache_dir=None))
         self.assertFalse(rval)
 
     def test_configure_accepts_a_valid_file(self):
         with NamedTemporaryFile(mode='w', delete=False) as somefile:
             somefile.write(CONFIGURABLE_SETS)
             somefile.close()
-            settings = Namespace(oai_set_configurable_path=somefile.name)
+            settings = Namespace(oai_set_configurable_path=somefile.name,
+                                 oai_set_configurable_reload_interval=0,
+                                 oai_set_configurable_cache_dir=None)
             # Should not raise here
             rval = metadataformats.ConfigurableAggMDSet.configure(settings)
         self.assertEqual(metadataformats.ConfigurableAggMDSet._loaded_filepath, somefile.name)
         self.assertTrue(rval)
 
+    def test_configure_writes_and_reads_cache(self):
+        with TemporaryDirectory() as cache_dir, NamedTemporaryFile(mode='w', delete=False) as somefile:
+            somefile.write(CONFIGURABLE_SETS)
+            somefile.close()
+            settings = Namespace(oai_set_configurable_path=somefile.name,
+                                 oai_set_configurable_reload_interval=0,
+                                 oai_set_configurable_cache_dir=cache_dir)
+            metadataformats.ConfigurableAggMDSet.configure(settings)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            with mock.patch.object(metadataformats, 'load') as mock_load:
+                metadataformats.ConfigurableAggMDSet.configure(settings)
+            mock_load.assert_not_called()
+        self.assertEqual(metadataformats.ConfigurableAggMDSet._index.identifiers_by_spec['humanities'],
+                         frozenset(['id_2', 'id_3', 'id_4']))
+
+    def test_configure_replaces_stale_cache(self):
+        with TemporaryDirectory() as cache_dir, NamedTemporaryFile(mode='w', delete=False) as somefile:
+            somefile.write(CONFIGURABLE_SETS)
+            somefile.close()
+            settings = Namespace(oai_set_configurable_path=somefile.name,
+                                 oai_set_configurable_reload_interval=0,
+                                 oai_set_configurable_cache_dir=cache_dir)
+            metadataformats.ConfigurableAggMDSet.configure(settings)
+            old_cache_files = os.listdir(cache_dir)
+            with open(somefile.name, 'w') as file_obj:
+                file_obj.write(CONFIGURABLE_SETS.replace('- id_4', '- id_5'))
+            metadataformats.ConfigurableAggMDSet.configure(settings)
+            new_cache_files = os.listdir(cache_dir)
+        self.assertEqual(len(new_cache_files), 1)
+        self.assertNotEqual(old_cache_files, new_cache_files)
+        self.assertEqual(metadataformats.ConfigurableAggMDSet._index.identifiers_by_spec['humanities'],
+                         frozenset(['id_2', 'id_3', 'id_5']))
+
+    def test_configure_ignores_corrupted_cache(self):
+        with TemporaryDirectory() as cache_dir, NamedTemporaryFile(mode='w', delete=False) as somefile:
+            somefile.write(CONFIGURABLE_SETS)
+            somefile.close()
+            settings = Namespace(oai_set_configurable_path=somefile.name,
+                                 oai_set_configurable_reload_interval=0,
+                                 oai_set_configurable_cache_dir=cache_dir)
+            metadataformats.ConfigurableAggMDSet.configure(settings)
+            cache_path = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+            with open(cache_path, 'wb') as file_obj:
+                file_obj.write(b'corrupted')
+            with self.assertLogs(metadataformats._logger, level='WARNING'):
+                metadataformats.ConfigurableAggMDSet.configure(settings)
+        self.assertEqual(metadataformats.ConfigurableAggMDSet._index.identifiers_by_spec['humanities'],
+                         frozenset(['id_2', 'id_3', 'id_4']))
+
     def _assert_configure_raises_InvalidMappingConfig(self, filecontent):
         with NamedTemporaryFile(mode='w', delete=False) as somefile:
             somefile.write(filecontent)
             somefile.close()
-            settings = Namespace(oai_set_configurable_path=somefile.name)
+            settings = Namespace(oai_set_configurable_path=somefile.name,
+                                 oai_set_configurable_reload_interval=0,
+                                 oai_set_configurable_cache_dir=None)
             with self.assertRaises(metadataformats.InvalidMappingConfig):
                 metadataformats.ConfigurableAggMDSet.configure(settings)
 
@@ -241,53 +591,225 @@ class TestConfigurableMDSet(TestCase):
 
 class TestConfigurableMDSetAsync(IsolatedAsyncioTestCase):
 
-    async def test_get_config_with_path_single_node(self):
-        conf_set = _configurable_sets_with_path('ext_confset.yaml')
-        with NamedTemporaryFile(mode='w', delete=False) as somefile:
-            somefile.write(conf_set)
-            somefile.close()
-            settings = Namespace(oai_set_configurable_path=somefile.name)
-            metadataformats.ConfigurableAggMDSet.configure(settings)
-            conf_agg_set = metadataformats.ConfigurableAggMDSet('metadataformat')
-        cnf = await conf_agg_set._get_config()
-        expected = [{'description': 'Studies in social sciences',
-                     'identifiers': ['id_1', 'id_2'],
-                     'name': 'Social sciences',
-                     'spec': 'social_sciences'},
-                    {'description': 'Studies in history',
-                     'identifiers': ['id_5', 'id_6'],
-                     'name': 'History',
-                     'spec': 'history'}]
-        self.assertEqual(cnf['nodes'], expected)
-
-    async def test_get_config_with_path_multiple_nodes(self):
-        conf_set = _configurable_sets_with_path('ext_confsets.yaml')
+    def tearDown(self):
+        metadataformats.ConfigurableAggMDSet.spec = None
+        metadataformats.ConfigurableAggMDSet._loaded_filepath = None
+        metadataformats.ConfigurableAggMDSet._index = None
+        metadataformats.ConfigurableAggMDSet._mtimes = None
+        metadataformats.ConfigurableAggMDSet._reload_interval = 0
+        metadataformats.ConfigurableAggMDSet._reload_future = None
+        super().tearDown()
+
+    def _configure(self, conf_set, reload_interval=0):
         with NamedTemporaryFile(mode='w', delete=False) as somefile:
             somefile.write(conf_set)
             somefile.close()
-            settings = Namespace(oai_set_configurable_path=somefile.name)
+            settings = Namespace(oai_set_configurable_path=somefile.name,
+                                 oai_set_configurable_reload_interval=reload_interval,
+                                 oai_set_configurable_cache_dir=None)
             metadataformats.ConfigurableAggMDSet.configure(settings)
-            conf_agg_set = metadataformats.ConfigurableAggMDSet('metadataformat')
-        cnf = await conf_agg_set._get_config()
-        expected = [{'description': 'Studies in social sciences',
-                     'identifiers': ['id_1', 'id_2'],
-                     'name': 'Social sciences',
-                     'spec': 'social_sciences'},
-                    {'description': 'Studies in history',
-                     'identifiers': ['id_5', 'id_6'],
-                     'name': 'History',
-                     'spec': 'history'},
-                    {'description': 'Literature Studies',
-                     'identifiers': ['id_7', 'id_8'],
-                     'name': 'Literature',
-                     'spec': 'literature'}]
-        self.assertEqual(cnf['nodes'], expected)
+        self._filepath = somefile.name
+        return metadataformats.ConfigurableAggMDSet(mock.Mock(study_class=Study))
+
+    def _rewrite(self, content):
+        mtime_ns = os.stat(self._filepath).st_mtime_ns
+        with open(self._filepath, 'w') as file_obj:
+            file_obj.write(content)
+        # Make sure the modification time changes regardless of filesystem timestamp resolution.
+        os.utime(self._filepath, ns=(mtime_ns + 10**9, mtime_ns + 10**9))
+
+    async def test_index_with_path_single_node(self):
+        conf_agg_set = self._configure(_configurable_sets_with_path('ext_confset.yaml'))
+        index = await conf_agg_set._get_index()
+        self.assertEqual(index.nodes, [('social_sciences', 'Social sciences', 'Studies in social sciences'),
+                                       ('history', 'History', 'Studies in history')])
+        self.assertEqual(index.identifiers_by_spec, {'social_sciences': frozenset(['id_1', 'id_2']),
+                                                     'history': frozenset(['id_5', 'id_6'])})
+
+    async def test_index_with_path_multiple_nodes(self):
+        conf_agg_set = self._configure(_configurable_sets_with_path('ext_confsets.yaml'))
+        index = await conf_agg_set._get_index()
+        self.assertEqual(index.nodes, [('social_sciences', 'Social sciences', 'Studies in social sciences'),
+                                       ('history', 'History', 'Studies in history'),
+                                       ('literature', 'Literature', 'Literature Studies')])
+        self.assertEqual(index.identifiers_by_spec, {'social_sciences': frozenset(['id_1', 'id_2']),
+                                                     'history': frozenset(['id_5', 'id_6']),
+                                                     'literature': frozenset(['id_7', 'id_8'])})
+
+    async def test_index_maps_identifiers_to_specs(self):
+        conf_agg_set = self._configure(CONFIGURABLE_SETS)
+        index = await conf_agg_set._get_index()
+        self.assertEqual(index.specs_by_identifier, {'id_1': frozenset(['social_sciences']),
+                                                     'id_2': frozenset(['social_sciences', 'humanities']),
+                                                     'id_3': frozenset(['humanities']),
+                                                     'id_4': frozenset(['humanities'])})
+
+    async def test_configure_does_not_reread_file(self):
+        conf_agg_set = self._configure(CONFIGURABLE_SETS)
+        study = Study()
+        study._aggregator_identifier.add_value('id_2')
+        with mock.patch('builtins.open') as mock_open:
+            await conf_agg_set.get(study)
+            await conf_agg_set.filter('humanities')
+            await conf_agg_set.query(mock.AsyncMock())
+        mock_open.assert_not_called()
+
+    async def test_get_returns_specs_in_declaration_order(self):
+        conf_agg_set = self._configure(CONFIGURABLE_SETS)
+        study = Study()
+        study._aggregator_identifier.add_value('id_2')
+        self.assertEqual(await conf_agg_set.get(study), ['social_sciences', 'humanities'])
+
+    async def test_get_returns_empty_list_for_unknown_identifier(self):
+        conf_agg_set = self._configure(CONFIGURABLE_SETS)
+        study = Study()
+        study._aggregator_identifier.add_value('id_5')
+        self.assertEqual(await conf_agg_set.get(study), [])
+
+    async def test_filter_returns_identifiers_of_spec(self):
+        conf_agg_set = self._configure(CONFIGURABLE_SETS)
+        _filter = await conf_agg_set.filter('humanities')
+        self.assertCountEqual(_filter[Study._aggregator_identifier]['$in'], ['id_2', 'id_3', 'id_4'])
+
+    async def test_filter_returns_sorted_identifiers_built_once(self):
+        conf_agg_set = self._configure(CONFIGURABLE_SETS)
+        first = await conf_agg_set.filter('humanities')
+        second = await conf_agg_set.filter('humanities')
+        self.assertEqual(first[Study._aggregator_identifier]['$in'], ['id_2', 'id_3', 'id_4'])
+        self.assertIs(first[Study._aggregator_identifier]['$in'], second[Study._aggregator_identifier]['$in'])
+
+    async def test_filter_returns_empty_list_for_unknown_spec(self):
+        conf_agg_set = self._configure(CONFIGURABLE_SETS)
+        _filter = await conf_agg_set.filter('unknown')
+        self.assertEqual(_filter[Study._aggregator_identifier]['$in'], [])
+
+    async def test_filter_returns_all_identifiers_if_value_is_None(self):
+        conf_agg_set = self._configure(CONFIGURABLE_SETS)
+        _filter = await conf_agg_set.filter(None)
+        self.assertCountEqual(_filter[Study._aggregator_identifier]['$in'], ['id_1', 'id_2', 'id_3', 'id_4'])
+
+    async def test_filter_accepts_identifiers_of_mixed_types(self):
+        conf_agg_set = self._configure(CONFIGURABLE_SETS.replace('- id_4', '- 4'))
+        _filter = await conf_agg_set.filter(None)
+        self.assertEqual(_filter[Study._aggregator_identifier]['$in'], [4, 'id_1', 'id_2', 'id_3'])
+
+    async def test_query_calls_on_set_cb(self):
+        conf_agg_set = self._configure(CONFIGURABLE_SETS)
+        mock_on_set_cb = mock.AsyncMock()
+        await conf_agg_set.query(mock_on_set_cb)
+        self.assertEqual(mock_on_set_cb.call_args_list, [
+            mock.call('thematic', name='Thematic', description='Thematic grouping of records'),
+            mock.call('thematic:social_sciences', name='Social sciences', description='Studies in social sciences'),
+            mock.call('thematic:humanities', name='Humanities', description='Studies in humanities')])
+
+    async def test_reload_replaces_index_if_file_changed(self):
+        conf_agg_set = self._configure(CONFIGURABLE_SETS)
+        old_index = await conf_agg_set._get_index()
+        self._rewrite(CONFIGURABLE_SETS.replace('- id_4', '- id_5'))
+        await metadataformats.ConfigurableAggMDSet._reload()
+        new_index = await conf_agg_set._get_index()
+        self.assertIsNot(new_index, old_index)
+        self.assertEqual(new_index.identifiers_by_spec['humanities'], frozenset(['id_2', 'id_3', 'id_5']))
+
+    async def test_query_serves_sets_from_list_sets_cache(self):
+        conf_agg_set = self._configure(CONFIGURABLE_SETS)
+        self.addCleanup(metadataformats._LIST_SETS_CACHE.invalidate)
+        self.addCleanup(setattr, metadataformats._LIST_SETS_CACHE, 'ttl', 0)
+        metadataformats._LIST_SETS_CACHE.ttl = 60
+        await conf_agg_set.query(mock.AsyncMock())
+        mock_on_set_cb = mock.AsyncMock()
+        with mock.patch.object(metadataformats.ConfigurableAggMDSet, '_get_index') as mock_get_index:
+            await conf_agg_set.query(mock_on_set_cb)
+        mock_get_index.assert_not_called()
+        self.assertEqual(mock_on_set_cb.call_count, 3)
+
+    async def test_reload_invalidates_list_sets_cache(self):
+        conf_agg_set = self._configure(CONFIGURABLE_SETS)
+        self.addCleanup(setattr, metadataformats._LIST_SETS_CACHE, 'ttl', 0)
+        metadataformats._LIST_SETS_CACHE.ttl = 60
+        await conf_agg_set.query(mock.AsyncMock())
+        self._rewrite(CONFIGURABLE_SETS.replace("name: 'Humanities'", "name: 'Arts'"))
+        await metadataformats.ConfigurableAggMDSet._reload()
+        mock_on_set_cb = mock.AsyncMock()
+        await conf_agg_set.query(mock_on_set_cb)
+        mock_on_set_cb.assert_called_with('thematic:humanities', name='Arts', description='Studies in humanities')
+
+    async def test_reload_keeps_index_if_file_not_changed(self):
+        conf_agg_set = self._configure(CONFIGURABLE_SETS)
+        old_index = await conf_agg_set._get_index()
+        await metadataformats.ConfigurableAggMDSet._reload()
+        self.assertIs(await conf_agg_set._get_index(), old_index)
+
+    async def test_reload_keeps_index_if_file_is_invalid(self):
+        conf_agg_set = self._configure(CONFIGURABLE_SETS)
+        old_index = await conf_agg_set._get_index()
+        self._rewrite("spec: 'thematic'\nname: 'Thematic'\nnodes:\n  - spec: 'social_sciences'\n")
+        with self.assertLogs(metadataformats._logger, level='ERROR'):
+            await metadataformats.ConfigurableAggMDSet._reload()
+        self.assertIs(await conf_agg_set._get_index(), old_index)
+
+    async def test_reload_keeps_index_if_top_level_spec_changes(self):
+        conf_agg_set = self._configure(CONFIGURABLE_SETS)
+        old_index = await conf_agg_set._get_index()
+        self._rewrite(CONFIGURABLE_SETS.replace("spec: 'thematic'", "spec: 'other'"))
+        with self.assertLogs(metadataformats._logger, level='ERROR'):
+            await metadataformats.ConfigurableAggMDSet._reload()
+        self.assertIs(await conf_agg_set._get_index(), old_index)
+        self.assertEqual(metadataformats.ConfigurableAggMDSet.spec, 'thematic')
+
+    async def test_reload_detects_changes_in_external_files(self):
+        with NamedTemporaryFile(mode='w', delete=False) as extfile:
+            extfile.write("spec: 'history'\nname: 'History'\nidentifiers:\n- id_5\n")
+        conf_agg_set = self._configure(CONFIGURABLE_SETS.replace(
+            "  - spec: 'humanities'", "  - path: '%s'\n  - spec: 'humanities'" % (extfile.name,)))
+        self.assertIn(extfile.name, metadataformats.ConfigurableAggMDSet._mtimes)
+        self._filepath = extfile.name
+        self._rewrite("spec: 'history'\nname: 'History'\nidentifiers:\n- id_7\n")
+        await metadataformats.ConfigurableAggMDSet._reload()
+        index = await conf_agg_set._get_index()
+        self.assertEqual(index.identifiers_by_spec['history'], frozenset(['id_7']))
+
+    async def test_get_index_schedules_reload_once_per_interval(self):
+        conf_agg_set = self._configure(CONFIGURABLE_SETS, reload_interval=60)
+        with mock.patch.object(metadataformats.ConfigurableAggMDSet, '_reload') as mock_reload, \
+                mock.patch.object(metadataformats.time, 'monotonic') as mock_monotonic:
+            mock_monotonic.return_value = metadataformats.ConfigurableAggMDSet._last_reload_check + 30
+            await conf_agg_set._get_index()
+            mock_reload.assert_not_called()
+            mock_monotonic.return_value = metadataformats.ConfigurableAggMDSet._last_reload_check + 60
+            await conf_agg_set._get_index()
+            await conf_agg_set._get_index()
+            mock_reload.assert_called_once_with()
+
+    async def test_query_schedules_reload_if_sets_are_cached(self):
+        conf_agg_set = self._configure(CONFIGURABLE_SETS, reload_interval=60)
+        self.addCleanup(metadataformats._LIST_SETS_CACHE.invalidate)
+        self.addCleanup(setattr, metadataformats._LIST_SETS_CACHE, 'ttl', 0)
+        metadataformats._LIST_SETS_CACHE.ttl = 60
+        await conf_agg_set.query(mock.AsyncMock())
+        with mock.patch.object(metadataformats.ConfigurableAggMDSet, '_reload') as mock_reload, \
+                mock.patch.object(metadataformats.ConfigurableAggMDSet, '_get_index') as mock_get_index, \
+                mock.patch.object(metadataformats.time, 'monotonic') as mock_monotonic:
+            mock_monotonic.return_value = metadataformats.ConfigurableAggMDSet._last_reload_check + 60
+            await conf_agg_set.query(mock.AsyncMock())
+        mock_get_index.assert_not_called()
+        mock_reload.assert_called_once_with()
+
+    async def test_get_index_does_not_schedule_reload_if_interval_is_zero(self):
+        conf_agg_set = self._configure(CONFIGURABLE_SETS)
+        with mock.patch.object(metadataformats.ConfigurableAggMDSet, '_reload') as mock_reload, \
+                mock.patch.object(metadataformats.time, 'monotonic') as mock_monotonic:
+            mock_monotonic.return_value = metadataformats.ConfigurableAggMDSet._last_reload_check + 10**6
+            await conf_agg_set._get_index()
+        mock_reload.assert_not_called()
 
 
 class TestSourceAggMDSet(TestCase):
 
     def tearDown(self):
         metadataformats.SourceAggMDSet._source_defs = None
+        metadataformats.SourceAggMDSet._defs_by_url = None
+        metadataformats.SourceAggMDSet._url_by_source = None
         super().tearDown()
 
     def test_add_cli_args(self):
@@ -317,6 +839,33 @@ class TestSourceAggMDSet(TestCase):
             metadataformats.SourceAggMDSet.configure(settings)
         self.assertEqual(metadataformats.SourceAggMDSet._source_defs, [])
 
+    def test_configure_builds_lookup_tables(self):
+        with NamedTemporaryFile(mode='w', delete=False) as somefile:
+            somefile.write(SOURCES)
+            somefile.close()
+            metadataformats.SourceAggMDSet.configure(Namespace(oai_set_sources_path=somefile.name))
+        self.assertEqual(metadataformats.SourceAggMDSet._defs_by_url, {
+            'http://some.url': ('some source', 'some source name', 'some source desc'),
+            'http://another.url': ('another source', 'another source name', None)})
+        self.assertEqual(metadataformats.SourceAggMDSet._url_by_source, {
+            'some source': 'http://some.url',
+            'another source': 'http://another.url'})
+
+    def _assert_configure_raises_InvalidMappingConfig(self, filecontent):
+        with NamedTemporaryFile(mode='w', delete=False) as somefile:
+            somefile.write(filecontent)
+            somefile.close()
+            settings = Namespace(oai_set_sources_path=somefile.name)
+            with self.assertRaises(metadataformats.InvalidMappingConfig):
+                metadataformats.SourceAggMDSet.configure(settings)
+
+    def test_configure_raises_for_duplicate_url(self):
+        self._assert_configure_raises_InvalidMappingConfig(SOURCES.replace('http://another.url', 'http://some.url'))
+
+    def test_configure_raises_for_duplicate_source(self):
+        self._assert_configure_raises_InvalidMappingConfig(
+            SOURCES.replace("source: 'another source'", "source: 'some source'"))
+
 
 class TestSourceAggMDSetWithYAMLFile(testcasebase(IsolatedAsyncioTestCase)):
 
@@ -330,6 +879,8 @@ class TestSourceAggMDSetWithYAMLFile(testcasebase(IsolatedAsyncioTestCase)):
 
     def tearDown(self):
         metadataformats.SourceAggMDSet._source_defs = None
+        metadataformats.SourceAggMDSet._defs_by_url = None
+        metadataformats.SourceAggMDSet._url_by_source = None
         self._sourcesfile.close()
         super().tearDown()
 
@@ -353,6 +904,13 @@ class TestSourceAggMDSetWithYAMLFile(testcasebase(IsolatedAsyncioTestCase)):
         result = await source_set.get(study)
         self.assertEqual(result, [])
 
+    async def test_filter_returns_url_of_source(self):
+        source_set = metadataformats.SourceAggMDSet(mock.Mock(study_class=Study))
+        result = await source_set.filter('another source')
+        self.assertEqual(result, {Study._provenance: {'$elemMatch': {
+            Study._provenance.attr_base_url: 'http://another.url',
+            Study._provenance.attr_direct: True}}})
+
     async def test_query_calls_param(self):
         # Mock & format
         mock_query_distinct = self._init_patcher(mock.patch(
@@ -378,3 +936,88 @@ class TestSourceAggMDSetWithYAMLFile(testcasebase(IsolatedAsyncioTestCase)):
             self.assertIn(cargs[0], exp_calls)
             exp_ckwargs = exp_calls.pop(cargs[0])
             self.assertEqual(ckwargs, exp_ckwargs)
+
+    async def test_query_serves_sets_from_list_sets_cache(self):
+        mock_query_distinct = self._init_patcher(mock.patch(
+            'kuha_common.query.QueryController.query_distinct'))
+        mock_query_distinct.return_value = {'_provenance.base_url': ['http://some.url']}
+        self.addCleanup(metadataformats._LIST_SETS_CACHE.invalidate)
+        self.addCleanup(setattr, metadataformats._LIST_SETS_CACHE, 'ttl', 0)
+        metadataformats._LIST_SETS_CACHE.ttl = 60
+        source_set = metadataformats.SourceAggMDSet(mock.Mock(study_class=Study, corr_id_header={}))
+        await source_set.query(mock.AsyncMock())
+        mock_on_set_cb = mock.AsyncMock()
+        await source_set.query(mock_on_set_cb)
+        mock_query_distinct.assert_called_once()
+        self.assertEqual(mock_on_set_cb.call_count, 2)
+
+
+class TestGetRecordBatching(CDCAggOAIHTTPTestBase):
+
+    def setUp(self):
+        super().setUp()
+        self._mock_query_single = self._init_patcher(mock.patch(
+            'kuha_common.query.QueryController.query_single'))
+        self._mock_query_multiple = self._init_patcher(mock.patch(
+            'kuha_common.query.QueryController.query_multiple'))
+        self._mock_query_multiple.side_effect = TestGetRecordBatcher._query_multiple
+        self._init_patcher(mock.patch.object(metadataformats, 'observe_get_record_batch_size'))
+        self._init_patcher(mock.patch.object(metadataformats._GET_RECORD_BATCHER, 'window', 0.01))
+        self._init_patcher(mock.patch.object(metadataformats._GET_RECORD_BATCHER, 'max_size', 10))
+
+    def _get_record(self, identifier, mdprefix='oai_dc'):
+        return self.http_client.fetch(self.get_url(
+            '/v0/oai?verb=GetRecord&metadataPrefix=%s&identifier=%s' % (mdprefix, identifier)))
+
+    @gen_test
+    async def test_concurrent_get_records_share_document_store_query(self):
+        responses = await asyncio.gather(self._get_record('agg_id_1'), self._get_record('agg_id_2'),
+                                         self._get_record('agg_id_1'))
+        self._mock_query_multiple.assert_called_once()
+        self._mock_query_single.assert_not_called()
+        xmlns = {'oai': 'http://www.openarchives.org/OAI/2.0/'}
+        for resp, identifier in zip(responses, ('agg_id_1', 'agg_id_2', 'agg_id_1')):
+            header_el = ElementTree.fromstring(resp.body).find('./oai:GetRecord/oai:record/oai:header', xmlns)
+            self.assertTrue(header_el.find('./oai:identifier', xmlns).text.endswith(':' + identifier))
+
+    @gen_test
+    async def test_loads_cached_metadata_of_record_before_rendering(self):
+        mock_load_fragment = self._init_patcher(mock.patch.object(metadataformats.serializers, 'load_fragment'))
+        await self._get_record('agg_id_1')
+        mock_load_fragment.assert_awaited_once()
+        self.assertEqual(mock_load_fragment.call_args[0][0], 'oai_dc')
+
+    @gen_test
+    async def test_get_records_of_different_prefixes_are_queried_separately(self):
+        await asyncio.gather(self._get_record('agg_id_1'), self._get_record('agg_id_1', mdprefix='oai_ddi25'))
+        self.assertEqual(self._mock_query_multiple.call_count, 2)
+        self._mock_query_single.assert_not_called()
+
+    @gen_test
+    async def test_batched_query_fetches_same_fields_as_single_lookup(self):
+        for mdprefix in ('oai_dc', 'oai_ddi25', 'oai_datacite'):
+            with self.subTest(mdprefix=mdprefix):
+                with mock.patch.object(metadataformats._GET_RECORD_BATCHER, 'window', 0):
+                    await self._get_record('agg_id_1', mdprefix=mdprefix)
+                await self._get_record('agg_id_1', mdprefix=mdprefix)
+                self.assertCountEqual(self._mock_query_multiple.call_args[1]['fields'],
+                                      self._mock_query_single.call_args[1]['fields'])
+
+    @gen_test
+    async def test_datacite_record_without_preferred_identifier_does_not_exist(self):
+        async def _query_single(study_class, on_record, **kwargs):
+            await on_record(_study('agg_id_1'))
+        self._mock_query_single.side_effect = _query_single
+        resp = await self._get_record('agg_id_1', mdprefix='oai_datacite')
+        self._mock_query_multiple.assert_called_once()
+        self._mock_query_single.assert_called_once()
+        xmlns = {'oai': 'http://www.openarchives.org/OAI/2.0/'}
+        xml = ElementTree.fromstring(resp.body)
+        self.assertIsNone(xml.find('./oai:GetRecord', xmlns))
+        self.assertEqual(xml.find('./oai:error', xmlns).get('code'), 'idDoesNotExist')
+
+    @gen_test
+    async def test_missing_record_is_looked_up_by_kuha(self):
+        await self._get_record('missing')
+        self._mock_query_multiple.assert_called_once()
+        self._mock_query_single.assert_called_once()
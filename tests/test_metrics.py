@@ -1,5 +1,8 @@
 """Test /metrics endpoint & module internals
 """
+import os
+import tempfile
+from argparse import Namespace
 from unittest import mock, TestCase
 from cdcagg_common import Study
 from cdcagg_oai import metrics
@@ -14,43 +17,46 @@ from . import CDCAggOAIHTTPTestBase
 class TestMetricsEndpoint(CDCAggOAIHTTPTestBase):
     """Test /metrics endpoint with HTTP Requests"""
 
-    maxDiff = None
-
     def setUp(self):
         super().setUp()
+        self._init_patcher(mock.patch.object(metrics._REFRESHER, "count_concurrency", 2))
+        self._init_patcher(mock.patch.object(metrics._REFRESHER, "_refreshed_at", None))
         self._mock_query_distinct = self._init_patcher(mock.patch("kuha_common.query.QueryController.query_distinct"))
         self._mock_query_count = self._init_patcher(mock.patch("kuha_common.query.QueryController.query_count"))
+        self._mock_query_distinct.return_value = {"_direct_base_url": []}
+        self._counts = {}
+
+        async def _query_count(record, _filter=None):
+            if _filter is None:
+                return self._counts.get("total", 0)
+            if "$and" in _filter:
+                result = self._counts.get(_filter["$and"][0][Study._direct_base_url], (0, 0))[1]
+            elif Study._direct_base_url in _filter:
+                result = self._counts.get(_filter[Study._direct_base_url], (0, 0))[0]
+            else:
+                result = self._counts.get("total_without_deleted", 0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        self._mock_query_count.side_effect = _query_count
+
+    def _fetch_resp_body_lines(self, counts):
+        self._counts = counts
+        self._mock_query_distinct.return_value = {
+            "_direct_base_url": [key for key in counts if key not in ("total", "total_without_deleted")]
+        }
+        return self.fetch("/metrics").body.decode("utf8").split("\n")
 
-    def _fetch_resp_body_lines(self):
-        resp = self.fetch("/metrics")
-        return resp.body.decode("utf8").split("\n")
-
-    def test_calls_query_count_twice_if_there_is_no_base_url(self):
-        self.fetch("/metrics")
-        self.assertEqual(self._mock_query_count.call_count, 2)
-        self._mock_query_count.assert_has_awaits(
-            [
-                mock.call(Study),
-                mock.call(
-                    Study,
-                    _filter={Study._metadata.attr_status: {"$ne": "deleted"}},
-                ),
-            ],
-            any_order=False,
+    def test_calls_query_count_twice_per_base_url(self):
+        self._fetch_resp_body_lines(
+            {"some.base.url": (1, 1), "another.base.url": (1, 1), "third.base.url": (1, 1)}
         )
-
-    def test_calls_query_count_four_times_if_there_is_single_base_url(self):
-        self._mock_query_distinct.return_value = {"_direct_base_url": ["some.base.url"]}
-        self._mock_query_count.return_value = 1
-        self.fetch("/metrics")
-        self.assertEqual(self._mock_query_count.call_count, 4)
+        self.assertEqual(self._mock_query_count.call_count, 8)
         self._mock_query_count.assert_has_awaits(
             [
                 mock.call(Study),
-                mock.call(
-                    Study,
-                    _filter={Study._metadata.attr_status: {"$ne": "deleted"}},
-                ),
+                mock.call(Study, _filter={Study._metadata.attr_status: {"$ne": "deleted"}}),
                 mock.call(Study, _filter={Study._direct_base_url: "some.base.url"}),
                 mock.call(
                     Study,
@@ -62,46 +68,54 @@ class TestMetricsEndpoint(CDCAggOAIHTTPTestBase):
                     },
                 ),
             ],
-            any_order=False,
+            any_order=True,
         )
 
-    def test_calls_query_count_eight_times_if_there_is_three_base_urls(self):
-        self._mock_query_distinct.return_value = {
-            "_direct_base_url": ["some.base.url", "another.base.url", "third.base.url"]
-        }
-        self._mock_query_count.return_value = 1
-        self.fetch("/metrics")
-        self.assertEqual(self._mock_query_count.call_count, 8)
-
-    def test_returns_records_total(self):
-        self._mock_query_count.side_effect = [10, 1]
-        self.assertIn("records_total 10.0", self._fetch_resp_body_lines())
-
-    def test_returns_records_total_without_deleted(self):
-        self._mock_query_count.side_effect = [10, 2]
-        self.assertIn("records_total_without_deleted 2.0", self._fetch_resp_body_lines())
-
-    def test_returns_publishers_total(self):
-        self._mock_query_distinct.return_value = {"_direct_base_url": ["some.base.url"]}
-        self._mock_query_count.return_value = 1
-        self.assertIn("publishers_total 1.0", self._fetch_resp_body_lines())
-
-    def test_returns_publishers_total_is_zero_if_count_query_returns_0(self):
-        self._mock_query_distinct.return_value = {"_direct_base_url": ["some.base.url"]}
-        self._mock_query_count.side_effect = [1, 1, 0]
-        self.assertIn("publishers_total 0.0", self._fetch_resp_body_lines())
+    def test_returns_records_totals(self):
+        lines = self._fetch_resp_body_lines({"total": 10, "total_without_deleted": 2})
+        self.assertIn("records_total 10.0", lines)
+        self.assertIn("records_total_without_deleted 2.0", lines)
 
     def test_returns_publishers_counts(self):
-        self._mock_query_distinct.return_value = {"_direct_base_url": ["some.base.url"]}
-        self._mock_query_count.side_effect = [1, 1, 20, 0]
-        self.assertIn('publishers_counts{publisher="some.base.url"} 20.0', self._fetch_resp_body_lines())
-
-    def test_returns_publishers_counts_without_deleted(self):
-        self._mock_query_distinct.return_value = {"_direct_base_url": ["some.base.url"]}
-        self._mock_query_count.side_effect = [1, 1, 1, 30]
-        self.assertIn(
-            'publishers_counts_without_deleted{publisher="some.base.url"} 30.0', self._fetch_resp_body_lines()
+        lines = self._fetch_resp_body_lines({"some.base.url": (20, 15), "another.base.url": (0, 0)})
+        self.assertIn("publishers_total 1.0", lines)
+        self.assertIn('publishers_counts{publisher="some.base.url"} 20.0', lines)
+        self.assertIn('publishers_counts_without_deleted{publisher="some.base.url"} 15.0', lines)
+
+    def test_reports_failed_publisher_and_returns_others(self):
+        failures = metrics._METRICS["publishers_counts_failures"].labels(publisher="failing.base.url")
+        failures_before = failures._value.get()
+        lines = self._fetch_resp_body_lines(
+            {"some.base.url": (20, 15), "failing.base.url": (ValueError("timeout"), 0)}
         )
+        self.assertIn("publishers_total 1.0", lines)
+        self.assertIn('publishers_counts{publisher="some.base.url"} 20.0', lines)
+        self.assertEqual(failures._value.get(), failures_before + 1)
+
+    def test_queries_docstore_on_every_request_by_default(self):
+        self.fetch("/metrics")
+        self.fetch("/metrics")
+        self.assertEqual(self._mock_query_distinct.call_count, 2)
+
+    def test_does_not_query_docstore_if_metrics_are_not_stale(self):
+        self._init_patcher(mock.patch.object(metrics._REFRESHER, "max_age", 60))
+        self.fetch("/metrics")
+        lines = self._fetch_resp_body_lines({"total": 10})
+        self.assertEqual(self._mock_query_distinct.call_count, 1)
+        self.assertIn("records_total 0.0", lines)
+
+    def test_does_not_query_docstore_if_another_worker_refreshed_metrics(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "records_refreshed")
+        self._init_patcher(mock.patch.object(metrics._REFRESHER, "max_age", 60))
+        self._init_patcher(mock.patch.object(metrics._REFRESHER, "shared_refresh_path", path))
+        self.fetch("/metrics")
+        self.assertTrue(os.path.exists(path))
+        # Metrics refreshed by another worker process are not stale.
+        self._init_patcher(mock.patch.object(metrics._REFRESHER, "_refreshed_at", None))
+        self.fetch("/metrics")
+        self.assertEqual(self._mock_query_distinct.call_count, 1)
 
 
 # ################################### #
@@ -214,6 +228,19 @@ class TestInitializeMetricsRegistry(TestCase):
             ]
         )
 
+    @mock.patch.object(metrics, "CollectorRegistry")
+    @mock.patch.object(metrics, "_MultiProcessCollector")
+    @mock.patch.object(metrics.os, "environ", new={"PROMETHEUS_MULTIPROC_DIR": "/some/dir"})
+    @mock.patch.object(metrics._REFRESHER, "shared_refresh_path", "/some/dir/records_refreshed")
+    def test_shares_Gauges_between_workers_if_refresh_is_shared(
+        self, mock_MultiProcessCollector, mock_CollectorRegistry, mock_Gauge
+    ):
+        metrics._initialize_metrics_registry()
+        self.assertEqual(mock_Gauge.call_count, 5)
+        for call in mock_Gauge.call_args_list:
+            with self.subTest(gauge=call.args[0]):
+                self.assertEqual(call.kwargs, {"multiprocess_mode": "mostrecent", "registry": None})
+
     @mock.patch.object(metrics.os, "environ", new={})
     def test_passes_correct_args_to_Gauges_if_environ_does_not_have_PROMETHEUS_MULTIPROC_DIR(self, mock_Gauge):
         metrics._initialize_metrics_registry()
@@ -251,6 +278,121 @@ class TestInitializeMetricsRegistry(TestCase):
         )
 
 
+class TestRecordsGaugesRefresher(TestCase):
+    def setUp(self):
+        super().setUp()
+        self._refresher = metrics._RecordsGaugesRefresher()
+
+    def test_configure_sets_interval_and_max_age(self):
+        self._refresher.configure(10, 20)
+        self.assertEqual(self._refresher.interval, 10)
+        self.assertEqual(self._refresher.max_age, 20)
+
+    @mock.patch.object(metrics._REFRESHER, "configure")
+    def test_module_configure_bounds_count_concurrency_by_docstore_max_clients(self, mock_configure):
+        metrics.configure(
+            Namespace(
+                metrics_refresh_interval=1,
+                metrics_max_age=2,
+                metrics_count_concurrency=20,
+                document_store_client_max_clients=5,
+                workers=1,
+            )
+        )
+        mock_configure.assert_called_once_with(1, 2, count_concurrency=5, shared_refresh_path=None)
+
+    @mock.patch.object(metrics.os, "environ", new={"PROMETHEUS_MULTIPROC_DIR": "/some/dir"})
+    @mock.patch.object(metrics._REFRESHER, "configure")
+    def test_module_configure_shares_refresh_between_workers(self, mock_configure):
+        metrics.configure(
+            Namespace(
+                metrics_refresh_interval=1,
+                metrics_max_age=2,
+                metrics_count_concurrency=1,
+                document_store_client_max_clients=5,
+                workers=2,
+            )
+        )
+        mock_configure.assert_called_once_with(
+            1, 2, count_concurrency=1, shared_refresh_path=os.path.join("/some/dir", "records_refreshed")
+        )
+
+    @mock.patch.object(metrics._REFRESHER, "configure")
+    def test_module_configure_raises_ValueError_if_max_age_is_less_than_interval(self, mock_configure):
+        for max_age in (0, 5):
+            with self.subTest(max_age=max_age), self.assertRaises(ValueError):
+                metrics.configure(
+                    Namespace(
+                        metrics_refresh_interval=10,
+                        metrics_max_age=max_age,
+                        metrics_count_concurrency=1,
+                        document_store_client_max_clients=5,
+                        workers=1,
+                    )
+                )
+        mock_configure.assert_not_called()
+
+    def test_is_stale_if_never_refreshed(self):
+        self._refresher.configure(0, 60)
+        self.assertTrue(self._refresher.is_stale())
+
+    @mock.patch.object(metrics.time, "monotonic")
+    def test_is_stale_depends_on_max_age(self, mock_monotonic):
+        self._refresher.configure(0, 60)
+        self._refresher._refreshed_at = 100
+        mock_monotonic.return_value = 159
+        self.assertFalse(self._refresher.is_stale())
+        mock_monotonic.return_value = 160
+        self.assertTrue(self._refresher.is_stale())
+
+    def test_is_stale_if_shared_refresh_file_does_not_exist(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self._refresher.configure(0, 60, shared_refresh_path=os.path.join(directory, "records_refreshed"))
+            self.assertTrue(self._refresher.is_stale())
+
+    @mock.patch.object(metrics.time, "time")
+    def test_is_stale_depends_on_shared_refresh_time(self, mock_time):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "records_refreshed")
+            self._refresher.configure(0, 60, shared_refresh_path=path)
+            open(path, "w", encoding="utf-8").close()
+            os.utime(path, (100, 100))
+            mock_time.return_value = 159
+            self.assertFalse(self._refresher.is_stale())
+            mock_time.return_value = 160
+            self.assertTrue(self._refresher.is_stale())
+
+    @mock.patch.object(metrics, "PeriodicCallback")
+    def test_start_does_nothing_if_interval_is_zero(self, mock_PeriodicCallback):
+        self._refresher.configure(0, 0)
+        self._refresher.start()
+        mock_PeriodicCallback.assert_not_called()
+
+    @mock.patch.object(metrics, "IOLoop")
+    @mock.patch.object(metrics, "PeriodicCallback")
+    def test_start_starts_periodic_callback_once(self, mock_PeriodicCallback, mock_IOLoop):
+        self._refresher.configure(15, 0)
+        self._refresher.start()
+        self._refresher.start()
+        mock_PeriodicCallback.assert_called_once_with(self._refresher._refresh_in_background, 15000)
+        mock_PeriodicCallback.return_value.start.assert_called_once_with()
+
+    @mock.patch.object(metrics, "IOLoop")
+    @mock.patch.object(metrics, "PeriodicCallback")
+    def test_start_schedules_immediate_refresh(self, mock_PeriodicCallback, mock_IOLoop):
+        self._refresher.configure(15, 0)
+        self._refresher.start()
+        mock_IOLoop.current.return_value.add_callback.assert_called_once_with(self._refresher._refresh_in_background)
+
+    @mock.patch.object(metrics, "IOLoop")
+    @mock.patch.object(metrics, "PeriodicCallback")
+    def test_stop_stops_periodic_callback(self, mock_PeriodicCallback, mock_IOLoop):
+        self._refresher.configure(15, 0)
+        self._refresher.start()
+        self._refresher.stop()
+        mock_PeriodicCallback.return_value.stop.assert_called_once_with()
+
+
 class TestCDCAggWebApp(TestCase):
     def setUp(self):
         super().setUp()
@@ -285,3 +427,25 @@ class TestCDCAggWebApp(TestCase):
                 app.log_request(mock_handler)
                 mock_requests_failed_metric.inc.assert_called_once_with()
             mock_requests_failed_metric.reset_mock()
+
+    @mock.patch.object(metrics.server.WebApplication, "log_request")
+    def test_log_request_increments_requests_succeeded_for_not_modified(self, mock_log_request):
+        mock_handler = mock.Mock(oai_protocol=None)
+        metrics.CDCAggWebApp.set_oai_route_handler_class(mock_handler.__class__)
+        app = metrics.CDCAggWebApp()
+        mock_requests_succeeded_metric = mock.Mock()
+        metrics._METRICS["requests_succeeded"] = mock_requests_succeeded_metric
+        mock_handler.get_status.return_value = 304
+        app.log_request(mock_handler)
+        mock_requests_succeeded_metric.inc.assert_called_once_with()
+
+    @mock.patch.object(metrics.server.WebApplication, "log_request")
+    def test_log_request_increments_requests_succeeded_for_shared_response(self, mock_log_request):
+        mock_handler = mock.Mock(oai_protocol=None, shared_response=True)
+        metrics.CDCAggWebApp.set_oai_route_handler_class(mock_handler.__class__)
+        app = metrics.CDCAggWebApp()
+        mock_requests_succeeded_metric = mock.Mock()
+        metrics._METRICS["requests_succeeded"] = mock_requests_succeeded_metric
+        mock_handler.get_status.return_value = 200
+        app.log_request(mock_handler)
+        mock_requests_succeeded_metric.inc.assert_called_once_with()
@@ -0,0 +1,216 @@
+# Copyright CESSDA ERIC 2021-2025
+#
+# Licensed under the EUPL, Version 1.2 (the "License"); you may not
+# use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import signal
+import asyncio
+from unittest import mock, TestCase, IsolatedAsyncioTestCase
+
+from cdcagg_oai import prefork
+
+
+@mock.patch.object(prefork.os, 'execv')
+class TestEnsureMultiprocessMetricsDir(TestCase):
+
+    @mock.patch.dict(os.environ, {prefork.MULTIPROC_DIR_ENV: '/some/dir'})
+    def test_keeps_configured_dir(self, mock_execv):
+        prefork.ensure_multiprocess_metrics_dir()
+        mock_execv.assert_not_called()
+        self.assertEqual(os.environ[prefork.MULTIPROC_DIR_ENV], '/some/dir')
+
+    @mock.patch.dict(os.environ, {}, clear=True)
+    @mock.patch.object(prefork.tempfile, 'mkdtemp', return_value='/tmp/some_dir')
+    @mock.patch.object(prefork.sys, 'argv', ['cdcagg_oai', '--workers', '2'])
+    def test_executes_again_with_temporary_dir(self, mock_mkdtemp, mock_execv):
+        prefork.ensure_multiprocess_metrics_dir()
+        self.assertEqual(os.environ[prefork.MULTIPROC_DIR_ENV], '/tmp/some_dir')
+        self.assertEqual(os.environ[prefork.TEMPORARY_MULTIPROC_DIR_ENV], '/tmp/some_dir')
+        mock_execv.assert_called_once_with(sys.executable, [sys.executable, '-m', 'cdcagg_oai', '--workers', '2'])
+
+
+@mock.patch.object(prefork.shutil, 'rmtree')
+class TestRemoveTemporaryMultiprocessMetricsDir(TestCase):
+
+    @mock.patch.dict(os.environ, {prefork.MULTIPROC_DIR_ENV: '/tmp/some_dir',
+                                  prefork.TEMPORARY_MULTIPROC_DIR_ENV: '/tmp/some_dir'})
+    def test_removes_temporary_dir(self, mock_rmtree):
+        prefork._remove_temporary_multiprocess_metrics_dir()
+        mock_rmtree.assert_called_once_with('/tmp/some_dir', ignore_errors=True)
+
+    @mock.patch.dict(os.environ, {prefork.MULTIPROC_DIR_ENV: '/some/dir'}, clear=True)
+    def test_keeps_configured_dir(self, mock_rmtree):
+        prefork._remove_temporary_multiprocess_metrics_dir()
+        mock_rmtree.assert_not_called()
+
+    @mock.patch.dict(os.environ, {prefork.MULTIPROC_DIR_ENV: '/some/dir',
+                                  prefork.TEMPORARY_MULTIPROC_DIR_ENV: '/tmp/some_dir'})
+    def test_keeps_dir_configured_after_temporary_dir(self, mock_rmtree):
+        prefork._remove_temporary_multiprocess_metrics_dir()
+        mock_rmtree.assert_not_called()
+
+
+@mock.patch.object(prefork.time, 'sleep')
+@mock.patch.object(prefork.signal, 'signal')
+@mock.patch.object(prefork.os, 'kill')
+@mock.patch.object(prefork.os, 'waitpid')
+@mock.patch.object(prefork.os, 'fork')
+class TestSupervisor(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(prefork.time, 'monotonic', return_value=0)
+        self._mock_monotonic = patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+
+    def test_returns_true_in_worker_process(self, mock_fork, mock_waitpid, mock_kill, mock_signal, mock_sleep):
+        mock_fork.return_value = 0
+        self.assertTrue(prefork._Supervisor(2).run())
+        mock_fork.assert_called_once_with()
+
+    def test_replaces_exited_worker(self, mock_fork, mock_waitpid, mock_kill, mock_signal, mock_sleep):
+        mock_fork.side_effect = [1, 2, 0]
+        mock_waitpid.side_effect = [(1, 9 << 8), (0, 0)]
+        # Worker 1 exits after running for the minimum lifetime.
+        self._mock_monotonic.side_effect = [0, 0, prefork._MIN_WORKER_LIFETIME]
+        with self.assertLogs(prefork._logger, level='WARNING'):
+            self.assertTrue(prefork._Supervisor(2).run())
+        self.assertEqual(mock_fork.call_count, 3)
+
+    def test_stops_workers_when_worker_exits_on_startup(self, mock_fork, mock_waitpid, mock_kill, mock_signal,
+                                                        mock_sleep):
+        mock_fork.side_effect = [1, 2]
+        mock_waitpid.side_effect = [(1, 1 << 8), (0, 0), (2, 0)]
+        supervisor = prefork._Supervisor(2)
+        with self.assertLogs(prefork._logger, level='ERROR'):
+            self.assertFalse(supervisor.run())
+        self.assertTrue(supervisor.failed)
+        mock_kill.assert_called_once_with(2, signal.SIGTERM)
+        self.assertEqual(mock_fork.call_count, 2)
+
+    @mock.patch.object(prefork, '_WORKER_INDEX', None)
+    def test_sets_worker_index_in_worker_process(self, mock_fork, mock_waitpid, mock_kill, mock_signal, mock_sleep):
+        mock_fork.side_effect = [1, 0]
+        self.assertTrue(prefork._Supervisor(2).run())
+        self.assertEqual(prefork.worker_index(), 1)
+        self.assertFalse(prefork.is_primary_process())
+
+    @mock.patch.object(prefork, '_WORKER_INDEX', None)
+    def test_replaced_worker_keeps_index(self, mock_fork, mock_waitpid, mock_kill, mock_signal, mock_sleep):
+        mock_fork.side_effect = [1, 2, 0]
+        mock_waitpid.side_effect = [(1, 0), (0, 0)]
+        self._mock_monotonic.side_effect = [0, 0, prefork._MIN_WORKER_LIFETIME]
+        self.assertTrue(prefork._Supervisor(2).run())
+        self.assertEqual(prefork.worker_index(), 0)
+        self.assertTrue(prefork.is_primary_process())
+
+    @mock.patch.dict(os.environ, {prefork.MULTIPROC_DIR_ENV: '/some/dir'})
+    @mock.patch.object(prefork.multiprocess, 'mark_process_dead')
+    def test_marks_exited_worker_dead(self, mock_mark_process_dead, mock_fork, mock_waitpid, mock_kill,
+                                      mock_signal, mock_sleep):
+        mock_fork.side_effect = [1, 2, 0]
+        mock_waitpid.side_effect = [(1, 0), (0, 0)]
+        self._mock_monotonic.side_effect = [0, 0, prefork._MIN_WORKER_LIFETIME]
+        self.assertTrue(prefork._Supervisor(2).run())
+        mock_mark_process_dead.assert_called_once_with(1)
+
+    def test_stops_workers_on_signal(self, mock_fork, mock_waitpid, mock_kill, mock_signal, mock_sleep):
+        mock_fork.side_effect = [1, 2]
+        supervisor = prefork._Supervisor(2)
+        mock_waitpid.side_effect = [(0, 0), (1, 0), (2, 0)]
+
+        def _stop_on_first_sleep(_):
+            supervisor._on_stop(signal.SIGTERM, None)
+        mock_sleep.side_effect = _stop_on_first_sleep
+        self.assertFalse(supervisor.run())
+        self.assertFalse(supervisor.failed)
+        self.assertCountEqual(mock_kill.call_args_list, [mock.call(1, signal.SIGTERM), mock.call(2, signal.SIGTERM)])
+        self.assertEqual(mock_fork.call_count, 2)
+
+    def test_restarts_workers_before_stopping_old_ones(self, mock_fork, mock_waitpid, mock_kill, mock_signal,
+                                                       mock_sleep):
+        mock_fork.side_effect = [1, 2, 3, 0]
+        supervisor = prefork._Supervisor(2)
+        mock_waitpid.return_value = (0, 0)
+        supervisor._on_restart(signal.SIGHUP, None)
+        self.assertTrue(supervisor.run())
+        self.assertEqual(mock_fork.call_count, 4)
+        mock_kill.assert_not_called()
+
+
+class TestRequestTracker(TestCase):
+
+    def setUp(self):
+        self._app = mock.Mock()
+        self._tracker = prefork._RequestTracker(self._app)
+        self._request_conn = mock.Mock()
+        self._message = self._tracker.start_request(mock.Mock(), self._request_conn)
+        self._connection = self._app.start_request.call_args[0][1]
+        super().setUp()
+
+    def test_idle_connection_is_not_in_progress(self):
+        self.assertEqual(self._tracker.in_progress, 0)
+
+    def test_request_is_in_progress_after_headers(self):
+        self._message.headers_received('start_line', 'headers')
+        self.assertEqual(self._tracker.in_progress, 1)
+        self._app.start_request.return_value.headers_received.assert_called_once_with('start_line', 'headers')
+
+    def test_request_is_done_after_response_finishes(self):
+        self._message.headers_received('start_line', 'headers')
+        self._message.finish()
+        self.assertEqual(self._tracker.in_progress, 1)
+        self._connection.finish()
+        self.assertEqual(self._tracker.in_progress, 0)
+        self._request_conn.finish.assert_called_once_with()
+
+    def test_request_is_done_once_after_connection_closes(self):
+        self._message.headers_received('start_line', 'headers')
+        self._message.on_connection_close()
+        self._connection.finish()
+        self.assertEqual(self._tracker.in_progress, 0)
+
+    def test_connection_delegates_other_attributes(self):
+        self.assertIs(self._connection.context, self._request_conn.context)
+
+
+class TestDrain(IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self._http_server = mock.Mock()
+        self._tracker = prefork._RequestTracker(mock.Mock())
+        self._mock_stop = mock.Mock()
+        patcher = mock.patch.object(prefork.IOLoop.current(), 'stop', new=self._mock_stop)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+
+    async def test_stops_without_requests_in_progress(self):
+        await asyncio.wait_for(prefork._drain(self._http_server, self._tracker, 60), 1)
+        self._http_server.stop.assert_called_once_with()
+        self._mock_stop.assert_called_once_with()
+
+    async def test_stops_when_requests_finish(self):
+        self._tracker.in_progress = 1
+        drain = asyncio.ensure_future(prefork._drain(self._http_server, self._tracker, 60))
+        await asyncio.sleep(0)
+        self._mock_stop.assert_not_called()
+        self._tracker.in_progress = 0
+        await asyncio.wait_for(drain, 1)
+        self._mock_stop.assert_called_once_with()
+
+    async def test_stops_after_timeout(self):
+        self._tracker.in_progress = 1
+        with self.assertLogs(prefork._logger, level='WARNING'):
+            await asyncio.wait_for(prefork._drain(self._http_server, self._tracker, 0.01), 1)
+        self._mock_stop.assert_called_once_with()
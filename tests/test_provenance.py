@@ -0,0 +1,97 @@
+# Copyright CESSDA ERIC 2021-2025
+#
+# Licensed under the EUPL, Version 1.2 (the "License"); you may not
+# use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os.path
+from types import SimpleNamespace
+from unittest import TestCase
+
+from genshi.template import MarkupTemplate, TemplateLoader
+
+from cdcagg_common.records import Study
+import cdcagg_oai
+
+
+PROVENANCE_SCHEMA_LOCATION = ('http://www.openarchives.org/OAI/2.0/provenance '
+                              'http://www.openarchives.org/OAI/2.0/provenance.xsd')
+# Recursive template that provenance.xml used before. The output must stay the same.
+RECURSIVE_PROVENANCE_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<provenance
+    xmlns="http://www.openarchives.org/OAI/2.0/provenance"
+    xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+    xsi:schemaLocation="%s"
+    xmlns:py="http://genshi.edgewall.org/">
+  <py:def function="render_container(prov, next_index=None)"
+          py:with="next_index = None if len(record.study._provenance) == next_index else next_index">
+    <originDescription
+        py:with="altered = 'true' if prov.attr_altered.get_value() is True else 'false'"
+        harvestDate="${prov.get_value()}"
+        altered="${altered}">
+      <baseURL>${prov.attr_base_url.get_value()}</baseURL>
+      <identifier>${prov.attr_identifier.get_value()}</identifier>
+      <datestamp>${prov.attr_datestamp.get_value()}</datestamp>
+      <metadataNamespace>${prov.attr_metadata_namespace.get_value()}</metadataNamespace>
+      <py:if test="next_index">
+        ${render_container(record.study._provenance[next_index], next_index=next_index + 1)}
+      </py:if>
+    </originDescription>
+  </py:def>
+  ${render_container(record.study._provenance[0], next_index=1)}
+</provenance>
+""" % (PROVENANCE_SCHEMA_LOCATION,)
+
+
+def _record(depth, **provenance_kw):
+    study = Study()
+    for index in range(depth):
+        kw = dict(altered=index % 2 == 0,
+                  base_url='http://somebaseurl/%s?verb=ListRecords&set=<a>' % (index,),
+                  identifier='someidentifier_%s' % (index,),
+                  datestamp='somedatestamp_%s' % (index,),
+                  direct=index == 0,
+                  metadata_namespace='somenamespace')
+        kw.update(provenance_kw)
+        study._provenance.add_value('someharvestdate_%s' % (index,), **kw)
+    return SimpleNamespace(study=study)
+
+
+class TestProvenanceTemplate(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self._template = TemplateLoader([os.path.join(os.path.dirname(cdcagg_oai.__file__), 'templates')]).load(
+            'provenance.xml')
+        self._recursive_template = MarkupTemplate(RECURSIVE_PROVENANCE_TEMPLATE)
+
+    def _assert_same_as_recursive(self, record):
+        events = [(kind, data) for kind, data, _ in self._template.generate(record=record)]
+        exp_events = [(kind, data) for kind, data, _ in self._recursive_template.generate(record=record)]
+        self.assertEqual(events, exp_events)
+        self.assertEqual(self._template.generate(record=record).render('xml', encoding='utf-8'),
+                         self._recursive_template.generate(record=record).render('xml', encoding='utf-8'))
+
+    def test_output_is_identical_to_recursive_template(self):
+        for depth in range(1, 6):
+            with self.subTest(depth=depth):
+                self._assert_same_as_recursive(_record(depth))
+
+    def test_output_is_identical_to_recursive_template_for_missing_values(self):
+        for depth in range(1, 4):
+            with self.subTest(depth=depth):
+                self._assert_same_as_recursive(_record(depth, base_url=None, altered=None))
+
+    def test_containers_are_nested_in_order(self):
+        output = self._template.generate(record=_record(3)).render('xml')
+        self.assertLess(output.index('someharvestdate_0'), output.index('someharvestdate_1'))
+        self.assertLess(output.index('someharvestdate_1'), output.index('someharvestdate_2'))
+        self.assertTrue(output.rstrip().endswith(
+            '</originDescription>\n    </originDescription>\n    </originDescription>\n</provenance>'))
@@ -0,0 +1,210 @@
+# Copyright CESSDA ERIC 2021-2025
+#
+# Licensed under the EUPL, Version 1.2 (the "License"); you may not
+# use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+from argparse import Namespace
+from unittest import mock
+
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, gen_test
+from tornado.web import Application, RequestHandler
+
+from cdcagg_oai import coalescing, compression, responsecache
+
+
+def _settings(**kw):
+    return Namespace(oai_pmh_response_cache_size=kw.get('size', 10),
+                     oai_pmh_response_cache_max_bytes=kw.get('max_bytes', 1024 * 1024),
+                     oai_pmh_response_cache_ttl=kw.get('ttl', 60),
+                     oai_pmh_response_cache_check_interval=kw.get('check_interval', 10),
+                     oai_pmh_respond_with_requested_url=False)
+
+
+class TestResponseCache(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = responsecache._ResponseCache()
+        self.cache.configure(2, 100, 60, 10, False)
+        patcher = mock.patch.object(responsecache, '_latest_datestamp', new=mock.AsyncMock(return_value='a'))
+        self._mock_latest_datestamp = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def _put(self, key, body=b'body'):
+        self.cache.put(key, await self.cache.marker(), 200, 'text/xml', body)
+
+    @gen_test
+    async def test_returns_cached_entry(self):
+        await self._put('key')
+        self.assertEqual(self.cache.get('key', await self.cache.marker()).variants[None], b'body')
+
+    @gen_test
+    async def test_evicts_least_recently_used_entry(self):
+        await self._put('first')
+        await self._put('second')
+        marker = await self.cache.marker()
+        self.cache.get('first', marker)
+        await self._put('third')
+        self.assertIsNone(self.cache.get('second', marker))
+        self.assertIsNotNone(self.cache.get('first', marker))
+
+    @gen_test
+    async def test_evicts_entries_over_byte_budget(self):
+        await self._put('first', b'x' * 60)
+        await self._put('second', b'x' * 60)
+        marker = await self.cache.marker()
+        self.assertIsNone(self.cache.get('first', marker))
+        self.assertIsNotNone(self.cache.get('second', marker))
+
+    @gen_test
+    async def test_does_not_cache_entry_over_byte_budget(self):
+        await self._put('key', b'x' * 101)
+        self.assertIsNone(self.cache.get('key', await self.cache.marker()))
+
+    @gen_test
+    async def test_does_not_cache_entry_with_expiring_resumption_token(self):
+        await self._put('key', b'<resumptionToken cursor="0" expirationDate="2025-01-01T00:00:00Z">t</resumptionToken>')
+        self.assertIsNone(self.cache.get('key', await self.cache.marker()))
+
+    @gen_test
+    async def test_caches_entry_with_resumption_token_without_expiration(self):
+        await self._put('key', b'<resumptionToken cursor="0">t</resumptionToken>')
+        self.assertIsNotNone(self.cache.get('key', await self.cache.marker()))
+
+    @gen_test
+    async def test_counts_variants_in_byte_budget(self):
+        await self._put('first', b'x' * 40)
+        await self._put('second', b'x' * 40)
+        marker = await self.cache.marker()
+        self.cache.add_variant('second', self.cache.get('second', marker), 'gzip', b'x' * 30)
+        self.assertIsNone(self.cache.get('first', marker))
+
+    @gen_test
+    async def test_rewrites_response_date(self):
+        await self._put('key', b'<responseDate>2020-01-01T00:00:00Z</responseDate><x/>')
+        entry = self.cache.get('key', await self.cache.marker())
+        self.cache.add_variant('key', entry, 'gzip', b'compressed')
+        self.cache.set_response_date('key', entry, b'2030-12-31T23:59:59Z')
+        self.assertEqual(entry.variants, {None: b'<responseDate>2030-12-31T23:59:59Z</responseDate><x/>'})
+        self.assertEqual(entry.response_date, b'2030-12-31T23:59:59Z')
+        self.assertEqual(self.cache._size, entry.size)
+
+    @gen_test
+    async def test_does_not_rewrite_response_without_response_date(self):
+        await self._put('key')
+        entry = self.cache.get('key', await self.cache.marker())
+        self.assertIsNone(entry.response_date)
+        self.cache.set_response_date('key', entry, b'2030-12-31T23:59:59Z')
+        self.assertEqual(entry.variants, {None: b'body'})
+
+    @gen_test
+    async def test_expires_entries(self):
+        self.cache.configure(2, 100, 0, 10, False)
+        await self._put('key')
+        self.assertIsNone(self.cache.get('key', await self.cache.marker()))
+
+    @gen_test
+    async def test_invalidates_entries_when_datestamps_change(self):
+        self.cache.configure(2, 100, 60, 0, False)
+        await self._put('key')
+        self._mock_latest_datestamp.return_value = 'b'
+        self.assertIsNone(self.cache.get('key', await self.cache.marker()))
+        self.assertEqual(self.cache._size, 0)
+
+    @gen_test
+    async def test_looks_up_datestamps_once_per_check_interval(self):
+        await self.cache.marker()
+        await self.cache.marker()
+        # Latest updated and deleted datestamps.
+        self.assertEqual(self._mock_latest_datestamp.call_count, 2)
+
+
+class _ListHandler(RequestHandler):
+
+    calls = 0
+    _correlation_id = mock.Mock()
+
+    async def get(self):
+        _ListHandler.calls += 1
+        self.set_header('Content-Type', 'text/xml')
+        self.write('<responseDate>2020-01-01T00:00:00Z</responseDate>')
+        self.write('<ListRecords>%s</ListRecords>' % ('<record/>' * 200,))
+
+
+class TestResponseCacheHandler(AsyncHTTPTestCase):
+
+    def setUp(self):
+        super().setUp()
+        _ListHandler.calls = 0
+        for target, attribute, value in (
+                (responsecache, '_latest_datestamp', mock.AsyncMock(return_value='a')),
+                (responsecache, 'observe_response_cache_lookup', mock.Mock()),
+                (responsecache, '_response_date', mock.Mock(return_value=b'2030-12-31T23:59:59Z')),
+                (coalescing.ConfigurableAggMDSet, 'get_mapping_mtimes',
+                 mock.AsyncMock(return_value={}))):
+            patcher = mock.patch.object(target, attribute, new=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        responsecache.configure(_settings())
+        self.addCleanup(responsecache.configure, _settings(size=0))
+
+    def get_app(self):
+        return Application([('/v0/oai', responsecache.handler_class(_ListHandler))],
+                           transforms=[compression.CompressionTransform])
+
+    def test_serves_first_page_from_cache(self):
+        first = self.fetch('/v0/oai?verb=ListRecords&metadataPrefix=oai_dc')
+        second = self.fetch('/v0/oai?metadataPrefix=oai_dc&verb=ListRecords')
+        self.assertEqual(_ListHandler.calls, 1)
+        self.assertEqual(first.body.replace(b'2020-01-01T00:00:00Z', b'2030-12-31T23:59:59Z'), second.body)
+        self.assertEqual(second.headers['Content-Type'], 'text/xml')
+
+    def test_rewrites_response_date_of_cached_response(self):
+        url = '/v0/oai?verb=ListRecords&metadataPrefix=oai_dc'
+        self.fetch(url)
+        self.assertIn(b'<responseDate>2030-12-31T23:59:59Z</responseDate>', self.fetch(url).body)
+        responsecache._response_date.return_value = b'2031-01-01T00:00:00Z'
+        self.assertIn(b'<responseDate>2031-01-01T00:00:00Z</responseDate>', self.fetch(url).body)
+        self.assertEqual(_ListHandler.calls, 1)
+
+    def test_does_not_cache_other_requests(self):
+        for url in ('/v0/oai?verb=ListRecords&resumptionToken=token',
+                    '/v0/oai?verb=GetRecord&metadataPrefix=oai_dc&identifier=id'):
+            with self.subTest(url=url):
+                _ListHandler.calls = 0
+                self.fetch(url)
+                self.fetch(url)
+                self.assertEqual(_ListHandler.calls, 2)
+
+    def test_serves_compressed_variant(self):
+        settings = Namespace(oai_pmh_compression_encodings='gzip', oai_pmh_compression_level=6,
+                             oai_pmh_compression_brotli_quality=4, oai_pmh_compression_min_length=1024,
+                             api_version='v0')
+        compression.configure(settings)
+        self.addCleanup(compression.configure, Namespace(**dict(vars(settings), oai_pmh_compression_encodings='')))
+        url = '/v0/oai?verb=ListIdentifiers&metadataPrefix=oai_dc'
+        first = self.fetch(url, decompress_response=False, headers={'Accept-Encoding': 'gzip'})
+        expected = gzip.decompress(first.body).replace(b'2020-01-01T00:00:00Z', b'2030-12-31T23:59:59Z')
+        for _ in range(2):
+            resp = self.fetch(url, decompress_response=False, headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+            self.assertEqual(gzip.decompress(resp.body), expected)
+        plain = self.fetch(url, decompress_response=False)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(plain.body, expected)
+        self.assertEqual(_ListHandler.calls, 1)
+        entry = next(iter(responsecache._CACHE._entries.values()))
+        self.assertEqual(set(entry.variants), {None, 'gzip'})
+        responsecache._response_date.return_value = b'2031-01-01T00:00:00Z'
+        resp = self.fetch(url, decompress_response=False, headers={'Accept-Encoding': 'gzip'})
+        self.assertIn(b'2031-01-01T00:00:00Z', gzip.decompress(resp.body))
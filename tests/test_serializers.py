@@ -0,0 +1,313 @@
+# Copyright CESSDA ERIC 2021-2025
+#
+# Licensed under the EUPL, Version 1.2 (the "License"); you may not
+# use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-eupl-12
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import random
+from types import SimpleNamespace
+from tempfile import TemporaryDirectory
+from unittest import mock, TestCase, IsolatedAsyncioTestCase
+
+from genshi.template import TemplateLoader
+
+import cdcagg_oai
+from cdcagg_oai import serializers
+
+
+TEMPLATE_FOLDER = os.path.join(os.path.dirname(cdcagg_oai.__file__), 'templates')
+GOLDEN_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'golden')
+METADATA = SimpleNamespace(namespace='somenamespace', schema='someschema')
+# Values that need escaping or that Genshi treats specially.
+TRICKY_VALUES = [None, '', 'value', 'a & b < c > "d" \'e\'', 'trailing  \nspace', 'blank\n\n\nlines',
+                 'tab\t\nend', 42, 1.5, True, 'äöå €']
+
+
+class _Field:
+
+    def __init__(self, value, language=None, **attrs):
+        self._value = value
+        self._language = language
+        for key, attr_value in attrs.items():
+            setattr(self, 'attr_' + key, _Field(attr_value))
+
+    def get_value(self):
+        return self._value
+
+    def get_language(self):
+        return self._language
+
+
+def _record(aggregator_identifier='agg_id_1', updated='2020-01-01T00:00:00Z', **study_fields):
+    fields = dict(_aggregator_identifier=_Field(aggregator_identifier),
+                  _metadata=SimpleNamespace(attr_updated=_Field(updated)),
+                  identifiers=[], document_uris=[], study_uris=[], study_titles=[], principal_investigators=[],
+                  publishers=[], abstract=[], keywords=[], classifications=[], publication_years=[],
+                  data_collection_copyrights=[], study_area_countries=[], data_access=[],
+                  geographic_coverages=[])
+    fields.update(study_fields)
+    return SimpleNamespace(study=SimpleNamespace(**fields),
+                           preferred_identifier=('DOI', 'some_doi'),
+                           publication_year='2001',
+                           publisher_lang_val=('en', 'some publisher'),
+                           related_identifier_types_ids=[('DOI', 'related_doi'), ('URN', 'related_urn')],
+                           funders=[('some_funder', 'grant_1', 'Agency & co')])
+
+
+def _golden_record(**record_fields):
+    # Only single distinct values in sets, since set order varies between processes.
+    return _record(
+        **record_fields,
+        identifiers=[_Field('some_id', 'en'), _Field('some_id', 'fi')],
+        document_uris=[_Field('http://some.uri?a=1&b=2', 'en')],
+        study_titles=[_Field('Some <title>', 'en'), _Field('Joku otsikko', 'en')],
+        principal_investigators=[_Field('Some PI', 'en', organization='Some org'),
+                                 _Field('Other PI', None, organization=None)],
+        publishers=[_Field('Some publisher', 'en')],
+        abstract=[_Field('Abstract with\n\n\nblank lines  \nand trailing space.', 'en'),
+                  _Field('Tiivistelmä', 'fi')],
+        keywords=[_Field('keyword', 'en', description=None, system_name='Scheme', uri='http://scheme'),
+                  _Field('avainsana', 'fi', description='Kuvaus', system_name=None, uri=None)],
+        classifications=[_Field(None, 'en', description='"Quoted" class', system_name='CESSDA', uri='')],
+        publication_years=[_Field('2001', 'en', distribution_date='2001-02-03'),
+                           _Field(None, 'fi', distribution_date=None)],
+        data_collection_copyrights=[_Field('Rights & more', 'en')],
+        study_area_countries=[_Field('Finland', 'en'), _Field(None, 'fi')],
+        data_access=[_Field('Open', 'en')],
+        geographic_coverages=[_Field('Europe', 'en'), _Field('Eurooppa', 'fi')])
+
+
+def _random_fields(rand, *attrs):
+    return [_Field(rand.choice(TRICKY_VALUES), rand.choice(TRICKY_VALUES),
+                   **{attr: rand.choice(TRICKY_VALUES) for attr in attrs})
+            for _ in range(rand.randint(0, 3))]
+
+
+def _random_record(rand):
+    record = _record(**{name: _random_fields(rand, 'description', 'system_name', 'uri', 'organization',
+                                             'distribution_date')
+                        for name in ('identifiers', 'document_uris', 'study_uris', 'study_titles',
+                                     'principal_investigators', 'publishers', 'abstract', 'keywords',
+                                     'classifications', 'publication_years', 'data_collection_copyrights',
+                                     'study_area_countries', 'data_access', 'geographic_coverages')})
+    record.preferred_identifier = (rand.choice(TRICKY_VALUES), rand.choice(TRICKY_VALUES))
+    record.publication_year = rand.choice(TRICKY_VALUES)
+    record.publisher_lang_val = rand.choice([(), ('en', rand.choice(TRICKY_VALUES))])
+    record.related_identifier_types_ids = [(rand.choice(TRICKY_VALUES), rand.choice(TRICKY_VALUES))
+                                           for _ in range(rand.randint(0, 2))]
+    record.funders = rand.choice([[], [('funder', rand.choice(TRICKY_VALUES), rand.choice(TRICKY_VALUES))]])
+    return record
+
+
+class TestCompiledSerializerEngine(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self._loader = TemplateLoader([TEMPLATE_FOLDER])
+
+    def tearDown(self):
+        serializers.set_engine(serializers.SERIALIZER_ENGINE_GENSHI)
+        super().tearDown()
+
+    def _render(self, template, record):
+        return self._loader.load(template).generate(record=record, metadata=METADATA).render(
+            'xml', encoding='utf-8')
+
+    def _assert_golden(self, template, golden_filename):
+        with open(os.path.join(GOLDEN_FOLDER, golden_filename), 'rb') as file_obj:
+            golden = file_obj.read()
+        self.assertEqual(self._render(template, _golden_record()), golden)
+
+    def test_genshi_oai_dc_matches_golden_file(self):
+        self._assert_golden('agg_oai_dc.xml', 'oai_dc.xml')
+
+    def test_compiled_oai_dc_matches_golden_file(self):
+        self._assert_golden('agg_oai_dc_compiled.xml', 'oai_dc.xml')
+
+    def test_genshi_oai_datacite_matches_golden_file(self):
+        self._assert_golden('agg_oai_datacite.xml', 'oai_datacite.xml')
+
+    def test_compiled_oai_datacite_matches_golden_file(self):
+        self._assert_golden('agg_oai_datacite_compiled.xml', 'oai_datacite.xml')
+
+    def test_compiled_output_matches_genshi_output_for_tricky_values(self):
+        rand = random.Random(0)
+        for index in range(300):
+            record = _random_record(rand)
+            for template, compiled_template in (('agg_oai_dc.xml', 'agg_oai_dc_compiled.xml'),
+                                                ('agg_oai_datacite.xml', 'agg_oai_datacite_compiled.xml')):
+                with self.subTest(index=index, template=template):
+                    self.assertEqual(self._render(compiled_template, record), self._render(template, record))
+
+    def test_subtemplate_returns_compiled_template_for_compiled_engine(self):
+        serializers.set_engine(serializers.SERIALIZER_ENGINE_COMPILED)
+        self.assertEqual(serializers.subtemplate('agg_oai_dc.xml'), 'agg_oai_dc_compiled.xml')
+        self.assertEqual(serializers.subtemplate('agg_oai_datacite.xml'), 'agg_oai_datacite_compiled.xml')
+
+    def test_subtemplate_returns_template_without_compiled_counterpart(self):
+        serializers.set_engine(serializers.SERIALIZER_ENGINE_COMPILED)
+        self.assertEqual(serializers.subtemplate('oai_ddi25.xml'), 'oai_ddi25.xml')
+
+    def test_subtemplate_returns_template_for_genshi_engine(self):
+        self.assertEqual(serializers.subtemplate('agg_oai_dc.xml'), 'agg_oai_dc.xml')
+
+    def test_set_engine_raises_ValueError_for_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            serializers.set_engine('unknown')
+
+
+class TestFragmentCache(IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self._cache = serializers._FragmentCache()
+        self._mock_write = mock.Mock(side_effect=serializers._write_oai_dc)
+        patcher = mock.patch.object(serializers, 'observe_fragment_cache_lookup')
+        self._mock_observe = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _wait_for_writes(self):
+        self._cache._get_executor().submit(lambda: None).result()
+
+    def test_disabled_by_default(self):
+        record = _golden_record()
+        for _ in range(2):
+            self._cache.get_or_write('oai_dc', record, self._mock_write)
+        self.assertEqual(self._mock_write.call_count, 2)
+        self._mock_observe.assert_not_called()
+
+    def test_returns_cached_events(self):
+        self._cache.configure(10)
+        record = _golden_record()
+        events = self._cache.get_or_write('oai_dc', record, self._mock_write)
+        self.assertIs(self._cache.get_or_write('oai_dc', record, self._mock_write), events)
+        self._mock_write.assert_called_once_with(record)
+        self.assertEqual(self._mock_observe.call_args_list, [mock.call('miss'), mock.call('hit')])
+
+    def test_keys_by_identifier_prefix_and_updated(self):
+        self._cache.configure(10)
+        self._cache.get_or_write('oai_dc', _golden_record(), self._mock_write)
+        self._cache.get_or_write('oai_datacite', _golden_record(), self._mock_write)
+        self._cache.get_or_write('oai_dc', _golden_record(aggregator_identifier='agg_id_2'), self._mock_write)
+        self._cache.get_or_write('oai_dc', _golden_record(updated='2021-01-01T00:00:00Z'), self._mock_write)
+        self.assertEqual(self._mock_write.call_count, 4)
+
+    def test_does_not_cache_records_without_identifier_or_updated(self):
+        self._cache.configure(10)
+        for record in (_golden_record(aggregator_identifier=None), _golden_record(updated=None)):
+            for _ in range(2):
+                self._cache.get_or_write('oai_dc', record, self._mock_write)
+        self.assertEqual(self._mock_write.call_count, 4)
+
+    def test_evicts_least_recently_used(self):
+        self._cache.configure(2)
+        first, second, third = (_golden_record(aggregator_identifier=identifier)
+                                for identifier in ('agg_id_1', 'agg_id_2', 'agg_id_3'))
+        for record in (first, second, first, third, first, second):
+            self._cache.get_or_write('oai_dc', record, self._mock_write)
+        self.assertEqual([call[0][0] for call in self._mock_write.call_args_list], [first, second, third, second])
+
+    async def test_spills_evicted_entries_to_disk(self):
+        with TemporaryDirectory() as directory:
+            self._cache.configure(1, directory)
+            events = self._cache.get_or_write('oai_dc', _golden_record(), self._mock_write)
+            self._cache.get_or_write('oai_dc', _golden_record(aggregator_identifier='agg_id_2'), self._mock_write)
+            self._wait_for_writes()
+            self._cache.configure(1, directory)
+            await self._cache.load('oai_dc', _golden_record().study)
+            self.assertEqual(self._cache.get_or_write('oai_dc', _golden_record(), self._mock_write), events)
+        self.assertEqual(self._mock_write.call_count, 2)
+        self._mock_observe.assert_called_with('disk_hit')
+
+    def test_does_not_read_disk_when_rendering(self):
+        with TemporaryDirectory() as directory:
+            self._cache.configure(1, directory)
+            self._cache.get_or_write('oai_dc', _golden_record(), self._mock_write)
+            self._cache.get_or_write('oai_dc', _golden_record(aggregator_identifier='agg_id_2'), self._mock_write)
+            self._wait_for_writes()
+            with mock.patch.object(self._cache, '_read') as mock_read:
+                self._cache.get_or_write('oai_dc', _golden_record(), self._mock_write)
+        mock_read.assert_not_called()
+        self.assertEqual(self._mock_write.call_count, 3)
+
+    async def test_does_not_write_entries_loaded_from_disk_again(self):
+        with TemporaryDirectory() as directory:
+            self._cache.configure(1, directory)
+            self._cache.get_or_write('oai_dc', _golden_record(), self._mock_write)
+            self._cache.get_or_write('oai_dc', _golden_record(aggregator_identifier='agg_id_2'), self._mock_write)
+            self._wait_for_writes()
+            await self._cache.load('oai_dc', _golden_record().study)
+            with mock.patch.object(self._cache, '_write') as mock_write:
+                self._cache.get_or_write('oai_dc', _golden_record(aggregator_identifier='agg_id_3'),
+                                         self._mock_write)
+                self._wait_for_writes()
+        mock_write.assert_not_called()
+
+    async def test_ignores_outdated_entries_on_disk(self):
+        with TemporaryDirectory() as directory:
+            self._cache.configure(1, directory)
+            self._cache.get_or_write('oai_dc', _golden_record(), self._mock_write)
+            self._cache.get_or_write('oai_dc', _golden_record(aggregator_identifier='agg_id_2'), self._mock_write)
+            self._wait_for_writes()
+            record = _golden_record(updated='2021-01-01T00:00:00Z')
+            await self._cache.load('oai_dc', record.study)
+            self._cache.get_or_write('oai_dc', record, self._mock_write)
+            self._wait_for_writes()
+        self.assertEqual(self._mock_write.call_count, 3)
+
+    async def test_ignores_corrupted_entries_on_disk(self):
+        with TemporaryDirectory() as directory:
+            self._cache.configure(1, directory)
+            with open(self._cache._path('agg_id_1', 'oai_dc'), 'wb') as file_obj:
+                file_obj.write(b'invalid')
+            with self.assertLogs(serializers._logger, level='WARNING'):
+                await self._cache.load('oai_dc', _golden_record().study)
+            self._cache.get_or_write('oai_dc', _golden_record(), self._mock_write)
+        self._mock_write.assert_called_once()
+
+    def test_removes_oldest_files_over_max_files(self):
+        with TemporaryDirectory() as directory:
+            self._cache.configure(1, directory, max_files=10)
+            for index in range(12):
+                self._cache.get_or_write('oai_dc', _golden_record(aggregator_identifier='agg_id_%s' % (index,)),
+                                         self._mock_write)
+                self._wait_for_writes()
+                spilled = self._cache._path('agg_id_%s' % (index - 1,), 'oai_dc')
+                if os.path.exists(spilled):
+                    # Spilled in order of identifiers.
+                    os.utime(spilled, (index, index))
+            files = os.listdir(directory)
+            self.assertEqual(len(files), 9)
+            self.assertNotIn(os.path.basename(self._cache._path('agg_id_0', 'oai_dc')), files)
+            self.assertIn(os.path.basename(self._cache._path('agg_id_10', 'oai_dc')), files)
+
+    @mock.patch.object(serializers, '_engine', serializers.SERIALIZER_ENGINE_COMPILED)
+    @mock.patch.object(serializers._FRAGMENT_CACHE, 'load', new_callable=mock.AsyncMock)
+    async def test_load_fragment_loads_cached_prefixes_only(self, mock_load):
+        study = _golden_record().study
+        await serializers.load_fragment('oai_dc', study)
+        await serializers.load_fragment('oai_ddi25', study)
+        mock_load.assert_awaited_once_with('oai_dc', study)
+
+    @mock.patch.object(serializers._FRAGMENT_CACHE, 'load', new_callable=mock.AsyncMock)
+    async def test_load_fragment_does_nothing_for_genshi_engine(self, mock_load):
+        await serializers.load_fragment('oai_dc', _golden_record().study)
+        mock_load.assert_not_awaited()
+
+    def test_cached_output_matches_golden_file(self):
+        serializers.configure_fragment_cache(10)
+        self.addCleanup(serializers.configure_fragment_cache, 0)
+        loader = TemplateLoader([TEMPLATE_FOLDER])
+        with open(os.path.join(GOLDEN_FOLDER, 'oai_dc.xml'), 'rb') as file_obj:
+            golden = file_obj.read()
+        for _ in range(2):
+            self.assertEqual(loader.load('agg_oai_dc_compiled.xml').generate(
+                record=_golden_record(), metadata=METADATA).render('xml', encoding='utf-8'), golden)
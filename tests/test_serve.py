@@ -70,27 +70,76 @@ def _study_for_oaidc():
 @mock.patch.object(serve.controller, 'add_cli_args')
 @mock.patch.object(serve.server, 'add_cli_args')
 @mock.patch.object(serve, 'set_ctx_populator')
-@mock.patch.object(serve.server, 'configure')
 @mock.patch.object(serve, 'setup_app_logging')
 class TestConfigure(TestCase):
-    def test_calls_conf_load(self, mock_setup_app_logging,
-                             mock_server_configure,
+
+    def setUp(self):
+        super().setUp()
+        self._mock_configures = {}
+        for module in (serve.server, serve.metrics, serve.metadataformats, serve.compression,
+                       serve.conditional, serve.admission, serve.loadshed, serve.coalescing,
+                       serve.responsecache):
+            patcher = mock.patch.object(module, 'configure')
+            self._mock_configures[module.__name__] = patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(serve.prefork, 'ensure_multiprocess_metrics_dir')
+        self._mock_ensure_multiprocess_metrics_dir = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_calls_conf_load(self,
+                             mock_setup_app_logging,
                              mock_set_ctx_populator,
                              mock_server_add_cli_args,
                              mock_controller_add_cli_args,
                              mock_conf):
+        mock_conf.get_conf.return_value.workers = 1
         serve.configure([])
         mock_conf.load.assert_called_once_with(
             prog='cdcagg_oai', package='cdcagg_oai', env_var_prefix='CDCAGG_')
 
-    def test_calls_server_configure(self, mock_setup_app_logging,
-                                    mock_server_configure,
-                                    mock_set_ctx_populator,
-                                    mock_server_add_cli_args,
-                                    mock_controller_add_cli_args,
-                                    mock_conf):
+    def test_calls_configure_with_settings(self,
+                                           mock_setup_app_logging,
+                                           mock_set_ctx_populator,
+                                           mock_server_add_cli_args,
+                                           mock_controller_add_cli_args,
+                                           mock_conf):
+        mdformat = mock.Mock()
+        settings = mock_conf.get_conf.return_value
+        settings.workers = 1
+        serve.configure([mdformat])
+        mdformat.configure.assert_called_once_with(settings)
+        for name, mock_configure in self._mock_configures.items():
+            with self.subTest(module=name):
+                mock_configure.assert_called_once_with(settings)
+        self._mock_ensure_multiprocess_metrics_dir.assert_not_called()
+
+    def test_shares_metrics_before_configuring_modules_if_using_workers(self,
+                                                                        mock_setup_app_logging,
+                                                                        mock_set_ctx_populator,
+                                                                        mock_server_add_cli_args,
+                                                                        mock_controller_add_cli_args,
+                                                                        mock_conf):
+        mock_conf.get_conf.return_value.workers = 2
+        mock_conf.get_conf.return_value.print_configuration = False
+
+        def _ensure_multiprocess_metrics_dir():
+            for name, mock_configure in self._mock_configures.items():
+                with self.subTest(module=name):
+                    mock_configure.assert_not_called()
+        self._mock_ensure_multiprocess_metrics_dir.side_effect = _ensure_multiprocess_metrics_dir
         serve.configure([])
-        mock_server_configure.assert_called_once_with(mock_conf.get_conf.return_value)
+        self._mock_ensure_multiprocess_metrics_dir.assert_called_once_with()
+
+    def test_does_not_share_metrics_if_printing_configuration(self,
+                                                              mock_setup_app_logging,
+                                                              mock_set_ctx_populator,
+                                                              mock_server_add_cli_args,
+                                                              mock_controller_add_cli_args,
+                                                              mock_conf):
+        mock_conf.get_conf.return_value.workers = 2
+        mock_conf.get_conf.return_value.print_configuration = True
+        serve.configure([])
+        self._mock_ensure_multiprocess_metrics_dir.assert_not_called()
 
 
 @mock.patch.object(serve.server, 'serve')
@@ -109,7 +158,7 @@ class TestMain(testcasebase(TestCase)):
                                                          mock_configure,
                                                          mock_serve):
         mock_configure.return_value = Namespace(
-            print_configuration=False, api_version='v0', port=6003)
+            print_configuration=False, api_version='v0', port=6003, workers=1)
         serve.main()
         mock_get_app.assert_called_once_with(
             'v0', controller=mock_from_settings.return_value, app_class=serve.metrics.CDCAggWebApp)
@@ -122,7 +171,7 @@ class TestMain(testcasebase(TestCase)):
                                                    mock_serve):
         mock_from_settings.return_value = mock.Mock(stylesheet_url='/v0/oai/static/oai2.xsl')
         mock_configure.return_value = Namespace(
-            print_configuration=False, api_version='v0', port=6003)
+            print_configuration=False, api_version='v0', port=6003, workers=1)
         serve.main()
         mock_set_oai_route_handler_class.assert_called_once_with(serve.http_api.OAIRouteHandler)
 
@@ -133,10 +182,166 @@ class TestMain(testcasebase(TestCase)):
                                     mock_configure,
                                     mock_serve):
         mock_configure.return_value = Namespace(
-            print_configuration=False, api_version='v0', port=6003)
+            print_configuration=False, api_version='v0', port=6003, workers=1)
         serve.main()
         mock_add_handlers.assert_called_once_with('.*', [('/metrics', serve.metrics.CDCAggMetricsHandler)])
 
+    @mock.patch.object(serve.http_api, 'get_app')
+    @mock.patch.object(serve.prefork, 'serve')
+    def test_serves_using_worker_processes(self,
+                                           mock_prefork_serve,
+                                           mock_get_app,
+                                           mock_from_settings,
+                                           mock_configure,
+                                           mock_serve):
+        mock_configure.return_value = Namespace(
+            print_configuration=False, api_version='v0', port=6003, workers=2, workers_shutdown_timeout=10)
+        serve.main()
+        mock_prefork_serve.assert_called_once_with(mock.ANY, 6003, 2, 10)
+        mock_serve.assert_not_called()
+        # Application is set up in worker processes.
+        mock_get_app.assert_not_called()
+
+    @mock.patch.object(serve.conditional, 'is_enabled', return_value=True)
+    def test_adds_conditional_oai_route_handler_if_enabled(self,
+                                                           mock_is_enabled,
+                                                           mock_from_settings,
+                                                           mock_configure,
+                                                           mock_serve):
+        mock_configure.return_value = Namespace(
+            print_configuration=False, api_version='v0', port=6003, workers=1)
+        serve.main()
+        app = mock_serve.call_args[0][0]
+        handler_class = app.find_handler(serve.HTTPServerRequest('GET', '/v0/oai')).handler_class
+        self.assertTrue(issubclass(handler_class, serve.http_api.OAIRouteHandler))
+        self.assertTrue(issubclass(handler_class, serve.conditional._ConditionalRequestMixin))
+
+    @mock.patch.object(serve.admission, 'is_enabled', return_value=True)
+    @mock.patch.object(serve.conditional, 'is_enabled', return_value=True)
+    def test_adds_admission_controlled_oai_route_handler_if_enabled(self,
+                                                                    mock_conditional_is_enabled,
+                                                                    mock_admission_is_enabled,
+                                                                    mock_from_settings,
+                                                                    mock_configure,
+                                                                    mock_serve):
+        mock_configure.return_value = Namespace(
+            print_configuration=False, api_version='v0', port=6003, workers=1)
+        serve.main()
+        app = mock_serve.call_args[0][0]
+        handler_class = app.find_handler(serve.HTTPServerRequest('GET', '/v0/oai')).handler_class
+        # Admission is decided before conditional requests are answered.
+        self.assertEqual(handler_class.__mro__[1], serve.admission._AdmissionControlMixin)
+        self.assertTrue(issubclass(handler_class, serve.conditional._ConditionalRequestMixin))
+
+    @mock.patch.object(serve.loadshed, 'is_enabled', return_value=True)
+    @mock.patch.object(serve.admission, 'is_enabled', return_value=True)
+    def test_adds_load_shedding_oai_route_handler_if_enabled(self,
+                                                             mock_admission_is_enabled,
+                                                             mock_loadshed_is_enabled,
+                                                             mock_from_settings,
+                                                             mock_configure,
+                                                             mock_serve):
+        mock_configure.return_value = Namespace(
+            print_configuration=False, api_version='v0', port=6003, workers=1)
+        serve.main()
+        app = mock_serve.call_args[0][0]
+        handler_class = app.find_handler(serve.HTTPServerRequest('GET', '/v0/oai')).handler_class
+        # Requests are shed before they are queued for admission.
+        self.assertEqual(handler_class.__mro__[1:3], (serve.loadshed._LoadSheddingMixin,
+                                                      serve.admission._AdmissionControlMixin))
+
+    @mock.patch.object(serve.coalescing, 'is_enabled', return_value=True)
+    @mock.patch.object(serve.conditional, 'is_enabled', return_value=True)
+    def test_adds_coalescing_oai_route_handler_if_enabled(self,
+                                                          mock_conditional_is_enabled,
+                                                          mock_coalescing_is_enabled,
+                                                          mock_from_settings,
+                                                          mock_configure,
+                                                          mock_serve):
+        mock_configure.return_value = Namespace(
+            print_configuration=False, api_version='v0', port=6003, workers=1)
+        serve.main()
+        app = mock_serve.call_args[0][0]
+        handler_class = app.find_handler(serve.HTTPServerRequest('GET', '/v0/oai')).handler_class
+        self.assertEqual(handler_class.__mro__[1:3], (serve.coalescing._CoalescingMixin,
+                                                      serve.conditional._ConditionalRequestMixin))
+
+    @mock.patch.object(serve.responsecache, 'is_enabled', return_value=True)
+    @mock.patch.object(serve.admission, 'is_enabled', return_value=True)
+    def test_adds_response_cache_oai_route_handler_if_enabled(self,
+                                                              mock_admission_is_enabled,
+                                                              mock_responsecache_is_enabled,
+                                                              mock_from_settings,
+                                                              mock_configure,
+                                                              mock_serve):
+        mock_configure.return_value = Namespace(
+            print_configuration=False, api_version='v0', port=6003, workers=1)
+        serve.main()
+        app = mock_serve.call_args[0][0]
+        handler_class = app.find_handler(serve.HTTPServerRequest('GET', '/v0/oai')).handler_class
+        # Cached responses are served before admission.
+        self.assertEqual(handler_class.__mro__[1:3], (serve.responsecache._ResponseCacheMixin,
+                                                      serve.admission._AdmissionControlMixin))
+
+    @mock.patch.object(serve.loadshed, 'start_lag_monitor')
+    def test_starts_event_loop_lag_monitor(self,
+                                           mock_start_lag_monitor,
+                                           mock_from_settings,
+                                           mock_configure,
+                                           mock_serve):
+        mock_configure.return_value = Namespace(
+            print_configuration=False, api_version='v0', port=6003, workers=1)
+        serve.main()
+        mock_start_lag_monitor.assert_called_once_with()
+
+    @mock.patch.object(serve.metrics, 'start_refresh')
+    def test_starts_metrics_refresh(self,
+                                    mock_start_refresh,
+                                    mock_from_settings,
+                                    mock_configure,
+                                    mock_serve):
+        mock_configure.return_value = Namespace(
+            print_configuration=False, api_version='v0', port=6003, workers=1)
+        serve.main()
+        mock_start_refresh.assert_called_once_with()
+
+    @mock.patch.object(serve.prefork, 'is_primary_process', return_value=False)
+    @mock.patch.object(serve.metrics, 'start_refresh')
+    def test_does_not_start_metrics_refresh_in_other_workers(self,
+                                                             mock_start_refresh,
+                                                             mock_is_primary_process,
+                                                             mock_from_settings,
+                                                             mock_configure,
+                                                             mock_serve):
+        mock_configure.return_value = Namespace(
+            print_configuration=False, api_version='v0', port=6003, workers=1)
+        serve.main()
+        mock_start_refresh.assert_not_called()
+
+    @mock.patch.object(serve.metrics.CDCAggWebApp, 'add_transform')
+    @mock.patch.object(serve.compression, 'is_enabled', return_value=True)
+    def test_adds_compression_transform_if_enabled(self,
+                                                   mock_is_enabled,
+                                                   mock_add_transform,
+                                                   mock_from_settings,
+                                                   mock_configure,
+                                                   mock_serve):
+        mock_configure.return_value = Namespace(
+            print_configuration=False, api_version='v0', port=6003, workers=1)
+        serve.main()
+        mock_add_transform.assert_called_once_with(serve.compression.CompressionTransform)
+
+    @mock.patch.object(serve.metrics.CDCAggWebApp, 'add_transform')
+    def test_does_not_add_compression_transform_by_default(self,
+                                                           mock_add_transform,
+                                                           mock_from_settings,
+                                                           mock_configure,
+                                                           mock_serve):
+        mock_configure.return_value = Namespace(
+            print_configuration=False, api_version='v0', port=6003, workers=1)
+        serve.main()
+        mock_add_transform.assert_not_called()
+
 
 def _query_single(result):
     async def _inner_query_single(record, on_record, **_discard):